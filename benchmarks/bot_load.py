@@ -0,0 +1,240 @@
+"""Сквозной нагрузочный тест обработчиков бота
+
+Прогоняет синтетические обновления через настоящий Dispatcher и
+обработчики из handlers/ с заглушкой Bot API (benchmarks.fake_telegram)
+и локальным Postgres. Каждый пользователь по кругу проходит сценарий
+"/start -> записать шутку -> шутка пользователей -> мои шутки", в конце
+удаляет свои шутки, а админ параллельно добавляет и удаляет админов.
+
+Печатает пропускную способность и p50/p95/p99 задержки по каждому
+обработчику для каждого числа пользователей. С --save результат
+сохраняется как базовый, с --baseline сравнивается с ним: рост p95 или
+падение пропускной способности больше --tolerance считается регрессией.
+
+Запускать на тестовой базе: python -m benchmarks.bot_load --users 10 50
+"""
+from argparse import ArgumentParser
+from asyncio import create_task, gather, run
+from collections import defaultdict
+from json import dump, load
+from os import environ
+from statistics import quantiles
+from sys import exit
+from time import perf_counter, time
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from benchmarks.fake_telegram import FakeTelegram
+
+BASE_USER_ID = -(10**12)
+ADMIN_ID = BASE_USER_ID + 1
+
+
+class HandlerNames(BaseMiddleware):
+    """Запоминает, какой обработчик выбран для обновления"""
+
+    def __init__(self):
+        super().__init__()
+        self.names = {}
+
+    def _remember(self):
+        from aiogram import types
+
+        self.names[
+            types.Update.get_current().update_id
+        ] = current_handler.get().__name__
+
+    async def on_process_message(self, message, data):
+        self._remember()
+
+    async def on_process_callback_query(self, call, data):
+        self._remember()
+
+
+class Stream:
+    """Обновления одного пользователя"""
+
+    ids = iter(range(1, 10**9))
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.message_id = 0
+
+    def message(self, text):
+        from aiogram import types
+
+        self.message_id += 1
+        return types.Update.to_object(
+            {
+                "update_id": next(self.ids),
+                "message": {
+                    "message_id": self.message_id,
+                    "date": int(time()),
+                    "chat": {"id": self.user_id, "type": "private"},
+                    "from": {
+                        "id": self.user_id,
+                        "is_bot": False,
+                        "first_name": "Bench",
+                    },
+                    "text": text,
+                },
+            }
+        )
+
+
+def userScenario(user_id, rounds):
+    stream = Stream(user_id)
+    for i in range(rounds):
+        yield stream.message("/start")
+        yield stream.message("Записать шутку")
+        yield stream.message(f"Шутка {i} пользователя {user_id}")
+        yield stream.message("Bench")
+        yield stream.message("Шутку пользователей бота")
+        yield stream.message("Мои шутки")
+    yield stream.message("Удалить мои Шутки")
+    yield stream.message("Подтверждаю")
+
+
+def adminScenario(rounds):
+    stream = Stream(ADMIN_ID)
+    for i in range(rounds):
+        yield stream.message("/start_adm")
+        yield stream.message("Добавить админа")
+        yield stream.message(f"bench{i}")
+        yield stream.message(str(-ADMIN_ID + i + 1))
+        yield stream.message("Список админов")
+        yield stream.message("Удалить админа")
+        yield stream.message(str(-ADMIN_ID + i + 1))
+
+
+async def replay(dp, names, scenario, timings):
+    for update in scenario:
+        start = perf_counter()
+        # Как в Dispatcher: каждое обновление в своей задаче (и контексте)
+        await create_task(dp.process_update(update))
+        elapsed = perf_counter() - start
+        timings[names.names.pop(update.update_id, "unhandled")].append(elapsed)
+
+
+async def level(dp, names, users, rounds):
+    timings = defaultdict(list)
+    start = perf_counter()
+    await gather(
+        replay(dp, names, adminScenario(rounds), timings),
+        *[
+            replay(dp, names, userScenario(BASE_USER_ID - 1 - i, rounds), timings)
+            for i in range(users)
+        ],
+    )
+    elapsed = perf_counter() - start
+    handlers = {}
+    for name, values in sorted(timings.items()):
+        q = quantiles(values, n=100) if len(values) > 1 else values * 99
+        handlers[name] = {
+            "count": len(values),
+            "throughput": len(values) / elapsed,
+            "p50": q[49],
+            "p95": q[94],
+            "p99": q[98],
+        }
+    total = sum(len(values) for values in timings.values())
+    return {"throughput": total / elapsed, "handlers": handlers}
+
+
+def report(results, baseline, tolerance):
+    """Печать результатов, возвращает число регрессий"""
+    regressions = 0
+    for key, result in results.items():
+        base = baseline.get(key)
+        line = f"{key}: {result['throughput']:8.1f} updates/s"
+        if base:
+            line += f" ({result['throughput'] / base['throughput'] - 1:+.0%})"
+            if result["throughput"] < base["throughput"] * (1 - tolerance):
+                line += "  REGRESSION"
+                regressions += 1
+        print(line)
+        for name, stats in result["handlers"].items():
+            line = (
+                f"  {name:<20} {stats['count']:6d}  p50 {stats['p50'] * 1000:7.1f}"
+                f"  p95 {stats['p95'] * 1000:7.1f}  p99 {stats['p99'] * 1000:7.1f} ms"
+            )
+            old = base and base["handlers"].get(name)
+            if old:
+                line += f"  p95 {stats['p95'] / old['p95'] - 1:+.0%}"
+                if stats["p95"] > old["p95"] * (1 + tolerance):
+                    line += "  REGRESSION"
+                    regressions += 1
+            print(line)
+    return regressions
+
+
+async def bench(args):
+    telegram = FakeTelegram(port=args.telegram_port)
+    await telegram.start()
+    environ.update(
+        TOKEN="123456:" + "A" * 35,
+        TELEGRAM_API_URL=telegram.url,
+        ID_ADMIN=str(ADMIN_ID),
+    )
+    from aiogram import Bot, Dispatcher
+    import main as _  # noqa: F401 регистрация обработчиков
+    from create_bot import adm_sql, dp
+
+    Dispatcher.set_current(dp)
+    Bot.set_current(dp.bot)
+    names = HandlerNames()
+    dp.middleware.setup(names)
+    await adm_sql.loadAdmins()
+    results = {}
+    try:
+        for users in args.users:
+            results[f"users={users}"] = await level(dp, names, users, args.rounds)
+    finally:
+        # Сначала сбросить отложенную запись состояний FSM, потом удалять
+        await dp.storage.close()
+        await cleanup(adm_sql, max(args.users) + 1)
+        await (await dp.bot.get_session()).close()
+        await telegram.stop()
+    return results
+
+
+async def cleanup(database, users):
+    def delete(cursor):
+        ids = [BASE_USER_ID - i for i in range(users + 1)] + [ADMIN_ID]
+        for table in ("newJokes", "jokes"):
+            cursor.execute(
+                f"""DELETE FROM {table} WHERE user_id IN
+                    (SELECT id FROM users WHERE user_id = ANY(%s))""",
+                (ids,),
+            )
+        cursor.execute("DELETE FROM users WHERE user_id = ANY(%s)", (ids,))
+        cursor.execute("DELETE FROM admins WHERE inviting = %s", (ADMIN_ID,))
+        cursor.execute("DELETE FROM fsm_states WHERE chat_id = ANY(%s)", (ids,))
+
+    await database._run(delete)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--baseline", help="JSON с базовыми результатами")
+    parser.add_argument("--save", help="сохранить результаты как базовые")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(bench(args))
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = load(file)
+    regressions = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, "w") as file:
+            dump(results, file, indent=2)
+    if regressions:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Пропускная способность базы при параллельных обновлениях
+
+Запускает несколько сценариев "записать шутку -> посчитать шутки ->
+случайная шутка" одновременно и сравнивает блокирующий режим
+(POSTGRES_EXECUTOR_THREADS=0) с выполнением запросов в пуле потоков.
+Параллельно измеряется максимальная задержка цикла событий.
+
+Запускать на тестовой базе: python -m benchmarks.db_concurrency
+"""
+from argparse import ArgumentParser
+from asyncio import gather, run, sleep
+from os import environ
+from time import perf_counter
+from scripts import JokesDatabase, NotificationsDatabase
+from scripts.sql_data import PostDatabase
+
+BASE_USER_ID = -(10**12)
+
+
+async def loop_lag(stop):
+    """Максимальная задержка цикла событий"""
+    worst = 0.0
+    while not stop:
+        start = perf_counter()
+        await sleep(0.001)
+        worst = max(worst, perf_counter() - start - 0.001)
+    return worst
+
+
+async def chat(jokes, user_id, updates):
+    for i in range(updates):
+        await jokes.recordJoke(f"bench {user_id} {i}", "bench", user_id)
+        await jokes.quantityJokesUser(user_id)
+        await jokes.randomJoke()
+
+
+async def measure(users, updates):
+    jokes = JokesDatabase("jokes")
+    NotificationsDatabase("jokes")
+    stop = []
+    lag = loop_lag(stop)
+    start = perf_counter()
+
+    async def work():
+        await gather(*[chat(jokes, BASE_USER_ID - i, updates) for i in range(users)])
+        stop.append(True)
+
+    _, worst = await gather(work(), lag)
+    elapsed = perf_counter() - start
+
+    def cleanup(cursor):
+        ids = [BASE_USER_ID - i for i in range(users)]
+        cursor.execute(
+            "DELETE FROM newJokes WHERE user_id IN "
+            "(SELECT id FROM users WHERE user_id = ANY(%s))",
+            (ids,),
+        )
+        cursor.execute(
+            "DELETE FROM jokes WHERE user_id IN "
+            "(SELECT id FROM users WHERE user_id = ANY(%s))",
+            (ids,),
+        )
+        cursor.execute("DELETE FROM users WHERE user_id = ANY(%s)", (ids,))
+
+    await jokes._run(cleanup)
+    jokes._user_ids.clear()
+    return users * updates / elapsed, worst
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=10)
+    args = parser.parse_args()
+
+    for title, threads in (("blocking", 0), ("executor", args.threads)):
+        environ["POSTGRES_EXECUTOR_THREADS"] = str(threads)
+        environ["POSTGRES_POOL_MAX"] = str(args.threads)
+        PostDatabase.closePool()
+        rate, worst = run(measure(args.users, args.updates))
+        print(f"{title:>8}: {rate:8.1f} updates/s, max loop lag {worst * 1000:7.1f} ms")
+    PostDatabase.closePool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Поиск почти одинаковых шуток на 10k/100k/1M шуток
+
+Для каждого размера заполняет MinHashIndex подписями (реальными для
+--texts синтетических шуток, остальные - случайные байты, как у
+несвязанных текстов) и измеряет p50/p99 времени find() для копии шутки
+с одним заменённым словом. Отдельно печатает время подсчёта подписи,
+долю найденных почти-дубликатов и долю ложных срабатываний на
+случайных шутках.
+
+Запуск: python -m benchmarks.dedup
+"""
+from argparse import ArgumentParser
+from os import urandom
+from random import Random
+from statistics import quantiles
+from time import perf_counter
+from scripts.dedup import MinHashIndex, minhash
+
+SIZES = (10_000, 100_000, 1_000_000)
+
+
+def texts(count, random, vocabulary=5000):
+    for _ in range(count):
+        yield [
+            f"слово{random.randrange(vocabulary)}"
+            for _ in range(random.randint(15, 40))
+        ]
+
+
+def edited(words, random):
+    words = list(words)
+    words[random.randrange(len(words))] = "замена"
+    return " ".join(words)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--texts", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    random = Random(1)
+    corpus = list(texts(args.texts, random))
+    start = perf_counter()
+    signatures = [minhash(" ".join(words)) for words in corpus]
+    print(f"minhash: {(perf_counter() - start) / len(corpus) * 1e6:.0f} us")
+
+    print(
+        f"{'jokes':>10} {'find p50, us':>13} {'p99, us':>8} {'recall':>7} {'false':>6}"
+    )
+    for size in SIZES:
+        index = MinHashIndex()
+        for id, signature in enumerate(signatures):
+            index.add(id, signature)
+        size_bytes = len(signatures[0])
+        for id in range(len(signatures), size):
+            index.add(id, urandom(size_bytes))
+
+        queries = [
+            (id, minhash(edited(corpus[id], random)))
+            for id in (random.randrange(len(corpus)) for _ in range(args.queries))
+        ]
+        timings, found = [], 0
+        for id, signature in queries:
+            start = perf_counter()
+            result = index.find(signature)
+            timings.append(perf_counter() - start)
+            found += id in result
+        unrelated = [minhash(" ".join(words)) for words in texts(args.queries, random)]
+        false = sum(bool(index.find(signature)) for signature in unrelated)
+        q = quantiles(timings, n=100)
+        print(
+            f"{size:>10} {q[49] * 1e6:>13.1f} {q[98] * 1e6:>8.1f}"
+            f" {found / len(queries):>7.1%} {false / len(unrelated):>6.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Локальная заглушка Bot API Telegram
+
+Отвечает успехом на любой метод и запоминает отправленные сообщения,
+чтобы нагрузочные тесты могли считать ответы бота. Бот направляется
+сюда переменной TELEGRAM_API_URL.
+"""
+from asyncio import Event
+from itertools import count
+from time import perf_counter, time
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Joker", "username": "joker_bot"}
+
+
+class FakeTelegram:
+    """Заглушка Bot API на aiohttp"""
+
+    def __init__(self, host="127.0.0.1", port=8081):
+        self.host = host
+        self.port = port
+        self.sent = []
+        self._expected = None
+        self._done = Event()
+        self._message_ids = count(1)
+        self._runner = None
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._app = app
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._runner = web.AppRunner(self._app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def expect(self, messages):
+        """Ожидание messages отправленных сообщений через wait()"""
+        self.sent = []
+        self._expected = messages
+        self._done.clear()
+
+    async def wait(self):
+        await self._done.wait()
+
+    async def _handle(self, request):
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+        if method == "getme":
+            return web.json_response({"ok": True, "result": BOT_USER})
+        if method not in ("sendmessage", "editmessagetext"):
+            return web.json_response({"ok": True, "result": True})
+        chat_id = int(params.get("chat_id", 0))
+        message = {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+        if method == "sendmessage":
+            self.sent.append(
+                (perf_counter(), chat_id, int(params.get("reply_to_message_id", 0)))
+            )
+            if self._expected is not None and len(self.sent) >= self._expected:
+                self._done.set()
+        return web.json_response({"ok": True, "result": message})
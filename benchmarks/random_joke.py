@@ -0,0 +1,94 @@
+"""Выборка случайной шутки на 10k/1M/10M шуток
+
+Для каждого размера измеряет время IdSampler.choice() и проверяет
+равномерность выборки критерием хи-квадрат по 100 корзинам. С флагом
+--database дополнительно сравнивает на временной таблице Postgres
+"ORDER BY RANDOM() LIMIT 1" с поиском по первичному ключу.
+
+Запуск: python -m benchmarks.random_joke [--database]
+"""
+from argparse import ArgumentParser
+from asyncio import run
+from random import randrange
+from time import perf_counter
+from scripts.sampler import IdSampler
+
+SIZES = (10_000, 1_000_000, 10_000_000)
+BUCKETS = 100
+
+
+def bench_sampler(size, draws):
+    sampler = IdSampler()
+    sampler.merge(range(1, size + 1), size)
+    # Каждый десятый id удалён, как после удаления шуток пользователями
+    for id in range(10, size + 1, 10):
+        sampler.discard(id)
+
+    start = perf_counter()
+    counts = [0] * BUCKETS
+    for _ in range(draws):
+        counts[sampler.choice() * BUCKETS // (size + 1)] += 1
+    elapsed = perf_counter() - start
+
+    expected = draws / BUCKETS
+    chi2 = sum((count - expected) ** 2 / expected for count in counts)
+    return elapsed / draws, chi2
+
+
+async def bench_database(size, draws):
+    from scripts import JokesDatabase
+
+    jokes = JokesDatabase("jokes")
+
+    def measure(cursor):
+        cursor.execute(
+            """CREATE TEMP TABLE bench_jokes AS
+               SELECT id, md5(id::text) AS joke, 'bench' AS author
+               FROM generate_series(1, %s) AS id""",
+            (size,),
+        )
+        cursor.execute("ALTER TABLE bench_jokes ADD PRIMARY KEY (id)")
+        cursor.execute("ANALYZE bench_jokes")
+        start = perf_counter()
+        for _ in range(draws):
+            cursor.execute(
+                "SELECT joke, author FROM bench_jokes ORDER BY RANDOM() LIMIT 1"
+            )
+            cursor.fetchone()
+        sort = (perf_counter() - start) / draws
+        start = perf_counter()
+        for _ in range(draws):
+            cursor.execute(
+                "SELECT joke, author FROM bench_jokes WHERE id = %s",
+                (randrange(1, size + 1),),
+            )
+            cursor.fetchone()
+        lookup = (perf_counter() - start) / draws
+        cursor.execute("DROP TABLE bench_jokes")
+        return sort, lookup
+
+    return await jokes._run(measure)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--draws", type=int, default=200_000)
+    parser.add_argument("--database", action="store_true")
+    parser.add_argument("--database-draws", type=int, default=20)
+    args = parser.parse_args()
+
+    # Критическое значение хи-квадрат для 99 степеней свободы, p = 0.01
+    print(f"{'jokes':>10} {'choice, us':>11} {'chi2 (<134.6)':>14}")
+    for size in SIZES:
+        per_draw, chi2 = bench_sampler(size, args.draws)
+        print(f"{size:>10} {per_draw * 1e6:>11.2f} {chi2:>14.1f}")
+
+    if args.database:
+        print(f"\n{'jokes':>10} {'ORDER BY RANDOM(), ms':>22} {'by id, ms':>10}")
+        for size in SIZES:
+            sort, lookup = run(bench_database(size, args.database_draws))
+            print(f"{size:>10} {sort * 1000:>22.2f} {lookup * 1000:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Время запуска бота
+
+В отдельном интерпретаторе импортирует create_bot (как main.py перед
+start_polling) и выполняет первый запрос к бд. Печатает медианное
+время импорта, первого запроса и число открытых соединений с Postgres.
+
+Запускать на тестовой базе: python -m benchmarks.startup
+"""
+from argparse import ArgumentParser
+from json import loads
+from os import environ
+from statistics import median
+from subprocess import check_output
+from sys import executable
+
+CHILD = """
+from json import dumps
+from time import perf_counter
+import psycopg2
+
+connects = []
+connect = psycopg2.connect
+def counting(*args, **kwargs):
+    connects.append(perf_counter())
+    return connect(*args, **kwargs)
+psycopg2.connect = counting
+
+start = perf_counter()
+import create_bot
+imported = perf_counter()
+import_connects = len(connects)
+
+from asyncio import run
+run(create_bot.jokes.quantityJokesUser(0))
+queried = perf_counter()
+print(dumps({
+    "import": imported - start,
+    "first_query": queried - imported,
+    "import_connects": import_connects,
+    "connects": len(connects),
+}))
+"""
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    env = dict(environ, TOKEN="123456:" + "A" * 35, FSM_STORAGE="postgres")
+    runs = [
+        loads(check_output([executable, "-c", CHILD], env=env).splitlines()[-1])
+        for _ in range(args.runs)
+    ]
+    print(f"import create_bot: {median(r['import'] for r in runs) * 1000:7.1f} ms")
+    print(f"first query:       {median(r['first_query'] for r in runs) * 1000:7.1f} ms")
+    print(f"connects at import: {runs[-1]['import_connects']}")
+    print(f"connects total:     {runs[-1]['connects']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Нагрузочный тест вебхука на локальной заглушке Telegram
+
+Запускает webhook.py с разным числом процессов, отправляет ему
+обновления от многих чатов параллельно (как Telegram с
+max_connections) и ждёт ответа бота на каждое. Печатает пропускную
+способность, задержку ответа и проверяет, что сообщения каждого чата
+обработаны по порядку.
+
+Запускать на тестовой базе: python -m benchmarks.webhook_load
+"""
+from argparse import ArgumentParser
+from asyncio import Semaphore, gather, run, sleep, wait_for
+from os import environ
+from statistics import quantiles
+from subprocess import Popen
+from sys import executable
+from time import perf_counter, time
+from aiohttp import ClientError, ClientSession
+from benchmarks.fake_telegram import FakeTelegram
+from scripts import Database
+
+BASE_USER_ID = -(10**12)
+
+
+def makeUpdate(update_id, chat, message_id, text):
+    user = {"id": chat, "is_bot": False, "first_name": "Bench"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id,
+            "date": int(time()),
+            "chat": {"id": chat, "type": "private"},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+async def waitServer(url, process):
+    """Ожидание запуска aiohttp-сервера вебхука"""
+    async with ClientSession() as session:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError("webhook.py завершился при запуске")
+            try:
+                async with session.get(url):
+                    return
+            except ClientError:
+                await sleep(0.2)
+
+
+async def measure(telegram, url, chats, updates, connections):
+    # По сообщению на обновление: /start -> answer, шутка -> reply
+    telegram.expect(chats * updates)
+    posted = {}
+    semaphore = Semaphore(connections)
+
+    async with ClientSession() as session:
+
+        async def post(update):
+            message = update["message"]
+            async with semaphore:
+                posted[message["chat"]["id"], message["message_id"]] = perf_counter()
+                async with session.post(url, json=update) as response:
+                    response.raise_for_status()
+
+        async def chat(i):
+            # Telegram присылает обновления одного чата друг за другом
+            for message_id in range(1, updates + 1):
+                text = "/start" if message_id == 1 else "Шутку пользователей бота"
+                await post(
+                    makeUpdate(
+                        i * updates + message_id, BASE_USER_ID - i, message_id, text
+                    )
+                )
+
+        start = perf_counter()
+        await gather(*[chat(i) for i in range(chats)])
+        await wait_for(telegram.wait(), 300)
+        elapsed = perf_counter() - start
+
+    latencies, ordered, last = [], True, {}
+    for at, chat, reply_to in telegram.sent:
+        if reply_to:
+            latencies.append(at - posted[chat, reply_to])
+            ordered &= reply_to > last.get(chat, 0)
+            last[chat] = reply_to
+    return chats * updates / elapsed, quantiles(latencies, n=100), ordered
+
+
+async def bench(args):
+    telegram = FakeTelegram(port=args.telegram_port)
+    await telegram.start()
+    url = f"http://127.0.0.1:{args.port}/webhook"
+    try:
+        for workers in args.workers:
+            env = dict(
+                environ,
+                TOKEN="123456:" + "A" * 35,
+                TELEGRAM_API_URL=telegram.url,
+                WEBHOOK_HOST="",
+                WEBHOOK_WORKERS=str(workers),
+                DISPATCH_CONCURRENCY=str(args.concurrency),
+                WEBAPP_HOST="127.0.0.1",
+                WEBAPP_PORT=str(args.port),
+            )
+            process = Popen([executable, "webhook.py"], env=env)
+            try:
+                await waitServer(f"http://127.0.0.1:{args.port}/", process)
+                rate, q, ordered = await measure(
+                    telegram, url, args.chats, args.updates, args.connections
+                )
+            finally:
+                process.terminate()
+                process.wait()
+            print(
+                f"{workers:>2} workers: {rate:8.1f} updates/s, "
+                f"p50 {q[49] * 1000:6.1f} ms, p99 {q[98] * 1000:6.1f} ms, "
+                f"{'order ok' if ordered else 'ORDER BROKEN'}"
+            )
+    finally:
+        await telegram.stop()
+
+    def cleanup(cursor):
+        cursor.execute(
+            "DELETE FROM users WHERE user_id <= %s AND user_id > %s",
+            (BASE_USER_ID, BASE_USER_ID - args.chats),
+        )
+
+    await Database("jokes")._run(cleanup)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=10)
+    parser.add_argument("--connections", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    run(bench(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
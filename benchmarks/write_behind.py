@@ -0,0 +1,78 @@
+"""Пропускная способность записи шуток с отложенной записью и без неё
+
+Несколько пользователей одновременно записывают шутки через recordJoke:
+сначала каждая шутка пишется своей транзакцией, затем через буфер
+отложенной записи, который собирает шутки всех пользователей в пачки.
+Печатает шутки в секунду, p50/p99 времени ответа recordJoke и средний
+размер пачки.
+
+Запускать на тестовой базе: python -m benchmarks.write_behind
+"""
+from argparse import ArgumentParser
+from asyncio import gather, run
+from statistics import quantiles
+from time import perf_counter
+from scripts import JokesDatabase
+from scripts.sql_data import PostDatabase
+
+BASE_USER_ID = -(10**12)
+
+
+async def writer(jokes, user_id, count, timings):
+    for i in range(count):
+        start = perf_counter()
+        await jokes.recordJoke(f"bench {user_id} {i}", "bench", user_id)
+        timings.append(perf_counter() - start)
+
+
+async def measure(users, count, size, interval):
+    jokes = JokesDatabase("jokes")
+    ids = [BASE_USER_ID - i for i in range(users)]
+    for user_id in ids:
+        await jokes.rowid(user_id)
+    if size:
+        jokes.startWriteBehind(size, interval)
+    writer_stats = jokes._writer
+    timings = []
+    start = perf_counter()
+    await gather(*[writer(jokes, user_id, count, timings) for user_id in ids])
+    await jokes.stopWriteBehind()
+    elapsed = perf_counter() - start
+
+    def cleanup(cursor):
+        rows = "(SELECT id FROM users WHERE user_id = ANY(%s))"
+        cursor.execute(f"DELETE FROM newJokes WHERE user_id IN {rows}", (ids,))
+        cursor.execute(f"DELETE FROM jokes WHERE user_id IN {rows}", (ids,))
+        cursor.execute("DELETE FROM users WHERE user_id = ANY(%s)", (ids,))
+
+    await jokes._run(cleanup)
+    jokes._user_ids.clear()
+    jokes.invalidateJokeCounts()
+    batch = (
+        writer_stats.written / writer_stats.flushes if writer_stats is not None else 1
+    )
+    return users * count / elapsed, quantiles(timings, n=100), batch
+
+
+async def compare(args):
+    print(f"{'mode':>13} {'jokes/s':>8} {'p50, ms':>8} {'p99, ms':>8} {'batch':>6}")
+    for title, size in (("sync", 0), ("write-behind", args.size)):
+        rate, q, batch = await measure(args.users, args.jokes, size, args.interval)
+        print(
+            f"{title:>13} {rate:8.0f} {q[49] * 1000:8.1f} {q[98] * 1000:8.1f} {batch:6.1f}"
+        )
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--jokes", type=int, default=20)
+    parser.add_argument("--size", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=0.2)
+    args = parser.parse_args()
+    run(compare(args))
+    PostDatabase.closePool()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,5 @@
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from aiogram import Bot
-from aiogram.dispatcher import Dispatcher
+from aiogram.bot.api import TelegramAPIServer
 from logging import basicConfig, INFO
 from scripts import (
     Database,
@@ -9,6 +8,11 @@ from scripts import (
     NotificationsDatabase,
     JokesDatabase,
 )
+from scripts.listener import PgListener
+from scripts.fsm_storage import PostgresStorage
+from scripts.scheduler import ChatDispatcher
+from scripts.throttling import ThrottlingMiddleware
+from scripts.metrics import Gauge, HandlerTimer, TimedBot, registry
 from os import getenv
 from dotenv import load_dotenv
 
@@ -19,7 +23,54 @@ sql = Database("jokes")
 adm_sql = AdminDatabase("jokes")
 notific = NotificationsDatabase("jokes")
 jokes = JokesDatabase("jokes")
+listener = PgListener("jokes")
+listener.subscribe("admins", adm_sql.invalidateAdmins)
+listener.subscribe("jokes_counts", jokes.invalidateJokeCounts)
+listener.subscribe("joke_ids", jokes.invalidateJokeIds)
 
-bot = Bot(token=getenv("TOKEN"))
-dp = Dispatcher(bot, storage=MemoryStorage())
+bot = TimedBot(
+    token=getenv("TOKEN"),
+    server=TelegramAPIServer.from_base(
+        getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+    ),
+)
+if getenv("FSM_STORAGE", "postgres") == "memory":
+    storage = MemoryStorage()
+else:
+    storage = PostgresStorage("jokes", ttl=int(getenv("FSM_STATE_TTL", 86400)))
+dp = ChatDispatcher(
+    bot,
+    storage=storage,
+    concurrency=int(getenv("DISPATCH_CONCURRENCY", 64)),
+    chat_queue=int(getenv("DISPATCH_CHAT_QUEUE", 100)),
+    pending=int(getenv("DISPATCH_PENDING", 10000)),
+)
+# Сверх лимита обработчик не вызывается, и его время не замеряется
+dp.middleware.setup(
+    ThrottlingMiddleware(
+        idle=int(getenv("THROTTLE_IDLE", 600)),
+        evict_interval=int(getenv("THROTTLE_EVICT_INTERVAL", 60)),
+    )
+)
+dp.middleware.setup(HandlerTimer())
+registry.register(
+    Gauge(
+        "bot_db_pool_connections",
+        "Соединения пула Postgres",
+        lambda: {
+            (key,): value
+            for key, value in sql.poolStats().items()
+            if key in ("size", "idle", "in_use", "waiting")
+        },
+        ("state",),
+    )
+)
+registry.register(
+    Gauge(
+        "bot_dispatch_queue",
+        "Очереди обновлений по чатам",
+        lambda: {(key,): value for key, value in dp.scheduler.stats().items()},
+        ("stat",),
+    )
+)
 basicConfig(level=INFO)
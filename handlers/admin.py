@@ -3,9 +3,14 @@ from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.utils.exceptions import BadRequest
+from tempfile import TemporaryFile
+from time import monotonic
 from create_bot import adm_sql
-from os import getenv, remove
+from os import getenv
 from keyboards import kb_admin, kb_aon, kb_record
+from scripts.metrics import summary
+
+ID_ADMIN = int(getenv("ID_ADMIN", 0))
 
 
 class AdminDelete(StatesGroup):
@@ -13,6 +18,14 @@ class AdminDelete(StatesGroup):
     aon = State()
 
 
+class AdminDedupe(StatesGroup):
+    aon = State()
+
+
+class AdminImport(StatesGroup):
+    document = State()
+
+
 class AddAdmin(StatesGroup):
     inviting = State()
     name = State()
@@ -37,14 +50,14 @@ class IsAdmin:
         self.__user_id = user_id
 
     async def is_admin(self):
-        if int(getenv("ID_ADMIN")) == self.user_id or await adm_sql.adminExists(self.user_id):
+        if ID_ADMIN == self.user_id or await adm_sql.adminExists(self.user_id):
             return True
         else:
             return False
 
     async def prv_is_admin(self, chat_type):
         if chat_type == "private":
-            if int(getenv("ID_ADMIN")) == self.user_id or await adm_sql.adminExists(self.user_id):
+            if ID_ADMIN == self.user_id or await adm_sql.adminExists(self.user_id):
                 return True
             else:
                 return False
@@ -71,6 +84,84 @@ async def res_clear_database(message: types.Message, state: FSMContext):
     await message.answer("🗑 Была произведена очистка 🗑", reply_markup=kb_admin)
 
 
+async def step_dedupe_jokes(message: types.Message, state: FSMContext):
+    if await IsAdmin(message.from_user.id).prv_is_admin(message.chat.type):
+        await message.answer(
+            "Удалить повторы и почти одинаковые шутки ? Останется самая ранняя",
+            reply_markup=kb_aon,
+        )
+        await AdminDedupe.aon.set()
+
+
+async def res_dedupe_jokes(message: types.Message, state: FSMContext):
+    await state.finish()
+    msg = await message.answer("Ищу дубликаты")
+    removed = await adm_sql.dedupeJokes()
+    await msg.delete()
+    await message.answer(
+        f"🗑 Удалено повторов: {removed['exact']}, "
+        f"почти одинаковых: {removed['near']} 🗑",
+        reply_markup=kb_admin,
+    )
+
+
+async def step_import_jokes(message: types.Message, state: FSMContext):
+    if await IsAdmin(message.from_user.id).prv_is_admin(message.chat.type):
+        await message.answer(
+            "Пришлите файл с шутками: txt (через пустую строку), "
+            "csv (колонки joke, author), json или jsonl.\n"
+            "Новые шутки не рассылаются, для рассылки подпишите файл словом "
+            "«рассылка»",
+            reply_markup=kb_record,
+        )
+        await AdminImport.document.set()
+
+
+def import_report(progress, done=False):
+    text = (
+        f"{'Готово' if done else 'Загружаю'}: прочитано {progress['read']}, "
+        f"добавлено {progress['added']}, повторов {progress['duplicates']}, "
+        f"с ошибками {progress['invalid']}"
+    )
+    if done and progress["errors"]:
+        text += "\n\n" + "\n".join(
+            f"{number}: {error}" for number, error in progress["errors"]
+        )
+    return text
+
+
+async def res_import_jokes(message: types.Message, state: FSMContext):
+    name = message.document.file_name or ""
+    kind = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+    broadcast = "рассылка" in (message.caption or "").lower()
+    await state.finish()
+    status = await message.answer("Скачиваю файл")
+    progress = {"read": 0, "added": 0, "duplicates": 0, "invalid": 0, "errors": []}
+    with TemporaryFile() as file:
+        try:
+            await message.document.download(destination_file=file, timeout=120)
+            file.seek(0)
+            shown = monotonic()
+            async for progress in adm_sql.importJokes(
+                file, kind, message.from_user.id, message.from_user.full_name, broadcast
+            ):
+                # Telegram не любит частое редактирование одного сообщения
+                if monotonic() - shown > 3:
+                    shown = monotonic()
+                    await status.edit_text(import_report(progress))
+        except ValueError as e:
+            await message.answer(
+                f"{import_report(progress, True)}\n\nИмпорт прерван: {e}",
+                reply_markup=kb_admin,
+            )
+            return
+        except BadRequest as e:
+            await message.answer(f"Не удалось скачать файл: {e}", reply_markup=kb_admin)
+            return
+    await status.delete()
+    await message.answer(import_report(progress, True), reply_markup=kb_admin)
+
+
 async def step_add_admin(message: types.Message, state: FSMContext):
     if await IsAdmin(message.from_user.id).prv_is_admin(message.chat.type):
         await AddAdmin.inviting.set()
@@ -134,32 +225,18 @@ async def res_del_admin(message: types.Message, state: FSMContext):
 
 async def sql_damp(message: types.Message):
     if await IsAdmin(message.from_user.id).prv_is_admin(message.chat.type):
-        user_id = message.from_user.id
-        await adm_sql.dump(user_id)
+        archive = await adm_sql.dump()
         try:
-            file = open(f"sql\dump_users_{user_id}.sql", "rb")
-            await message.answer_document(file, caption="sql dump users")
-        except BadRequest:
-            await message.answer(
-                "Пока что дамп бд users не возможен", reply_markup=kb_admin
+            await message.answer_document(
+                types.InputFile(
+                    archive, filename=f"dump_{message.date:%Y%m%d_%H%M%S}.sql.gz"
+                ),
+                caption="sql dump users, jokes, admins",
             )
-        try:
-            file = open(f"sql\dump_jokes_{user_id}.sql", "rb")
-            await message.answer_document(file, caption="sql dump jokes")
         except BadRequest:
-            await message.answer(
-                "Пока что дамп бд jokes не возможен", reply_markup=kb_admin
-            )
-        try:
-            file = open(f"sql\dump_admins_{user_id}.sql", "rb")
-            await message.answer_document(file, caption="sql dump admins")
-        except BadRequest:
-            await message.answer(
-                "Пока что дамп бд admins не возможен", reply_markup=kb_admin
-            )
-        remove(f"sql\dump_users_{user_id}.sql")
-        remove(f"sql\dump_jokes_{user_id}.sql")
-        remove(f"sql\dump_admins_{user_id}.sql")
+            await message.answer("Пока что дамп бд не возможен", reply_markup=kb_admin)
+        finally:
+            archive.close()
 
 
 async def all_admins(message: types.Message):
@@ -167,6 +244,17 @@ async def all_admins(message: types.Message):
         await message.answer(await adm_sql.allAdmins())
 
 
+async def stats(message: types.Message):
+    if await IsAdmin(message.from_user.id).prv_is_admin(message.chat.type):
+        pool = adm_sql.poolStats()
+        queue = Dispatcher.get_current().scheduler.stats()
+        await message.answer(
+            f"{summary()}\n"
+            f"Пул бд: {pool['in_use']}/{pool['size']} заняты, ждут {pool['waiting']}\n"
+            f"Очереди: {queue['pending']} обновлений в {queue['chats']} чатах"
+        )
+
+
 def register_handlers_admin(dp: Dispatcher):
     dp.register_message_handler(cmd_start_adm, commands="start_adm")
     dp.register_message_handler(
@@ -175,6 +263,20 @@ def register_handlers_admin(dp: Dispatcher):
     dp.register_message_handler(
         res_clear_database, Text(equals="Подтверждаю"), state=AdminDelete.aon
     )
+    dp.register_message_handler(
+        step_dedupe_jokes, Text(equals="Удалить дубликаты"), state="*"
+    )
+    dp.register_message_handler(
+        res_dedupe_jokes, Text(equals="Подтверждаю"), state=AdminDedupe.aon
+    )
+    dp.register_message_handler(
+        step_import_jokes, Text(equals="Импорт шуток"), state="*"
+    )
+    dp.register_message_handler(
+        res_import_jokes,
+        state=AdminImport.document,
+        content_types=types.ContentTypes.DOCUMENT,
+    )
     dp.register_message_handler(
         step_add_admin, Text(equals="Добавить админа"), state="*"
     )
@@ -192,3 +294,4 @@ def register_handlers_admin(dp: Dispatcher):
     )
     dp.register_message_handler(sql_damp, Text(equals="Дамп бд"))
     dp.register_message_handler(all_admins, Text(equals="Список админов"))
+    dp.register_message_handler(stats, commands="stats")
@@ -1,11 +1,27 @@
+from os import getenv
 from aiogram import Dispatcher, types
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from create_bot import sql, Anekdot, jokes
-from keyboards import kb_client, kb_record, kb_aon
+from scripts.dedup import DuplicateJoke
+from keyboards import (
+    kb_client,
+    kb_record,
+    kb_aon,
+    kb_my_jokes,
+    cb_my_jokes,
+    kb_search,
+    cb_search,
+)
+from scripts.throttling import throttled
 from .admin import IsAdmin
 
+# Частота запросов одного пользователя к тяжёлым обработчикам
+THROTTLE_RATE = float(getenv("THROTTLE_RATE", 1))
+THROTTLE_BURST = int(getenv("THROTTLE_BURST", 5))
+SEARCH_PAGE = 5
+
 
 class ClientRecord(StatesGroup):
     quantity = State()
@@ -24,17 +40,132 @@ async def cmd_start(message: types.Message):
     await message.answer("Что выбираете ?", reply_markup=kb_client)
 
 
+async def recent_bot_joke(message: types.Message):
+    """Ответ сверх лимита: недавно выбранная шутка, без запроса в бд"""
+    joke = jokes.recentJoke()
+    if joke is not None:
+        await message.reply(joke)
+        return True
+    return False
+
+
+@throttled(THROTTLE_RATE, THROTTLE_BURST, fallback=recent_bot_joke)
 async def random_bot_joke(message: types.Message):
     await message.reply(await jokes.randomJoke())
 
 
+async def cached_joke(message: types.Message):
+    """Ответ сверх лимита: анекдот из готовой очереди, без загрузки"""
+    joke = Anekdot.popAnekdot()
+    if joke is not None:
+        await message.answer(joke)
+        return True
+    return False
+
+
+@throttled(THROTTLE_RATE, THROTTLE_BURST, fallback=cached_joke)
 async def random_joke(message: types.Message):
+    joke = Anekdot.popAnekdot()
+    if joke is not None:
+        await message.answer(joke)
+        return
     msg = await message.answer("Загружаю")
     await msg.edit_text(await Anekdot.getAnekdot())
 
 
+@throttled(THROTTLE_RATE, THROTTLE_BURST)
 async def my_joke(message: types.Message):
-    await message.answer(await jokes.myJoke(message.from_user.id))
+    page = await jokes.myJokesPage(message.from_user.id)
+    if page is None:
+        await message.answer("Нету шуток 😞, но ты можешь записать свою шутку 😉")
+        return
+    await message.answer(page["text"], reply_markup=kb_my_jokes(page))
+
+
+@throttled(THROTTLE_RATE * 3, THROTTLE_BURST * 2)
+async def my_joke_page(call: types.CallbackQuery, callback_data: dict):
+    if callback_data["direction"] == "next":
+        page = await jokes.myJokesPage(
+            call.from_user.id, after=int(callback_data["id"])
+        )
+    else:
+        page = await jokes.myJokesPage(
+            call.from_user.id, before=int(callback_data["id"])
+        )
+    if page is None:
+        await call.answer("Больше шуток нет")
+        return
+    await call.message.edit_text(page["text"], reply_markup=kb_my_jokes(page))
+    await call.answer()
+
+
+def search_text(query, page, offset, size=4096):
+    """Текст страницы результатов поиска, не длиннее сообщения Telegram"""
+    if not page["jokes"]:
+        return f"🔎 {query}\n\nНичего не нашлось 😞"
+    lines = [f"🔎 {query}"]
+    for i, row in enumerate(page["jokes"], offset + 1):
+        lines.append(f'{i}. {row["joke"]} Автор: {row["author"]}')
+    text = "\n\n".join(lines)
+    return text if len(text) <= size else text[: size - 1] + "…"
+
+
+@throttled(THROTTLE_RATE, THROTTLE_BURST)
+async def search_jokes(message: types.Message, state: FSMContext):
+    query = " ".join(message.get_args().split())
+    if len(query) < 3:
+        await message.answer("Что ищем ? Например: /search кот")
+        return
+    # Запрос нужен для листания, в callback_data он не помещается
+    await state.update_data(search=query)
+    page = await jokes.searchJokes(query, limit=SEARCH_PAGE)
+    await message.answer(
+        search_text(query, page, 0),
+        reply_markup=kb_search(0, SEARCH_PAGE, page["next"]),
+    )
+
+
+@throttled(THROTTLE_RATE * 3, THROTTLE_BURST * 2)
+async def search_page(
+    call: types.CallbackQuery, callback_data: dict, state: FSMContext
+):
+    query = (await state.get_data()).get("search")
+    if query is None:
+        await call.answer("Повторите поиск: /search")
+        return
+    offset = int(callback_data["offset"])
+    page = await jokes.searchJokes(query, offset, limit=SEARCH_PAGE)
+    await call.message.edit_text(
+        search_text(query, page, offset),
+        reply_markup=kb_search(offset, SEARCH_PAGE, page["next"]),
+    )
+    await call.answer()
+
+
+@throttled(THROTTLE_RATE * 3, THROTTLE_BURST * 2)
+async def inline_search(inline_query: types.InlineQuery):
+    query = " ".join(inline_query.query.split())
+    if len(query) < 3:
+        await inline_query.answer([], cache_time=300)
+        return
+    offset = int(inline_query.offset or 0)
+    page = await jokes.searchJokes(query, offset, limit=20)
+    results = [
+        types.InlineQueryResultArticle(
+            id=str(row["id"]),
+            title=row["joke"][:100],
+            description=f'Автор: {row["author"]}',
+            input_message_content=types.InputTextMessageContent(
+                f'{row["joke"]} Автор: {row["author"]}'[:4096]
+            ),
+        )
+        for row in page["jokes"]
+    ]
+    await inline_query.answer(
+        results,
+        cache_time=60,
+        next_offset=str(offset + len(results)) if page["next"] else "",
+    )
 
 
 async def delet_step(message: types.Message, state: FSMContext):
@@ -74,12 +205,17 @@ async def author_step(message: types.Message, state: FSMContext):
 async def res_step(message: types.Message, state: FSMContext):
     await state.update_data(author=message.text)
     user_data = await state.get_data()
-    await jokes.recordJoke(user_data["joke"], user_data["author"], message.from_user.id)
-    await state.update_data(quantity = await jokes.quantityJokesUser(message.from_user.id))
-    user_data = await state.get_data()
-    await message.answer(
-        f"Записано {user_data['quantity']}/10", reply_markup=kb_client
-    )
+    try:
+        quantity = await jokes.recordJoke(
+            user_data["joke"], user_data["author"], message.from_user.id
+        )
+    except DuplicateJoke as e:
+        await message.answer(
+            "Такая шутка уже есть 🙂" if e.exact else "Очень похожая шутка уже есть 🙂",
+            reply_markup=kb_client,
+        )
+    else:
+        await message.answer(f"Записано {quantity}/10", reply_markup=kb_client)
     await state.finish()
 
 
@@ -91,6 +227,10 @@ def register_handlers_client(dp: Dispatcher):
     )
     dp.register_message_handler(random_joke, Text(equals="Шутку рандомную из инета"))
     dp.register_message_handler(my_joke, Text(equals="Мои шутки"))
+    dp.register_callback_query_handler(my_joke_page, cb_my_jokes.filter())
+    dp.register_message_handler(search_jokes, commands="search", state="*")
+    dp.register_callback_query_handler(search_page, cb_search.filter(), state="*")
+    dp.register_inline_handler(inline_search)
     dp.register_message_handler(delet_step, Text(equals="Удалить мои Шутки"), state="*")
     dp.register_message_handler(
         delete_res, Text(equals="Подтверждаю"), state=ClientDelete.aon
@@ -1,3 +1,9 @@
-from keyboards.client_kb import kb_client
+from keyboards.client_kb import (
+    kb_client,
+    kb_my_jokes,
+    cb_my_jokes,
+    kb_search,
+    cb_search,
+)
 from keyboards.admin_kb import kb_admin
 from keyboards.other_kb import kb_record, kb_aon
@@ -6,8 +6,11 @@ kb2 = KeyboardButton("Добавить админа")
 kb3 = KeyboardButton("Удалить админа")
 kb4 = KeyboardButton("Список админов")
 kb5 = KeyboardButton("В главное меню")
+kb6 = KeyboardButton("Удалить дубликаты")
+kb7 = KeyboardButton("Импорт шуток")
 
 
 kb_admin = ReplyKeyboardMarkup(resize_keyboard=True)
 
-kb_admin.add(kb0).insert(kb1).add(kb2).insert(kb3).add(kb4).add(kb5)
+kb_admin.add(kb0).insert(kb1).add(kb2).insert(kb3).add(kb4).insert(kb6)
+kb_admin.add(kb7).add(kb5)
@@ -1,4 +1,10 @@
-from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
+from aiogram.types import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    KeyboardButton,
+    ReplyKeyboardMarkup,
+)
+from aiogram.utils.callback_data import CallbackData
 
 kb0 = KeyboardButton("Записать шутку")
 kb1 = KeyboardButton("Шутку пользователей бота")
@@ -9,3 +15,44 @@ kb4 = KeyboardButton("Удалить мои Шутки")
 kb_client = ReplyKeyboardMarkup(resize_keyboard=True)
 
 kb_client.add(kb0).add(kb1).insert(kb2).add(kb3).insert(kb4)
+
+cb_my_jokes = CallbackData("myjokes", "direction", "id")
+
+
+def kb_my_jokes(page):
+    """Листание страниц "Мои шутки" """
+    kb = InlineKeyboardMarkup()
+    if page["prev"]:
+        kb.insert(
+            InlineKeyboardButton(
+                "◀️", callback_data=cb_my_jokes.new(direction="prev", id=page["first"])
+            )
+        )
+    if page["next"]:
+        kb.insert(
+            InlineKeyboardButton(
+                "▶️", callback_data=cb_my_jokes.new(direction="next", id=page["last"])
+            )
+        )
+    return kb
+
+
+cb_search = CallbackData("search", "offset")
+
+
+def kb_search(offset, limit, more):
+    """Листание результатов поиска"""
+    kb = InlineKeyboardMarkup()
+    if offset:
+        kb.insert(
+            InlineKeyboardButton(
+                "◀️", callback_data=cb_search.new(offset=max(offset - limit, 0))
+            )
+        )
+    if more:
+        kb.insert(
+            InlineKeyboardButton(
+                "▶️", callback_data=cb_search.new(offset=offset + limit)
+            )
+        )
+    return kb
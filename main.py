@@ -1,17 +1,53 @@
-from asyncio import new_event_loop, set_event_loop
+from asyncio import create_task, gather, new_event_loop, set_event_loop
 from logging import info
+from os import getenv
 
 from aiogram.utils.executor import start_polling
 
-from create_bot import dp
+from create_bot import dp, listener, adm_sql, jokes, Anekdot
 from handlers import admin, client, other
+from scripts.metrics import startServer
 from scripts.notifications import scheduled
 
+metrics = None
+backfill = None
+
 
 async def on_startup(_):
+    global metrics, backfill
+    await adm_sql.loadAdmins()
+    if getenv("METRICS_PORT"):
+        metrics = await startServer(
+            getenv("METRICS_HOST", "127.0.0.1"), int(getenv("METRICS_PORT"))
+        )
+    await listener.start()
+    await Anekdot.start()
+    if int(getenv("JOKES_WRITE_BEHIND_SIZE", 0)) > 0:
+        jokes.startWriteBehind(
+            int(getenv("JOKES_WRITE_BEHIND_SIZE")),
+            float(getenv("JOKES_WRITE_BEHIND_INTERVAL", 0.2)),
+        )
+    # Отпечатки старых шуток досчитываются в фоне, не на записи пользователя
+    backfill = create_task(jokes.backfillJokes())
     info("Бот вышел в онлайн")
 
 
+async def on_shutdown(_):
+    # Сначала доработать уже принятые обновления
+    dp.stop_polling()
+    await dp.drain()
+    await dp.scheduler.join()
+    info("Очереди обновлений: %s", dp.scheduler.stats())
+    if backfill is not None:
+        backfill.cancel()
+        await gather(backfill, return_exceptions=True)
+    await jokes.stopWriteBehind()
+    await Anekdot.stop()
+    await listener.stop()
+    if metrics is not None:
+        await metrics.cleanup()
+
+
 other.register_handlers_client(dp)
 client.register_handlers_client(dp)
 admin.register_handlers_admin(dp)
@@ -19,5 +55,5 @@ admin.register_handlers_admin(dp)
 if __name__ == "__main__":
     loop = new_event_loop()
     set_event_loop(loop)
-    loop.create_task(scheduled(60))
-    start_polling(dp, skip_updates=True, on_startup=on_startup)
+    loop.create_task(scheduled(int(getenv("NOTIFY_POLL_INTERVAL", 300))))
+    start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,203 @@
+from asyncio import FIRST_COMPLETED, Queue, create_task, gather, sleep, wait
+from collections import deque
+from logging import exception, info, warning
+from time import monotonic
+from aiogram.utils.exceptions import ChatNotFound, RetryAfter, Unauthorized
+from scripts.limiter import TokenBucket
+from scripts.metrics import broadcast_messages
+
+
+class Broadcaster:
+    """Рассылка сообщения всем пользователям бота
+
+    Получатели читаются пачками из одного запроса, а сообщения отправляют
+    concurrency задач под общим ограничителем rate сообщений в секунду.
+    RetryAfter приостанавливает всю рассылку на указанное Telegram время,
+    пользователи, заблокировавшие бота, помечаются в бд и больше не
+    получают рассылок. Любая другая ошибка отправки считается неудачной
+    отправкой этому пользователю и не останавливает рассылку.
+
+    Раз в checkpoint_interval секунд вызывается checkpoint(last_id), где
+    last_id - наибольший внутренний id, до которого включительно все
+    получатели уже обработаны. Рассылку можно продолжить с него через
+    after, повторно отправятся лишь сообщения последних секунд. Ошибка
+    checkpoint пишется в лог и повторяется со следующим интервалом; если
+    сохранить прогресс не удаётся дольше checkpoint_timeout секунд (за это
+    время истекает аренда, и рассылку может подхватить другой процесс),
+    рассылка прерывается с последней ошибкой. Рассылка, где граница
+    обработанных не сдвигается дольше stall_timeout секунд, прерывается
+    TimeoutError, чтобы не продлевать её аренду бесконечно.
+    """
+
+    def __init__(
+        self,
+        bot,
+        database,
+        rate=30,
+        concurrency=20,
+        batch=1000,
+        progress=10,
+        checkpoint_interval=1,
+        checkpoint_timeout=30,
+        stall_timeout=300,
+    ):
+        self._bot = bot
+        self._database = database
+        self._limiter = TokenBucket(rate)
+        self._concurrency = concurrency
+        self._batch = batch
+        self._progress = progress
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_timeout = checkpoint_timeout
+        self._stall_timeout = stall_timeout
+        self.stats = None
+
+    async def broadcast(self, text, exclude=None, after=0, checkpoint=None):
+        """Рассылка text всем, кроме пользователя с внутренним id exclude"""
+        stats = self.stats = {
+            "users": await self._database.quantityUsers(),
+            "sent": 0,
+            "blocked": 0,
+            "failed": 0,
+            "elapsed": 0.0,
+            "rate": 0.0,
+        }
+        started = monotonic()
+        queue = Queue(self._concurrency * 2)
+        blocked = []
+        # Получатели в порядке id: [id, отправлено], и граница обработанных
+        pending = deque()
+        progress = {"done": after}
+        workers = [
+            create_task(self._worker(queue, text, stats, blocked, pending, progress))
+            for _ in range(self._concurrency)
+        ]
+        tasks = [create_task(self._report(stats, started))]
+        sending = create_task(
+            self._produce(queue, workers, pending, blocked, exclude, after)
+        )
+        tasks.append(sending)
+        try:
+            if checkpoint is None:
+                await sending
+            else:
+                saving = create_task(self._checkpoint(checkpoint, progress))
+                tasks.append(saving)
+                await wait((sending, saving), return_when=FIRST_COMPLETED)
+                if saving.done():
+                    # Прогресс не сохраняется или не двигается
+                    sending.cancel()
+                    await gather(sending, return_exceptions=True)
+                    saving.result()
+                await sending
+        finally:
+            for task in workers + tasks:
+                task.cancel()
+        if blocked:
+            await self._flushBlocked(blocked)
+        if checkpoint is not None:
+            await checkpoint(progress["done"])
+        self._measure(stats, started)
+        info(
+            "Рассылка завершена: отправлено %d, заблокировали %d, ошибок %d "
+            "за %.1f с (%.1f сообщ./с)",
+            stats["sent"],
+            stats["blocked"],
+            stats["failed"],
+            stats["elapsed"],
+            stats["rate"],
+        )
+        return stats
+
+    async def _produce(self, queue, workers, pending, blocked, exclude, after):
+        recipients = self._database.recipients(exclude, self._batch, after)
+        try:
+            async for rows in recipients:
+                for row in rows:
+                    entry = [row["id"], False]
+                    pending.append(entry)
+                    await queue.put((row["user_id"], entry))
+                if blocked:
+                    await self._flushBlocked(blocked)
+        finally:
+            # Вернуть соединение в пул и при отмене рассылки
+            await recipients.aclose()
+        for _ in workers:
+            await queue.put(None)
+        await gather(*workers)
+
+    async def _flushBlocked(self, blocked):
+        user_ids = blocked[:]
+        blocked.clear()
+        await self._database.blockUsers(user_ids)
+
+    async def _worker(self, queue, text, stats, blocked, pending, progress):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            user_id, entry = item
+            try:
+                await self._send(user_id, text, stats, blocked)
+            finally:
+                entry[1] = True
+                while pending and pending[0][1]:
+                    progress["done"] = pending.popleft()[0]
+
+    async def _checkpoint(self, checkpoint, progress):
+        saved = moved = monotonic()
+        done = progress["done"]
+        while True:
+            await sleep(self._checkpoint_interval)
+            if progress["done"] != done:
+                done, moved = progress["done"], monotonic()
+            elif monotonic() - moved >= self._stall_timeout:
+                raise TimeoutError("Рассылка не продвигается после id %s" % done)
+            try:
+                await checkpoint(progress["done"])
+            except Exception:
+                if monotonic() - saved >= self._checkpoint_timeout:
+                    raise
+                exception("Рассылка: не удалось сохранить прогресс, повтор")
+            else:
+                saved = monotonic()
+
+    async def _send(self, user_id, text, stats, blocked):
+        while True:
+            await self._limiter.acquire()
+            try:
+                await self._bot.send_message(user_id, text)
+            except RetryAfter as e:
+                warning("Рассылка: флуд-контроль, пауза %d с", e.timeout)
+                self._limiter.pause(e.timeout)
+                continue
+            except (Unauthorized, ChatNotFound):
+                stats["blocked"] += 1
+                broadcast_messages.inc("blocked")
+                blocked.append(user_id)
+            except Exception as e:
+                # Не только TelegramAPIError: таймауты и ошибки сети тоже
+                stats["failed"] += 1
+                broadcast_messages.inc("failed")
+                warning("Рассылка: не удалось отправить %s: %s", user_id, e)
+            else:
+                stats["sent"] += 1
+                broadcast_messages.inc("sent")
+            return
+
+    @staticmethod
+    def _measure(stats, started):
+        stats["elapsed"] = monotonic() - started
+        done = stats["sent"] + stats["blocked"] + stats["failed"]
+        stats["rate"] = done / stats["elapsed"] if stats["elapsed"] else 0.0
+
+    async def _report(self, stats, started):
+        while True:
+            await sleep(self._progress)
+            self._measure(stats, started)
+            info(
+                "Рассылка: %d/%d, %.1f сообщ./с",
+                stats["sent"] + stats["blocked"] + stats["failed"],
+                stats["users"],
+                stats["rate"],
+            )
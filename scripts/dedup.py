@@ -0,0 +1,141 @@
+from hashlib import blake2b
+from re import compile as regex
+from struct import Struct
+
+_words = regex(r"\w+")
+PERMUTATIONS = 32
+BANDS = 8
+# Каждые 4 байта хеша blake2b - своя независимая хеш-функция для MinHash
+_half = Struct(">%dI" % (PERMUTATIONS // 2))
+_signature = Struct(">%dI" % PERMUTATIONS)
+# Полоса - 4 числа подписи, её ключ - XOR двух половин как BIGINT
+_band = Struct(">%dQ" % (PERMUTATIONS // 2))
+
+
+class DuplicateJoke(Exception):
+    """Такая же или почти такая же шутка уже записана"""
+
+    def __init__(self, joke_id, exact=True):
+        super().__init__(joke_id)
+        self.joke_id = joke_id
+        self.exact = exact
+
+
+def normalize(text):
+    """Текст без регистра, пунктуации и лишних пробелов, "ё" как "е" """
+    return " ".join(_words.findall(text.lower().replace("ё", "е").replace("_", " ")))
+
+
+def textHash(text):
+    """Хеш нормализованного текста для точного совпадения"""
+    return blake2b(normalize(text).encode(), digest_size=16).digest()
+
+
+def minhash(text):
+    """MinHash-подпись множества слов текста, PERMUTATIONS чисел в bytes
+
+    Для текстов короче MIN_WORDS слов возвращает None: у них оценка
+    сходства слишком грубая, такие шутки проверяются только на точное
+    совпадение.
+    """
+    words = set(normalize(text).split())
+    if len(words) < MinHashIndex.MIN_WORDS:
+        return None
+    columns = zip(
+        *(
+            _half.unpack(blake2b(word, digest_size=64).digest())
+            + _half.unpack(blake2b(word, digest_size=64, salt=b"minhash").digest())
+            for word in map(str.encode, words)
+        )
+    )
+    return _signature.pack(*map(min, columns))
+
+
+def similarity(first, second):
+    """Оценка коэффициента Жаккара по двум подписям"""
+    return (
+        sum(a == b for a, b in zip(_signature.unpack(first), _signature.unpack(second)))
+        / PERMUTATIONS
+    )
+
+
+def bands(signature):
+    """Ключи полос подписи для LSH, как minhash_bands() в бд"""
+    halves = _band.unpack(signature)
+    keys = []
+    for i in range(0, len(halves), 2):
+        key = halves[i] ^ halves[i + 1]
+        keys.append(key - (1 << 64) if key >= 1 << 63 else key)
+    return keys
+
+
+class MinHashIndex:
+    """Поиск почти одинаковых текстов по MinHash с LSH в памяти
+
+    Подпись режется на BANDS полос, и для каждой полосы словарь хранит id
+    текстов с таким же ключом полосы: сам id, а при совпадениях - кортеж.
+    Кандидаты - тексты, совпавшие хотя бы по одной полосе (при 8 полосах
+    по 4 числа это почти все тексты со сходством от 0.8 и редкие со
+    сходством ниже 0.5), из них остаются те, у кого оценка сходства не
+    ниже threshold.
+
+    Записанные шутки ищутся в бд по тем же полосам (jokes.minhash_bands),
+    индекс в памяти нужен для небольших наборов: шуток в буфере
+    отложенной записи, пачки импорта.
+    """
+
+    MIN_WORDS = 5
+
+    def __init__(self, threshold=0.8):
+        self.threshold = threshold
+        self._tables = [{} for _ in range(BANDS)]
+        self._signatures = {}
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def add(self, id, signature):
+        if signature is None:
+            return
+        self.discard(id)
+        self._signatures[id] = signature
+        for table, key in zip(self._tables, bands(signature)):
+            ids = table.get(key)
+            if ids is None:
+                table[key] = id
+            else:
+                table[key] = (ids if isinstance(ids, tuple) else (ids,)) + (id,)
+
+    def discard(self, id):
+        signature = self._signatures.pop(id, None)
+        if signature is None:
+            return
+        for table, key in zip(self._tables, bands(signature)):
+            ids = table[key]
+            if not isinstance(ids, tuple):
+                del table[key]
+            else:
+                ids = tuple(other for other in ids if other != id)
+                table[key] = ids if len(ids) > 1 else ids[0]
+
+    def find(self, signature):
+        """id похожих текстов по убыванию сходства"""
+        if signature is None:
+            return []
+        candidates = set()
+        for table, key in zip(self._tables, bands(signature)):
+            ids = table.get(key)
+            if isinstance(ids, tuple):
+                candidates.update(ids)
+            elif ids is not None:
+                candidates.add(ids)
+        scored = [
+            (similarity(signature, self._signatures[id]), id) for id in candidates
+        ]
+        return [
+            id for score, id in sorted(scored, reverse=True) if score >= self.threshold
+        ]
+
+    def reset(self):
+        self._tables = [{} for _ in self._tables]
+        self._signatures = {}
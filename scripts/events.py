@@ -0,0 +1,40 @@
+from asyncio import Event, TimeoutError, wait_for
+
+
+class Signal:
+    """Пробуждение задачи, ожидающей работы
+
+    Сигнал, поданный до начала ожидания, не теряется: следующий wait()
+    завершится сразу.
+    """
+
+    def __init__(self):
+        self._event = None
+        self._pending = False
+
+    def set(self, *args):
+        if self._event is None:
+            self._pending = True
+        else:
+            self._event.set()
+
+    async def wait(self, timeout=None):
+        """Ожидание сигнала не дольше timeout секунд, True - если он был"""
+        if self._event is None:
+            # Event создаётся внутри работающего цикла событий
+            self._event = Event()
+            if self._pending:
+                self._event.set()
+        if self._event.is_set():
+            self._event.clear()
+            return True
+        try:
+            await wait_for(self._event.wait(), timeout)
+        except TimeoutError:
+            return False
+        finally:
+            self._event.clear()
+        return True
+
+
+jokeAdded = Signal()
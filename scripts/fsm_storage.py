@@ -0,0 +1,186 @@
+from asyncio import create_task, gather, sleep
+from copy import deepcopy
+from logging import exception
+from time import monotonic
+from aiogram.dispatcher.storage import BaseStorage
+from psycopg2.extras import Json, execute_values
+from scripts.cache import LRUCache
+from scripts.sql_data import PostDatabase
+
+
+class PostgresStorage(BaseStorage, PostDatabase):
+    """Хранилище состояний FSM в Postgres
+
+    Состояния переживают перезапуск и доступны всем процессам бота.
+    Последние cache_size состояний держатся в памяти: чтение из кеша не
+    ходит в бд, а изменения сразу видны в кеше и пишутся в бд пачкой раз в
+    flush_interval секунд (и при остановке бота). Кеш предполагает, что
+    сообщения одного чата обрабатывает один процесс. Состояние, которое не
+    менялось дольше ttl секунд, считается брошенным и удаляется.
+    """
+
+    def __init__(self, database, ttl=86400, cache_size=10000, flush_interval=0.2):
+        PostDatabase.__init__(self, database)
+        self._ttl = ttl
+        self._cache = LRUCache(cache_size)
+        self._flush_interval = flush_interval
+        self._dirty = {}
+        self._flusher = None
+        self._expired_at = monotonic()
+
+    async def _record(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        key = (int(chat), int(user))
+        record = self._cache.get(key)
+        if record is not None and monotonic() - record["touched"] < self._ttl:
+            return key, record
+        row = await self._fetchone(
+            """SELECT state, data, bucket FROM fsm_states
+               WHERE chat_id = %s AND user_id = %s
+                   AND updated_at > now() - %s * interval '1 second'""",
+            (*key, self._ttl),
+        )
+        record = {
+            "state": row["state"] if row else None,
+            "data": row["data"] if row else {},
+            "bucket": row["bucket"] if row else {},
+            "touched": monotonic(),
+        }
+        self._cache.put(key, record)
+        return key, record
+
+    def _write(self, key, record):
+        record["touched"] = monotonic()
+        self._cache.put(key, record)
+        self._dirty[key] = record
+        if self._flusher is None or self._flusher.done():
+            self._flusher = create_task(self._flushLater())
+
+    async def _flushLater(self):
+        # Пока пачка пишется, могут измениться другие состояния: пишутся
+        # следующей пачкой, после ошибки - с растущей паузой
+        delay = self._flush_interval
+        while True:
+            await sleep(delay)
+            try:
+                await self.flush()
+            except Exception:
+                delay = min(max(delay * 2, 1), 30)
+                exception(
+                    "Не удалось записать состояния FSM, повтор через %.1f с", delay
+                )
+                continue
+            delay = self._flush_interval
+            if not self._dirty:
+                return
+
+    async def flush(self):
+        """Запись изменённых состояний в бд одним обращением"""
+        dirty, self._dirty = self._dirty, {}
+        expire = monotonic() - self._expired_at > 60
+        if not dirty and not expire:
+            return
+        rows, empty = [], []
+        for (chat, user), record in dirty.items():
+            if record["state"] is None and not record["data"] and not record["bucket"]:
+                empty.append((chat, user))
+            else:
+                rows.append(
+                    (
+                        chat,
+                        user,
+                        record["state"],
+                        Json(record["data"]),
+                        Json(record["bucket"]),
+                    )
+                )
+
+        def write(cursor):
+            if rows:
+                execute_values(
+                    cursor,
+                    """INSERT INTO fsm_states (chat_id, user_id, state, data, bucket)
+                       VALUES %s
+                       ON CONFLICT (chat_id, user_id) DO UPDATE
+                       SET state = EXCLUDED.state, data = EXCLUDED.data,
+                           bucket = EXCLUDED.bucket, updated_at = now()""",
+                    rows,
+                )
+            if empty:
+                cursor.execute(
+                    """DELETE FROM fsm_states WHERE (chat_id, user_id) IN (
+                           SELECT * FROM unnest(%s::bigint[], %s::bigint[]))""",
+                    ([chat for chat, _ in empty], [user for _, user in empty]),
+                )
+            if expire:
+                cursor.execute(
+                    """DELETE FROM fsm_states
+                       WHERE updated_at < now() - %s * interval '1 second'""",
+                    (self._ttl,),
+                )
+
+        try:
+            await self._run(write)
+        except BaseException:
+            # Не потерять изменения: записать их со следующей пачкой
+            for key, record in dirty.items():
+                self._dirty.setdefault(key, record)
+            raise
+        if expire:
+            self._expired_at = monotonic()
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await gather(self._flusher, return_exceptions=True)
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        _, record = await self._record(chat, user)
+        return record["state"] or self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, record = await self._record(chat, user)
+        return deepcopy(record["data"])
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, record = await self._record(chat, user)
+        record["state"] = self.resolve_state(state)
+        self._write(key, record)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key, record = await self._record(chat, user)
+        record["data"] = deepcopy(data or {})
+        self._write(key, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key, record = await self._record(chat, user)
+        record["data"].update(deepcopy(data or {}), **kwargs)
+        self._write(key, record)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        key, record = await self._record(chat, user)
+        record["state"] = None
+        if with_data:
+            record["data"] = {}
+        self._write(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        _, record = await self._record(chat, user)
+        return deepcopy(record["bucket"])
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key, record = await self._record(chat, user)
+        record["bucket"] = deepcopy(bucket or {})
+        self._write(key, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        key, record = await self._record(chat, user)
+        record["bucket"].update(deepcopy(bucket or {}), **kwargs)
+        self._write(key, record)
@@ -1,27 +1,153 @@
+from asyncio import CancelledError, Queue, create_task, gather, get_running_loop, sleep
+from collections import deque
+from logging import warning
+from os import getenv
 from pyjokes import get_joke
-from googletrans import Translator
-from random import randint
-from bs4 import BeautifulSoup
-from aiohttp import ClientSession
+from random import randint, shuffle
+from bs4 import BeautifulSoup, SoupStrainer
+from scripts.events import Signal
+from scripts.http_client import HttpClient
+from scripts.translate import TranslationCache
+
+
+def parseAnekdots(html):
+    """Все анекдоты со страницы anecdotica.ru"""
+    soup = BeautifulSoup(
+        html, "lxml", parse_only=SoupStrainer("div", class_="item_text")
+    )
+    return [div.text for div in soup.find_all("div", class_="item_text")]
 
 
 class getAnekdot:
-    def __init__(self):
-        pass
+    """Анекдоты из интернета
+
+    После start() для каждого источника работает фоновая задача, которая
+    держит наготове до size анекдотов и дозаправляет очередь, когда в ней
+    остаётся меньше low. Недавние анекдоты (последние recent) не
+    повторяются, а при сбое источника выдаются анекдоты другого.
+
+    Страница anecdotica.ru разбирается целиком в пуле потоков, так что
+    одна загрузка заполняет очередь сразу несколькими анекдотами. Переводы
+    pyjokes кешируются в файле TRANSLATIONS_PATH, заранее заполнить его
+    можно командой python -m scripts.translate.
+    """
+
+    def __init__(self, size=10, low=3, recent=200, url="http://anecdotica.ru/"):
+        self._size = size
+        self._low = low
+        self._url = url
+        self._recent = deque(maxlen=recent)
+        self._http = HttpClient()
+        self._translations = None
+        self._queues = []
+        self._wakeups = []
+        self._tasks = []
+
+    async def start(self):
+        for source in (self.Anekdots1, self.Anekdots2):
+            queue, wakeup = Queue(self._size), Signal()
+            self._queues.append(queue)
+            self._wakeups.append(wakeup)
+            self._tasks.append(create_task(self._produce(source, queue, wakeup)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await gather(*self._tasks, return_exceptions=True)
+        self._queues, self._wakeups, self._tasks = [], [], []
+        await self._http.close()
+        if self._translations is not None:
+            self._translations.close()
+            self._translations = None
+
+    def popAnekdot(self):
+        """Готовый анекдот из очереди или None, если все очереди пусты"""
+        order = list(range(len(self._queues)))
+        shuffle(order)
+        for i in order:
+            queue = self._queues[i]
+            if not queue.empty():
+                joke = queue.get_nowait()
+                if queue.qsize() < self._low:
+                    self._wakeups[i].set()
+                return joke
+        return None
 
     async def getAnekdot(self):
-        return await eval(f"self.Anekdot{randint(1, 2)}")()
+        joke = self.popAnekdot()
+        if joke is not None:
+            return joke
+        order = [0, 1]
+        if randint(1, 2) == 2:
+            order.reverse()
+        sources = (self.Anekdots1, self.Anekdots2)
+        for i in order:
+            try:
+                jokes = await sources[i]()
+            except CancelledError:
+                raise
+            except Exception as e:
+                warning("Источник анекдотов %s недоступен: %s", sources[i].__name__, e)
+                continue
+            fresh = [joke for joke in jokes if not self._isRecent(joke)] or jokes
+            # Остальные анекдоты страницы пригодятся следующим запросам
+            if self._queues:
+                for joke in fresh[1:]:
+                    if self._queues[i].full():
+                        break
+                    self._queues[i].put_nowait(joke)
+            return fresh[0]
+        return "Не удалось загрузить анекдот 😞, попробуйте позже"
+
+    def _isRecent(self, joke):
+        if joke in self._recent:
+            return True
+        self._recent.append(joke)
+        return False
+
+    async def _produce(self, source, queue, wakeup):
+        """Фоновое заполнение очереди одного источника"""
+        delay = 1
+        while True:
+            while not queue.full():
+                try:
+                    jokes = await source()
+                except CancelledError:
+                    raise
+                except Exception as e:
+                    warning("Источник анекдотов %s недоступен: %s", source.__name__, e)
+                    await sleep(delay)
+                    delay = min(delay * 2, 60)
+                    continue
+                fresh = [joke for joke in jokes if not self._isRecent(joke)]
+                if not fresh:
+                    # Источник отдаёт то же самое, пусть обновится
+                    await sleep(delay)
+                    delay = min(delay * 2, 60)
+                    continue
+                delay = 1
+                for joke in fresh:
+                    if queue.full():
+                        break
+                    queue.put_nowait(joke)
+            await wakeup.wait()
 
     async def Anekdot1(self):
-        translator = Translator()
-        joke = get_joke()
-        result = translator.translate(str(joke), dest="ru")
-        return result.text
+        if self._translations is None:
+            self._translations = TranslationCache(
+                getenv("TRANSLATIONS_PATH", "translations.sqlite3")
+            )
+        return await self._translations.translate(str(get_joke()))
 
     async def Anekdot2(self):
-        async with ClientSession(trust_env=True) as session:
-            async with session.get("http://anecdotica.ru/", ssl=False) as response:
-                html = await response.text()
-                soup = BeautifulSoup(html, "lxml")
-                result = soup.find_all("div", class_="item_text")[0]
-                return result.text
+        return (await self.Anekdots2())[0]
+
+    async def Anekdots1(self):
+        return [await self.Anekdot1()]
+
+    async def Anekdots2(self):
+        html = await self._http.text(self._url)
+        jokes = await get_running_loop().run_in_executor(None, parseAnekdots, html)
+        if not jokes:
+            raise ValueError("На странице нет анекдотов")
+        return jokes
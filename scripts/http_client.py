@@ -0,0 +1,60 @@
+from asyncio import TimeoutError, sleep
+from logging import warning
+from aiohttp import (
+    ClientError,
+    ClientResponseError,
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+)
+
+
+class HttpClient:
+    """Долгоживущая HTTP-сессия
+
+    Одна сессия на всё время работы бота: соединения переиспользуются
+    (keep-alive), DNS кешируется. Сетевые ошибки, таймауты и ответы 5xx
+    повторяются до retries раз с экспоненциальной задержкой.
+    """
+
+    def __init__(self, timeout=10, retries=3, backoff=0.5, limit=10):
+        self._timeout = ClientTimeout(total=timeout)
+        self._retries = retries
+        self._backoff = backoff
+        self._limit = limit
+        self._session = None
+
+    def _getSession(self):
+        # Сессия создаётся внутри работающего цикла событий
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(limit=self._limit, ttl_dns_cache=300, ssl=False),
+                timeout=self._timeout,
+                trust_env=True,
+            )
+        return self._session
+
+    async def text(self, url):
+        """Текст страницы по url"""
+        delay = self._backoff
+        for attempt in range(self._retries + 1):
+            try:
+                async with self._getSession().get(url) as response:
+                    response.raise_for_status()
+                    return await response.text()
+            except ClientResponseError as e:
+                if e.status < 500 or attempt == self._retries:
+                    raise
+                error = e
+            except (ClientError, TimeoutError) as e:
+                if attempt == self._retries:
+                    raise
+                error = e
+            warning("Запрос %s не удался (%s), повтор через %.1f с", url, error, delay)
+            await sleep(delay)
+            delay *= 2
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
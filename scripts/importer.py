@@ -0,0 +1,140 @@
+"""Чтение шуток из файлов для массового импорта
+
+Поддерживаются форматы:
+- txt: шутки через пустую строку, автор - по умолчанию;
+- csv: заголовок с колонками joke и (необязательно) author;
+- json: массив строк или объектов {"joke": ..., "author": ...},
+  а также JSON Lines (.jsonl) - по объекту или строке в строке файла.
+
+Файлы читаются потоково, в памяти держится не больше одного куска.
+"""
+from csv import DictReader, Error as CsvError
+from io import TextIOWrapper
+from json import JSONDecodeError, JSONDecoder, loads
+from scripts.dedup import minhash, textHash
+
+FORMATS = ("txt", "csv", "json", "jsonl")
+MAX_JOKE = 4096
+MAX_AUTHOR = 256
+_decoder = JSONDecoder()
+
+
+def _txt(text):
+    number, lines = 0, []
+    for i, line in enumerate(text, 1):
+        if line.strip():
+            if not lines:
+                number = i
+            lines.append(line.rstrip())
+        elif lines:
+            yield number, "\n".join(lines), None
+            lines = []
+    if lines:
+        yield number, "\n".join(lines), None
+
+
+def _csv(text):
+    reader = DictReader(text)
+    if not reader.fieldnames or "joke" not in reader.fieldnames:
+        raise ValueError("В CSV нет колонки joke")
+    for row in reader:
+        yield reader.line_num, row.get("joke"), row.get("author")
+
+
+def _item(number, item):
+    if isinstance(item, str):
+        return number, item, None
+    if isinstance(item, dict):
+        return number, item.get("joke"), item.get("author")
+    return number, None, None
+
+
+def _jsonl(text):
+    for number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            yield _item(number, loads(line))
+        except JSONDecodeError:
+            yield number, None, None
+
+
+def _json(text, size=65536):
+    """Элементы JSON-массива по одному, без загрузки всего файла"""
+    buffer, position, number, eof = "", 0, 0, False
+    started = False
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if not started and position < len(buffer):
+            if buffer[position] != "[":
+                raise ValueError("JSON должен быть массивом")
+            started = True
+            position += 1
+            continue
+        if position < len(buffer) and buffer[position] == "]":
+            return
+        try:
+            if position >= len(buffer):
+                raise JSONDecodeError("", buffer, position)
+            item, end = _decoder.raw_decode(buffer, position)
+        except JSONDecodeError:
+            if eof:
+                raise ValueError("JSON оборван на элементе %d" % (number + 1))
+            chunk = text.read(size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        number += 1
+        position = end
+        yield _item(number, item)
+
+
+def readJokes(file, kind, author):
+    """(номер, шутка, автор) из бинарного файла формата kind
+
+    Номер - строка (txt, csv, jsonl) или элемент массива (json). Для
+    некорректных записей шутка - None. Ошибка формата всего файла -
+    ValueError.
+    """
+    if kind not in FORMATS:
+        raise ValueError("Неизвестный формат, нужен один из: %s" % ", ".join(FORMATS))
+    text = TextIOWrapper(
+        file, encoding="utf-8-sig", newline="" if kind == "csv" else None
+    )
+    try:
+        rows = {"txt": _txt, "csv": _csv, "json": _json, "jsonl": _jsonl}[kind](text)
+        for number, joke, joke_author in rows:
+            yield number, joke, joke_author or author
+    except (UnicodeDecodeError, CsvError) as e:
+        raise ValueError(f"Не удалось прочитать файл: {e}") from e
+    finally:
+        text.detach()
+
+
+def prepareJokes(rows, size):
+    """Следующие size записей с отпечатками и ошибки проверки
+
+    Возвращает список (номер, шутка, автор, хеш, подпись MinHash) и
+    список (номер, описание ошибки); пустой первый список и пустые
+    ошибки - записи кончились.
+    """
+    jokes, errors = [], []
+    for number, joke, author in rows:
+        if not isinstance(joke, str) or not joke.strip():
+            errors.append((number, "нет текста шутки"))
+        elif len(joke) > MAX_JOKE:
+            errors.append((number, "шутка длиннее %d символов" % MAX_JOKE))
+        elif (
+            not isinstance(author, str)
+            or not author.strip()
+            or len(author) > MAX_AUTHOR
+        ):
+            errors.append((number, "некорректный автор"))
+        else:
+            joke = joke.strip()
+            jokes.append((number, joke, author.strip(), textHash(joke), minhash(joke)))
+        if len(jokes) + len(errors) >= size:
+            break
+    return jokes, errors
@@ -0,0 +1,51 @@
+from asyncio import sleep
+from time import monotonic
+
+
+class TokenBucket:
+    """Ограничитель частоты "ведро с токенами"
+
+    Токены пополняются со скоростью rate в секунду, но не больше burst.
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("Частота должна быть положительной")
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """Взятие токенов без ожидания"""
+        now = monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens < tokens:
+            return False
+        self._tokens -= tokens
+        return True
+
+    async def acquire(self, tokens=1):
+        """Ожидание и взятие токенов"""
+        while True:
+            now = monotonic()
+            if now < self._paused_until:
+                await sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return
+            await sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Остановка выдачи токенов, например по RetryAfter"""
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+        self._tokens = 0
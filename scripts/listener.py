@@ -0,0 +1,89 @@
+from asyncio import get_running_loop
+from logging import info, warning
+from psycopg2 import InterfaceError, OperationalError
+from psycopg2.extensions import quote_ident
+from scripts.sql_data import PostDatabase
+
+
+class PgListener(PostDatabase):
+    """Приём уведомлений Postgres LISTEN/NOTIFY
+
+    Держит отдельное соединение вне пула и читает уведомления без опроса,
+    по готовности сокета в цикле событий. После переподключения все
+    подписчики вызываются с payload None, так как часть уведомлений могла
+    потеряться.
+    """
+
+    def __init__(self, database, reconnect=5):
+        super(PgListener, self).__init__(database)
+        self._reconnect = reconnect
+        self._callbacks = {}
+        self._connection = None
+        self._loop = None
+        self._stopped = False
+
+    def subscribe(self, channel, callback):
+        """Вызов callback(payload) на каждое уведомление канала"""
+        self._callbacks.setdefault(channel, []).append(callback)
+
+    async def start(self):
+        self._loop = get_running_loop()
+        self._stopped = False
+        try:
+            connection = await self._blocking(self._connect)
+            with connection.cursor() as cursor:
+                for channel in self._callbacks:
+                    cursor.execute("LISTEN %s" % quote_ident(channel, cursor))
+        except (InterfaceError, OperationalError) as e:
+            warning("LISTEN недоступен: %s, повтор через %d с", e, self._reconnect)
+            self._schedule()
+            return
+        try:
+            self._loop.add_reader(connection.fileno(), self._read)
+        except NotImplementedError:
+            # Цикл событий без add_reader (Proactor в Windows)
+            warning("LISTEN не поддерживается этим циклом событий")
+            connection.close()
+            return
+        self._connection = connection
+        info("Слушаю каналы: %s", ", ".join(self._callbacks))
+        self._dispatch_all(None)
+
+    async def stop(self):
+        self._stopped = True
+        self._disconnect()
+
+    def _schedule(self):
+        if not self._stopped:
+            self._loop.call_later(
+                self._reconnect, lambda: self._loop.create_task(self.start())
+            )
+
+    def _disconnect(self):
+        if self._connection is None:
+            return
+        try:
+            self._loop.remove_reader(self._connection.fileno())
+        except (InterfaceError, ValueError):
+            pass
+        self._connection.close()
+        self._connection = None
+
+    def _read(self):
+        try:
+            self._connection.poll()
+        except (InterfaceError, OperationalError) as e:
+            warning("Соединение LISTEN потеряно: %s", e)
+            self._disconnect()
+            self._schedule()
+            return
+        notifies = self._connection.notifies
+        while notifies:
+            notify = notifies.pop(0)
+            for callback in self._callbacks.get(notify.channel, ()):
+                callback(notify.payload)
+
+    def _dispatch_all(self, payload):
+        for callbacks in self._callbacks.values():
+            for callback in callbacks:
+                callback(payload)
@@ -0,0 +1,308 @@
+from bisect import bisect_left
+from re import compile as regex
+from threading import Lock
+from time import perf_counter
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+from psycopg2.extras import RealDictCursor
+from scripts.cache import LRUCache
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return "{%s}" % pairs
+
+
+class Counter:
+    """Счётчик с метками"""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        return [
+            f"{self.name}{_labels(self.labels, key)} {value}"
+            for key, value in self.values().items()
+        ]
+
+
+class Gauge:
+    """Значения, которые в момент выгрузки возвращает callback()
+
+    callback возвращает число или словарь {кортеж меток: число}.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, callback, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._callback = callback
+
+    def render(self):
+        values = self._callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [
+            f"{self.name}{_labels(self.labels, key)} {value}"
+            for key, value in values.items()
+        ]
+
+
+class Histogram:
+    """Распределение длительностей с метками"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def series(self):
+        """{метки: (счётчики корзин, количество, сумма)}"""
+        with self._lock:
+            return {key: (list(s[0]), s[1], s[2]) for key, s in self._series.items()}
+
+    def quantile(self, q, *labels):
+        """Оценка квантиля по корзинам с линейной интерполяцией"""
+        series = self.series().get(labels)
+        if not series or not series[1]:
+            return 0.0
+        counts, count, _ = series
+        rank, seen, lower = q * count, 0, 0.0
+        for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+            if seen + bucket >= rank:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / bucket
+            seen += bucket
+            lower = bound
+        return lower
+
+    def render(self):
+        lines = []
+        for key, (counts, count, total) in self.series().items():
+            seen = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                seen += bucket
+                labels = _labels(self.labels + ("le",), key + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {seen}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+handler_seconds = registry.register(
+    Histogram("bot_handler_seconds", "Время обработчиков", ("handler",))
+)
+query_seconds = registry.register(
+    Histogram("bot_db_query_seconds", "Время запросов к бд", ("query",))
+)
+api_seconds = registry.register(
+    Histogram("bot_api_request_seconds", "Время запросов к Bot API", ("method",))
+)
+api_errors = registry.register(
+    Counter("bot_api_errors_total", "Ошибки запросов к Bot API", ("method",))
+)
+broadcast_messages = registry.register(
+    Counter("bot_broadcast_messages_total", "Сообщения рассылки", ("result",))
+)
+throttled_requests = registry.register(
+    Counter("bot_throttled_total", "Запросы сверх лимита частоты", ("handler",))
+)
+
+# Литерал может быть обрезан вместе с текстом запроса
+_literals = regex(r"'(?:[^']|'')*(?:'|$)|\b\d+(?:\.\d+)?\b")
+# Повторы строк VALUES, включая обрезанную последнюю
+_rows = regex(r"(\([^()]*\))(?:\s*,\s*\([^()]*\)?)+")
+_spaces = regex(r"\s+")
+_templates = LRUCache(1000)
+_templates_lock = Lock()
+# Запросы execute_values и mogrify содержат данные и бывают огромными,
+# шаблон строится только по их началу
+TEMPLATE_PREFIX = 512
+
+
+def queryTemplate(query):
+    """Шаблон запроса: без литералов, лишних пробелов и повторов VALUES"""
+    if not isinstance(query, (bytes, str)):
+        query = str(query)
+    query = query[:TEMPLATE_PREFIX]
+    with _templates_lock:
+        template = _templates.get(query)
+    if template is None:
+        text = query.decode(errors="replace") if isinstance(query, bytes) else query
+        text = _spaces.sub(" ", _literals.sub("?", text)).strip()
+        template = _rows.sub(r"\1, ...", text)[:120]
+        with _templates_lock:
+            _templates.put(query, template)
+    return template
+
+
+class TimedCursor(RealDictCursor):
+    """Курсор, замеряющий время запросов по их шаблонам"""
+
+    def execute(self, query, vars=None):
+        start = perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            query_seconds.observe(perf_counter() - start, queryTemplate(query))
+
+
+class HandlerTimer(BaseMiddleware):
+    """Замер времени зарегистрированных обработчиков"""
+
+    def _start(self, data):
+        data["_handler_started"] = perf_counter()
+        data["_handler_name"] = current_handler.get().__name__
+
+    def _stop(self, data):
+        if "_handler_started" in data:
+            handler_seconds.observe(
+                perf_counter() - data.pop("_handler_started"), data.pop("_handler_name")
+            )
+
+    async def on_process_message(self, message, data):
+        self._start(data)
+
+    async def on_post_process_message(self, message, results, data):
+        self._stop(data)
+
+    async def on_process_callback_query(self, call, data):
+        self._start(data)
+
+    async def on_post_process_callback_query(self, call, results, data):
+        self._stop(data)
+
+    async def on_process_inline_query(self, inline_query, data):
+        self._start(data)
+
+    async def on_post_process_inline_query(self, inline_query, results, data):
+        self._stop(data)
+
+
+class TimedBot(Bot):
+    """Bot, замеряющий время запросов к Bot API"""
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        start = perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception:
+            api_errors.inc(method)
+            raise
+        finally:
+            api_seconds.observe(perf_counter() - start, method)
+
+
+def top(histogram, limit=5):
+    """Самые затратные по суммарному времени серии гистограммы"""
+    series = sorted(histogram.series().items(), key=lambda item: -item[1][2])
+    return [
+        (key[0], count, total / count, histogram.quantile(0.95, *key))
+        for key, (_, count, total) in series[:limit]
+        if count
+    ]
+
+
+def summary():
+    """Краткая сводка для команды /stats"""
+    lines = []
+    for title, histogram in (
+        ("Обработчики", handler_seconds),
+        ("Запросы к бд", query_seconds),
+        ("Bot API", api_seconds),
+    ):
+        lines.append(f"{title}:")
+        for name, count, mean, p95 in top(histogram):
+            lines.append(
+                f"  {name[:60]}: {count} шт., ср. {mean * 1000:.1f} мс, "
+                f"p95 {p95 * 1000:.1f} мс"
+            )
+    sent = broadcast_messages.values()
+    lines.append(
+        "Рассылка: отправлено %d, заблокировали %d, ошибок %d"
+        % (sent.get(("sent",), 0), sent.get(("blocked",), 0), sent.get(("failed",), 0))
+    )
+    throttled = throttled_requests.values()
+    if throttled:
+        lines.append(
+            "Сверх лимита: "
+            + ", ".join(f"{key[0]} {value}" for key, value in sorted(throttled.items()))
+        )
+    return "\n".join(lines)
+
+
+async def startServer(host, port):
+    """HTTP-сервер с /metrics, возвращает runner для остановки"""
+
+    async def metrics(request):
+        return web.Response(
+            text=registry.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,214 @@
+"""Версионные миграции схемы бд
+
+Каждая миграция применяется один раз в своей транзакции и записывается
+в schema_migrations. Запуск защищён advisory-блокировкой, так что
+несколько процессов бота, стартующих одновременно, не мешают друг
+другу. Команды миграций идемпотентны: бд, созданная до появления
+миграций, догоняется до текущей схемы без ошибок.
+
+Применить миграции вручную: python -m scripts.migrations
+"""
+from logging import info
+
+# Ключ pg_advisory_lock, общий для всех процессов бота
+LOCK_ID = 0x6A6F6B6573
+
+MIGRATIONS = (
+    (
+        1,
+        "Начальная схема",
+        (
+            """CREATE TABLE IF NOT EXISTS users (
+                   id BIGSERIAL NOT NULL PRIMARY KEY,
+                   user_id BIGINT NOT NULL
+               )""",
+            """CREATE TABLE IF NOT EXISTS jokes (
+                   user_id INTEGER,
+                   joke TEXT,
+                   author TEXT
+               )""",
+            """CREATE TABLE IF NOT EXISTS newJokes (
+                   user_id INTEGER,
+                   joke TEXT,
+                   author TEXT
+               )""",
+            """CREATE TABLE IF NOT EXISTS admins (
+                   user_id BIGINT,
+                   name TEXT,
+                   inviting BIGINT
+               )""",
+        ),
+    ),
+    (
+        2,
+        "Уникальный user_id пользователей",
+        (
+            """DELETE FROM users a USING users b
+               WHERE a.user_id = b.user_id AND a.id > b.id""",
+            "CREATE UNIQUE INDEX IF NOT EXISTS users_user_id_key ON users (user_id)",
+        ),
+    ),
+    (
+        3,
+        "Пользователи, заблокировавшие бота",
+        (
+            """ALTER TABLE users
+               ADD COLUMN IF NOT EXISTS blocked BOOLEAN NOT NULL DEFAULT FALSE""",
+        ),
+    ),
+    (
+        4,
+        "Первичный ключ шуток",
+        (
+            "ALTER TABLE jokes ADD COLUMN IF NOT EXISTS id BIGSERIAL PRIMARY KEY",
+            "CREATE INDEX IF NOT EXISTS jokes_user_id_id_idx ON jokes (user_id, id)",
+        ),
+    ),
+    (
+        5,
+        "Очередь рассылки с позицией и арендой",
+        (
+            """ALTER TABLE newJokes
+               ADD COLUMN IF NOT EXISTS id BIGSERIAL PRIMARY KEY,
+               ADD COLUMN IF NOT EXISTS last_user_id BIGINT NOT NULL DEFAULT 0,
+               ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ""",
+        ),
+    ),
+    (
+        6,
+        "Счётчик шуток пользователя",
+        (
+            """ALTER TABLE users
+               ADD COLUMN IF NOT EXISTS jokes_count INTEGER NOT NULL DEFAULT 0""",
+            """UPDATE users SET jokes_count = counts.quantity
+               FROM (SELECT user_id, COUNT(*) AS quantity FROM jokes
+                     GROUP BY user_id) counts
+               WHERE users.id = counts.user_id""",
+        ),
+    ),
+    (
+        7,
+        "Состояния FSM",
+        (
+            """CREATE TABLE IF NOT EXISTS fsm_states (
+                   chat_id BIGINT NOT NULL,
+                   user_id BIGINT NOT NULL,
+                   state TEXT,
+                   data JSONB NOT NULL DEFAULT '{}',
+                   bucket JSONB NOT NULL DEFAULT '{}',
+                   updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                   PRIMARY KEY (chat_id, user_id)
+               )""",
+            """CREATE INDEX IF NOT EXISTS fsm_states_updated_at_idx
+               ON fsm_states (updated_at)""",
+        ),
+    ),
+    (
+        8,
+        "Полнотекстовый поиск шуток",
+        (
+            """ALTER TABLE jokes ADD COLUMN IF NOT EXISTS search TSVECTOR
+               GENERATED ALWAYS AS (
+                   setweight(to_tsvector('russian', coalesce(joke, '')), 'A')
+                   || setweight(to_tsvector('russian', coalesce(author, '')), 'B')
+               ) STORED""",
+            "CREATE INDEX IF NOT EXISTS jokes_search_idx ON jokes USING GIN (search)",
+            # pg_trgm есть не в каждой сборке Postgres, без него короткие
+            # запросы ищутся перебором
+            """DO $$
+               BEGIN
+                   IF EXISTS (SELECT FROM pg_available_extensions
+                              WHERE name = 'pg_trgm') THEN
+                       CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                       CREATE INDEX IF NOT EXISTS jokes_joke_trgm_idx
+                           ON jokes USING GIN (joke gin_trgm_ops);
+                   END IF;
+               END
+               $$""",
+        ),
+    ),
+    (
+        9,
+        "Отпечатки шуток для поиска дубликатов",
+        (
+            # Заполняются ботом (scripts.dedup), у старых шуток - при
+            # первой загрузке индекса дубликатов
+            """ALTER TABLE jokes
+               ADD COLUMN IF NOT EXISTS text_hash BYTEA,
+               ADD COLUMN IF NOT EXISTS minhash BYTEA""",
+            "CREATE INDEX IF NOT EXISTS jokes_text_hash_idx ON jokes (text_hash)",
+        ),
+    ),
+    (
+        10,
+        "Полосы MinHash для поиска похожих шуток",
+        (
+            # Ключ полосы - XOR двух половин её 16 байт, как scripts.dedup.bands
+            """CREATE OR REPLACE FUNCTION minhash_bands(signature BYTEA)
+               RETURNS BIGINT[] LANGUAGE SQL IMMUTABLE PARALLEL SAFE AS $$
+                   SELECT array_agg(
+                       (('x' || encode(substring(signature FROM i * 16 + 1 FOR 8), 'hex'))::BIT(64)
+                        # ('x' || encode(substring(signature FROM i * 16 + 9 FOR 8), 'hex'))::BIT(64)
+                       )::BIGINT ORDER BY i)
+                   FROM generate_series(0, length(signature) / 16 - 1) i
+               $$""",
+            """ALTER TABLE jokes ADD COLUMN IF NOT EXISTS minhash_bands BIGINT[]
+               GENERATED ALWAYS AS (minhash_bands(minhash)) STORED""",
+            """CREATE INDEX IF NOT EXISTS jokes_minhash_bands_idx
+               ON jokes USING GIN (minhash_bands)""",
+        ),
+    ),
+)
+
+
+def migrate(connection):
+    """Применение недостающих миграций, возвращает их версии
+
+    Соединение должно быть в режиме autocommit, транзакции открываются
+    явно для каждой миграции.
+    """
+    applied = []
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_lock(%s)", (LOCK_ID,))
+        try:
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS schema_migrations (
+                       version INTEGER PRIMARY KEY,
+                       name TEXT NOT NULL,
+                       applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                   )"""
+            )
+            cursor.execute("SELECT version FROM schema_migrations")
+            done = {row[0] for row in cursor.fetchall()}
+            for version, name, statements in MIGRATIONS:
+                if version in done:
+                    continue
+                cursor.execute("BEGIN")
+                try:
+                    for statement in statements:
+                        cursor.execute(statement)
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                        (version, name),
+                    )
+                except BaseException:
+                    cursor.execute("ROLLBACK")
+                    raise
+                cursor.execute("COMMIT")
+                info("Применена миграция %s: %s", version, name)
+                applied.append(version)
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (LOCK_ID,))
+    return applied
+
+
+if __name__ == "__main__":
+    from logging import basicConfig, INFO
+    from scripts.sql_data import PostDatabase
+
+    basicConfig(level=INFO)
+    connection = PostDatabase("jokes")._connect()
+    try:
+        print("Применено миграций:", len(migrate(connection)))
+    finally:
+        connection.close()
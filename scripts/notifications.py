@@ -1,17 +1,62 @@
-from create_bot import bot, notific
-from asyncio import sleep
+from os import getenv
+from logging import exception
+from create_bot import bot, notific, listener
+from asyncio import CancelledError, shield
+from scripts.broadcast import Broadcaster
+from scripts.events import jokeAdded
+
+BROADCAST_LEASE = int(getenv("BROADCAST_LEASE", 60))
+
+broadcaster = Broadcaster(
+    bot,
+    notific,
+    rate=float(getenv("BROADCAST_RATE", 30)),
+    concurrency=int(getenv("BROADCAST_CONCURRENCY", 20)),
+    batch=int(getenv("BROADCAST_BATCH", 1000)),
+    # Прервать рассылку раньше, чем истечёт аренда шутки
+    checkpoint_timeout=BROADCAST_LEASE / 2,
+)
+
+
+async def broadcastJoke(row):
+    """Рассылка шутки из очереди newJokes с её сохранённой позиции"""
+
+    async def checkpoint(last_user_id):
+        await notific.checkpointJoke(row["id"], last_user_id, BROADCAST_LEASE)
+
+    try:
+        await broadcaster.broadcast(
+            f"Появилась новая шутка\n\n{row['joke']}\n\nАвтор: {row['author']}",
+            exclude=row["user_id"],
+            after=row["last_user_id"],
+            checkpoint=checkpoint,
+        )
+    except CancelledError:
+        # Остановка бота: следующий запуск продолжит рассылку без ожидания аренды
+        await shield(notific.releaseJoke(row["id"]))
+        raise
+    await notific.finishJoke(row["id"])
+
+
+# Шутки, записанные другими процессами бота
+listener.subscribe("new_jokes", jokeAdded.set)
 
 
 async def scheduled(self):
+    """Рассылка новых шуток
+
+    Просыпается сразу после записи шутки, а раз в self секунд проверяет
+    очередь на случай пропущенного уведомления или истёкшей аренды.
+    """
     while True:
-        await sleep(self)
-        if await notific.newsJokesExists():
-            row = await notific.newsJoke()
-            for i in range(await notific.quantityUsers()):
-                if row["user_id"] != i + 1:
-                    userId = await notific.infoId(i + 1)
-                    await bot.send_message(
-                        userId,
-                        f"Появилась новая шутка\n\n{row['joke']}\n\nАвтор: {row['author']}",
-                    )
-            await notific.deleteOldJoke()
+        try:
+            while True:
+                row = await notific.claimJoke(BROADCAST_LEASE)
+                if row is None:
+                    break
+                await broadcastJoke(row)
+        except CancelledError:
+            raise
+        except Exception:
+            exception("Ошибка рассылки новой шутки")
+        await jokeAdded.wait(self)
@@ -0,0 +1,154 @@
+from threading import Condition
+from time import monotonic
+from psycopg2 import connect, InterfaceError, OperationalError
+from psycopg2.extensions import (
+    ISOLATION_LEVEL_AUTOCOMMIT,
+    TRANSACTION_STATUS_IDLE,
+)
+from psycopg2.pool import PoolError
+
+
+class ConnectionPool:
+    """Ограниченный пул долгоживущих соединений psycopg2
+
+    Соединения выдаются через getconn() и возвращаются через putconn().
+    Если все maxconn соединений заняты, getconn() ждёт освобождения не
+    дольше timeout секунд. Соединение, пролежавшее в пуле дольше
+    check_interval секунд, перед выдачей проверяется запросом SELECT 1.
+    """
+
+    def __init__(self, minconn, maxconn, timeout=None, check_interval=30, **kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Некорректный размер пула")
+        self._minconn = minconn
+        self._maxconn = maxconn
+        self._timeout = timeout
+        self._check_interval = check_interval
+        self._kwargs = kwargs
+        self._cond = Condition()
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._wait_count = 0
+        self._wait_time = 0.0
+        self._wait_max = 0.0
+        self._closed = False
+        for _ in range(minconn):
+            self._idle.append((self._connect(), monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        connection = connect(**self._kwargs)
+        connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        return connection
+
+    def _healthy(self, connection, idle_since):
+        """Проверка соединения перед выдачей"""
+        if connection.closed:
+            return False
+        # Соединение с незавершённой транзакцией или потерянное
+        if connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            return False
+        if monotonic() - idle_since < self._check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        except (InterfaceError, OperationalError):
+            return False
+        return True
+
+    def getconn(self):
+        """Получение соединения из пула"""
+        start = monotonic()
+        with self._cond:
+            if self._closed:
+                raise PoolError("Пул соединений закрыт")
+            self._waiting += 1
+            try:
+                while not self._idle and self._size >= self._maxconn:
+                    remaining = None
+                    if self._timeout is not None:
+                        remaining = self._timeout - (monotonic() - start)
+                        if remaining <= 0:
+                            raise PoolError("Нет свободных соединений в пуле")
+                    self._cond.wait(remaining)
+                    if self._closed:
+                        raise PoolError("Пул соединений закрыт")
+            finally:
+                self._waiting -= 1
+            waited = monotonic() - start
+            self._wait_count += 1
+            self._wait_time += waited
+            self._wait_max = max(self._wait_max, waited)
+            if self._idle:
+                connection, idle_since = self._idle.pop()
+            else:
+                connection, idle_since = None, None
+                self._size += 1
+            self._in_use += 1
+
+        try:
+            if connection is not None and not self._healthy(connection, idle_since):
+                connection.close()
+                connection = None
+            if connection is None:
+                connection = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return connection
+
+    def putconn(self, connection, close=False):
+        """Возврат соединения в пул"""
+        if not connection.closed and not close:
+            try:
+                # В autocommit rollback() ничего не делает, а транзакцию,
+                # открытую явным BEGIN, нужно откатить запросом
+                if connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    with connection.cursor() as cursor:
+                        cursor.execute("ROLLBACK")
+                    close = (
+                        connection.get_transaction_status() != TRANSACTION_STATUS_IDLE
+                    )
+            except (InterfaceError, OperationalError):
+                close = True
+        with self._cond:
+            self._in_use -= 1
+            if self._closed or close or connection.closed:
+                self._size -= 1
+                if not connection.closed:
+                    connection.close()
+            else:
+                self._idle.append((connection, monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """Закрытие всех свободных соединений пула"""
+        with self._cond:
+            self._closed = True
+            for connection, _ in self._idle:
+                if not connection.closed:
+                    connection.close()
+            self._size -= len(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+
+    def stats(self):
+        """Статистика пула"""
+        with self._cond:
+            return {
+                "min": self._minconn,
+                "max": self._maxconn,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "wait_count": self._wait_count,
+                "wait_time": self._wait_time,
+                "wait_max": self._wait_max,
+            }
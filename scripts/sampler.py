@@ -0,0 +1,91 @@
+from array import array
+from random import randrange
+
+
+class IdSampler:
+    """Равномерная выборка случайного id за O(1)
+
+    id хранятся в компактном массиве. Удалённые id не вырезаются сразу, а
+    помечаются и пропускаются при выборке; когда помеченных становится
+    больше половины, массив уплотняется. Поэтому ожидаемое число попыток
+    выборки не превышает двух.
+
+    id выше floor дополнительно хранятся в множестве, чтобы при повторном
+    чтении этого окна из бд (см. merge) не добавить их второй раз.
+    """
+
+    def __init__(self):
+        self._ids = array("q")
+        self._removed = set()
+        self._tail = set()
+        self.floor = 0
+        # Наибольший загруженный id, None - ещё ничего не загружено
+        self.position = None
+        self.refreshed_at = 0.0
+        self.stale = False
+
+    def __len__(self):
+        return len(self._ids) - len(self._removed)
+
+    def add(self, id):
+        if id > self.floor:
+            if id in self._tail:
+                self._removed.discard(id)
+                return
+            self._tail.add(id)
+        self._removed.discard(id)
+        self._ids.append(id)
+
+    def extend(self, ids):
+        for id in ids:
+            self.add(id)
+
+    def merge(self, ids, floor):
+        """Добавление прочитанных из бд id, которых ещё нет в выборке
+
+        ids - все id выше прежнего floor, после чего окно сдвигается до
+        нового floor, и множество хранит только id выше него.
+        """
+        tail = self._tail
+        self.floor = max(self.floor, floor)
+        self._tail = {id for id in tail if id > self.floor}
+        for id in ids:
+            if id in tail:
+                self._removed.discard(id)
+                continue
+            if id > self.floor:
+                self._tail.add(id)
+            self._ids.append(id)
+
+    def discard(self, id):
+        self._removed.add(id)
+        if len(self._removed) * 2 > len(self._ids):
+            self.compact()
+
+    def compact(self):
+        """Удаление помеченных id из массива"""
+        removed = self._removed
+        self._ids = array("q", (id for id in self._ids if id not in removed))
+        self._tail -= removed
+        self._removed = set()
+
+    def clear(self):
+        self._ids = array("q")
+        self._removed = set()
+        self._tail = set()
+        self.stale = True
+
+    def reset(self):
+        """Очистка с полной перезагрузкой при следующем обращении"""
+        self.clear()
+        self.floor = 0
+        self.position = None
+
+    def choice(self):
+        """Случайный id или None, если выбирать не из чего"""
+        if not len(self):
+            return None
+        while True:
+            id = self._ids[randrange(len(self._ids))]
+            if id not in self._removed:
+                return id
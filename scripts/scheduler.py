@@ -0,0 +1,183 @@
+from asyncio import CancelledError, Condition, Lock, Semaphore, create_task, sleep
+from collections import deque
+from logging import exception, info
+from time import monotonic
+from aiohttp import ClientTimeout
+from aiohttp.helpers import sentinel
+from aiogram import Bot, Dispatcher
+from scripts.updates import chatId
+
+
+class ChatScheduler:
+    """Параллельная обработка чатов с сохранением порядка внутри чата
+
+    У каждого чата своя очередь не длиннее chat_queue обновлений, которую
+    по порядку разбирает одна задача. Одновременно выполняются не больше
+    concurrency обработчиков, а всего в очередях ждут не больше pending
+    обновлений. Если очередь чата или общий лимит заполнены, submit() ждёт
+    освобождения места, притормаживая получение новых обновлений.
+    """
+
+    def __init__(self, handler, concurrency=64, chat_queue=100, pending=10000):
+        self._handler = handler
+        self._chat_queue = chat_queue
+        self._limit = pending
+        self._queues = {}
+        self._pending = 0
+        self._active = 0
+        self._slots = Semaphore(concurrency)
+        self._space = Condition()
+        self._processed = 0
+        self._peak = 0
+        self._waits = 0
+        self._wait_time = 0.0
+
+    async def submit(self, chat, update):
+        """Постановка обновления в очередь чата"""
+        queue = self._queues.get(chat)
+        if self._pending >= self._limit or (queue and len(queue) >= self._chat_queue):
+            start = monotonic()
+            self._waits += 1
+            async with self._space:
+                await self._space.wait_for(
+                    lambda: self._pending < self._limit
+                    and len(self._queues.get(chat, ())) < self._chat_queue
+                )
+            self._wait_time += monotonic() - start
+            queue = self._queues.get(chat)
+        self._pending += 1
+        self._peak = max(self._peak, self._pending)
+        if queue is None:
+            queue = self._queues[chat] = deque()
+            queue.append(update)
+            create_task(self._drain(chat, queue))
+        else:
+            queue.append(update)
+
+    async def _drain(self, chat, queue):
+        """Обработка очереди одного чата"""
+        while queue:
+            async with self._slots:
+                self._active += 1
+                try:
+                    # Своя задача на обновление: aiogram кеширует состояние
+                    # FSM в contextvars, и в общей задаче оно бы устаревало
+                    await create_task(self._handler(queue[0]))
+                except Exception:
+                    exception("Ошибка обработки обновления чата %s", chat)
+                finally:
+                    self._active -= 1
+            queue.popleft()
+            if not queue:
+                del self._queues[chat]
+            self._pending -= 1
+            self._processed += 1
+            async with self._space:
+                self._space.notify_all()
+
+    async def join(self):
+        """Ожидание обработки всех принятых обновлений"""
+        async with self._space:
+            await self._space.wait_for(lambda: not self._pending)
+
+    def stats(self):
+        """Глубина очередей и нагрузка"""
+        return {
+            "chats": len(self._queues),
+            "pending": self._pending,
+            "active": self._active,
+            "max_chat_depth": max(map(len, self._queues.values()), default=0),
+            "peak_pending": self._peak,
+            "processed": self._processed,
+            "waits": self._waits,
+            "wait_time": self._wait_time,
+        }
+
+
+class ChatDispatcher(Dispatcher):
+    """Dispatcher, обрабатывающий обновления через ChatScheduler
+
+    Обновления разных чатов обрабатываются параллельно, а шаги FSM одного
+    чата (joke_step -> author_step -> res_step) строго по очереди. В
+    режиме long polling следующий getUpdates запрашивается только после
+    того, как предыдущая пачка встала в очереди, так что заполненные
+    очереди притормаживают получение обновлений.
+    """
+
+    def __init__(self, *args, concurrency=64, chat_queue=100, pending=10000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = ChatScheduler(
+            self.updates_handler.notify,
+            concurrency=concurrency,
+            chat_queue=chat_queue,
+            pending=pending,
+        )
+        self._submit = Lock()
+
+    async def process_updates(self, updates, fast=True):
+        # Lock сохраняет порядок пачек, пока submit() ждёт места в очереди
+        async with self._submit:
+            for update in updates:
+                await self.scheduler.submit(chatId(update), update)
+        return []
+
+    async def drain(self):
+        """Ожидание постановки в очереди уже полученных пачек"""
+        async with self._submit:
+            pass
+
+    async def start_polling(
+        self,
+        timeout=20,
+        relax=0.1,
+        limit=None,
+        reset_webhook=None,
+        fast=True,
+        error_sleep=5,
+        allowed_updates=None,
+    ):
+        """Long polling, как в aiogram, но пачка ставится в очереди до
+        запроса следующей, а не в отдельной задаче"""
+        if self._polling:
+            raise RuntimeError("Polling already started")
+        info("Start polling.")
+        Dispatcher.set_current(self)
+        Bot.set_current(self.bot)
+        if reset_webhook is None:
+            await self.reset_webhook(check=False)
+        if reset_webhook:
+            await self.reset_webhook(check=True)
+
+        self._polling = True
+        offset = None
+        try:
+            request_timeout = None
+            if self.bot.timeout is not sentinel and timeout is not None:
+                request_timeout = ClientTimeout(
+                    total=self.bot.timeout.total + timeout or 1
+                )
+            while self._polling:
+                try:
+                    with self.bot.request_timeout(request_timeout):
+                        updates = await self.bot.get_updates(
+                            limit=limit,
+                            offset=offset,
+                            timeout=timeout,
+                            allowed_updates=allowed_updates,
+                        )
+                except CancelledError:
+                    break
+                except Exception:
+                    exception("Cause exception while getting updates.")
+                    await sleep(error_sleep)
+                    continue
+                # Пачка, полученная после остановки, не подтверждена и
+                # придёт снова при следующем запуске
+                if updates and self._polling:
+                    offset = updates[-1].update_id + 1
+                    await self.process_updates(updates, fast)
+                if relax:
+                    await sleep(relax)
+        finally:
+            self._close_waiter.set_result(None)
+            info("Polling is stopped.")
@@ -1,23 +1,52 @@
-from os import getenv, mkdir
-from os.path import exists
+from asyncio import Lock as AsyncLock, get_running_loop, shield
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from csv import writer
+from gzip import GzipFile
+from io import StringIO
+from itertools import count
+from logging import info
+from os import getenv
+from random import choice
+from tempfile import TemporaryFile
+from threading import Lock
+from time import monotonic
 from dotenv import load_dotenv
 from psycopg2 import connect
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from psycopg2.extras import RealDictCursor
-from psycopg2.errors import UndefinedTable
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, quote_ident
+from psycopg2.extras import execute_values
+from scripts.cache import LRUCache
+from scripts.dedup import (
+    DuplicateJoke,
+    MinHashIndex,
+    bands,
+    minhash,
+    similarity,
+    textHash,
+)
+from scripts.events import jokeAdded
+from scripts.importer import prepareJokes, readJokes
+from scripts.metrics import TimedCursor
+from scripts.migrations import migrate
+from scripts.pool import ConnectionPool
+from scripts.sampler import IdSampler
+from scripts.write_behind import WriteBehind
 
 
 load_dotenv()
 
 
 class PostDatabase:
+    __pool = None
+    __pool_lock = Lock()
+    __executor = None
+    __migrated = False
+    __migrate_lock = Lock()
     __user = None
     __host = None
     __password = None
     __port = None
-    __connection = None
     _database = None
-    _cursor = None
 
     def __init__(self, database):
         self.__user = getenv("POSTGRES_USER")
@@ -26,275 +55,1042 @@ class PostDatabase:
         self.__port = getenv("POSTGRES_PORT")
         self._database = database.lower()
 
-    def _open(self):
-        self.__connection = connect(
+    def _pool(self):
+        """Общий для всех баз пул соединений"""
+        if PostDatabase.__pool is None:
+            with PostDatabase.__pool_lock:
+                if PostDatabase.__pool is None:
+                    PostDatabase.__pool = ConnectionPool(
+                        int(getenv("POSTGRES_POOL_MIN", 1)),
+                        int(getenv("POSTGRES_POOL_MAX", 10)),
+                        timeout=float(getenv("POSTGRES_POOL_TIMEOUT", 30)),
+                        user=self.__user,
+                        password=self.__password,
+                        host=self.__host,
+                        port=self.__port,
+                    )
+        return PostDatabase.__pool
+
+    def _connect(self):
+        """Отдельное соединение вне пула"""
+        connection = connect(
             user=self.__user,
             password=self.__password,
             host=self.__host,
             port=self.__port,
         )
-        self.__connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-        self._cursor = self.__connection.cursor(cursor_factory=RealDictCursor)
+        connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        return connection
+
+    def _getconn(self):
+        """Соединение из пула, перед первым запросом схема бд обновляется"""
+        pool = self._pool()
+        connection = pool.getconn()
+        if not PostDatabase.__migrated:
+            try:
+                with PostDatabase.__migrate_lock:
+                    if not PostDatabase.__migrated:
+                        migrate(connection)
+                        PostDatabase.__migrated = True
+            except BaseException:
+                pool.putconn(connection)
+                raise
+        return connection
+
+    @classmethod
+    def resetSchema(cls):
+        """Повторная проверка миграций при следующем обращении к бд"""
+        PostDatabase.__migrated = False
+
+    @contextmanager
+    def _cursor(self):
+        """Курсор на соединении из пула"""
+        connection = self._getconn()
+        try:
+            with connection.cursor(cursor_factory=TimedCursor) as cursor:
+                yield cursor
+        finally:
+            self._pool().putconn(connection)
+
+    def _executor(self):
+        """Общий пул потоков для блокирующих запросов"""
+        if PostDatabase.__executor is None:
+            with PostDatabase.__pool_lock:
+                if PostDatabase.__executor is None:
+                    threads = int(
+                        getenv(
+                            "POSTGRES_EXECUTOR_THREADS", getenv("POSTGRES_POOL_MAX", 10)
+                        )
+                    )
+                    PostDatabase.__executor = (
+                        ThreadPoolExecutor(threads, thread_name_prefix="postgres")
+                        if threads > 0
+                        else False
+                    )
+        return PostDatabase.__executor
+
+    def __call(self, func, args):
+        with self._cursor() as cursor:
+            return func(cursor, *args)
+
+    def __atomic(self, func, args):
+        with self._cursor() as cursor:
+            # Соединения пула в autocommit, транзакция открывается явно
+            cursor.execute("BEGIN")
+            try:
+                result = func(cursor, *args)
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+            return result
+
+    async def _blocking(self, func, *args):
+        """Выполнение блокирующей функции в пуле потоков"""
+        executor = self._executor()
+        if not executor:
+            return func(*args)
+        return await get_running_loop().run_in_executor(executor, func, *args)
+
+    async def _run(self, func, *args):
+        """Выполнение func(cursor, *args) в пуле потоков"""
+        return await self._blocking(self.__call, func, args)
+
+    async def _atomic(self, func, *args):
+        """Выполнение func(cursor, *args) в одной транзакции"""
+        return await self._blocking(self.__atomic, func, args)
+
+    async def _stream(self, query, params=None, size=1000):
+        """Выдача результата одного запроса пачками по size строк"""
+        connection = await self._blocking(self._getconn)
+        cursor = connection.cursor("stream", cursor_factory=TimedCursor, withhold=True)
+        try:
+            await self._blocking(cursor.execute, query, params)
+            while True:
+                rows = await self._blocking(cursor.fetchmany, size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            # Курсор WITH HOLD живёт на соединении до закрытия: закрыть его
+            # до возврата соединения в пул, даже если задачу отменили
+            await shield(self._blocking(self.__release, connection, cursor))
+
+    def __release(self, connection, cursor):
+        try:
+            cursor.close()
+        finally:
+            self._pool().putconn(connection)
 
-    def _close(self):
-        self.__connection.close()
+    async def _execute(self, query, params=None):
+        """Выполнение запроса без результата"""
+        await self._run(lambda cursor: cursor.execute(query, params))
+
+    async def _fetchone(self, query, params=None):
+        """Первая строка результата запроса"""
+
+        def fetchone(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchone()
+
+        return await self._run(fetchone)
+
+    async def _fetchall(self, query, params=None):
+        """Все строки результата запроса"""
+
+        def fetchall(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+        return await self._run(fetchall)
+
+    def poolStats(self):
+        """Статистика пула соединений"""
+        return self._pool().stats()
+
+    @classmethod
+    def closePool(cls):
+        """Закрытие пула соединений"""
+        with PostDatabase.__pool_lock:
+            if PostDatabase.__pool is not None:
+                PostDatabase.__pool.closeall()
+                PostDatabase.__pool = None
+            if PostDatabase.__executor:
+                PostDatabase.__executor.shutdown()
+            PostDatabase.__executor = None
 
 
 class Database(PostDatabase):
-    def __init__(self, database):
-        super(Database, self).__init__(database)
-        self._open()
-        self._cursor.execute(
-            "SELECT 1 FROM pg_catalog.pg_database WHERE datname = '%s'" % database
-        )
-        exists = self._cursor.fetchone()
-        if not exists:
-            self._cursor.execute("CREATE database %s" % database)
-        self._cursor.execute(
-            """CREATE TABLE IF NOT EXISTS users (
-                                id BIGSERIAL NOT NULL PRIMARY KEY,
-                                user_id BIGINT NOT NULL
-                            )"""
-        )
-        self._close()
+    _user_ids = LRUCache(int(getenv("USERS_CACHE_SIZE", 100000)))
+    _joke_ids = IdSampler()
+    _joke_ids_lock = None
+    _similarity = float(getenv("JOKES_SIMILARITY", 0.8))
+    _joke_counts = LRUCache(int(getenv("JOKES_COUNT_CACHE_SIZE", 100000)))
+    # Недавно выбранные шутки для ответа сверх лимита частоты
+    _recent_jokes = LRUCache(int(getenv("JOKES_RECENT_SIZE", 100)))
+    # Отложенная запись шуток: ещё не записанные шутки по хешу текста, их
+    # подписи под временными id и количество по авторам
+    _writer = None
+    _pending = {}
+    _pending_near = MinHashIndex(_similarity)
+    _pending_users = {}
+    _temp_ids = count(-1, -1)
+
+    async def _flushJokes(self, user_id=None):
+        """Запись отложенных шуток (только если среди них есть шутки user_id)"""
+        if Database._writer is None:
+            return
+        if user_id is None or user_id in self._pending_users:
+            await Database._writer.flush()
 
     async def userExists(self, user_id):
         """Проверка пользовотеля"""
-        self._open()
-        self._cursor.execute("SELECT * FROM users WHERE user_id = %d" % user_id)
-        result = self._cursor.fetchmany(1)
-        self._close()
-        if not bool(len(result)):
-            await self.userAdd(user_id)
+        rowid = await self.rowid(user_id)
+        # Пользователь, заблокировавший бота, снова нажал /start
+        await self._execute(
+            "UPDATE users SET blocked = FALSE WHERE id = %s AND blocked", (rowid,)
+        )
 
     async def userAdd(self, user_id):
         """Добавление пользователя"""
-        self._open()
-        self._cursor.execute("INSERT INTO users (user_id) VALUES (%d)" % user_id)
-        self._close()
+        await self._execute(
+            "INSERT INTO users (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING",
+            (user_id,),
+        )
 
     async def rowid(self, user_id):
-        """Поиск пользователя"""
-        await self.userExists(user_id)
-        self._open()
-        self._cursor.execute(
-            "SELECT row_number() over()  FROM users WHERE user_id = %d" % user_id
+        """Внутренний id пользователя, добавляет его при первом обращении"""
+        rowid = self._user_ids.get(user_id)
+        if rowid is not None:
+            return rowid
+
+        def resolve(cursor):
+            # Вставка только отсутствующего пользователя не тратит значения
+            # последовательности, поэтому id остаются плотными
+            for _ in range(2):
+                cursor.execute(
+                    """WITH found AS (
+                           SELECT id FROM users WHERE user_id = %(user_id)s
+                       ), inserted AS (
+                           INSERT INTO users (user_id)
+                           SELECT %(user_id)s WHERE NOT EXISTS (SELECT 1 FROM found)
+                           ON CONFLICT (user_id) DO NOTHING
+                           RETURNING id
+                       )
+                       SELECT id FROM found UNION ALL SELECT id FROM inserted""",
+                    {"user_id": user_id},
+                )
+                row = cursor.fetchone()
+                if row is not None:
+                    return row["id"]
+            raise LookupError(f"Не удалось найти пользователя {user_id}")
+
+        rowid = await self._run(resolve)
+        self._user_ids.put(user_id, rowid)
+        return rowid
+
+    @staticmethod
+    def _lockHashes(cursor, digests):
+        """Блокировки транзакции на хеши текстов шуток"""
+        keys = sorted(
+            {int.from_bytes(digest[:8], "big", signed=True) for digest in digests}
+        )
+        cursor.execute(
+            """SELECT pg_advisory_xact_lock(key)
+               FROM unnest(%s::BIGINT[]) WITH ORDINALITY AS k (key, n) ORDER BY n""",
+            (keys,),
         )
-        result = self._cursor.fetchone()["row_number"]
-        self._close()
-        return result
 
+    @staticmethod
+    def _windowFloor(position):
+        """Граница окна id, которое перечитывается при подгрузке"""
+        if position is None:
+            return 0
+        return max(position - int(getenv("JOKES_SAMPLER_WINDOW", 10000)), 0)
 
-class JokesDatabase(Database):
-    def __init__(self, database):
-        super(JokesDatabase, self).__init__(database)
-        self._open()
-        self._cursor.execute(
-            """CREATE TABLE IF NOT EXISTS jokes (
-                                    user_id INTEGER,
-                                    joke TEXT,
-                                    author TEXT
-                                )"""
+    def _similarJokes(self, cursor, signatures):
+        """id самой похожей записанной шутки для каждой подписи или None"""
+        keys = {
+            key for signature in signatures if signature for key in bands(signature)
+        }
+        if not keys:
+            return [None] * len(signatures)
+        cursor.execute(
+            "SELECT id, minhash FROM jokes WHERE minhash_bands && %s::BIGINT[]",
+            (list(keys),),
         )
-        self._close()
+        index = MinHashIndex(self._similarity)
+        for row in cursor.fetchall():
+            index.add(row["id"], bytes(row["minhash"]))
+        return [next(iter(index.find(signature)), None) for signature in signatures]
+
+    async def backfillJokes(self, batch=1000):
+        """Отпечатки шуток, записанных до их появления, возвращает количество"""
+
+        def backfill(cursor):
+            cursor.execute(
+                """SELECT id, joke FROM jokes WHERE text_hash IS NULL
+                   ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED""",
+                (batch,),
+            )
+            rows = [
+                (row["id"], textHash(row["joke"] or ""), minhash(row["joke"] or ""))
+                for row in cursor.fetchall()
+            ]
+            if rows:
+                execute_values(
+                    cursor,
+                    """UPDATE jokes SET text_hash = v.text_hash, minhash = v.minhash
+                       FROM (VALUES %s) v (id, text_hash, minhash)
+                       WHERE jokes.id = v.id""",
+                    rows,
+                    template="(%s, %s::BYTEA, %s::BYTEA)",
+                    page_size=batch,
+                )
+            return len(rows)
+
+        total = 0
+        while True:
+            done = await self._atomic(backfill)
+            total += done
+            if done < batch:
+                break
+        if total:
+            info("Досчитаны отпечатки %d шуток", total)
+        return total
+
+    def invalidateJokeCounts(self, *args):
+        """Сброс кеша счётчиков шуток (например, по NOTIFY jokes_counts)"""
+        self._joke_counts.clear()
+
+    def invalidateJokeIds(self, payload=None):
+        """Удаление id из выборки по NOTIFY joke_ids, без payload - сброс"""
+        if payload:
+            for id in payload.split(","):
+                self._joke_ids.discard(int(id))
+                self._recent_jokes.pop(int(id))
+        else:
+            self._joke_ids.reset()
+            self._recent_jokes.clear()
+
+    @staticmethod
+    def _notifyDeleted(cursor, ids=None):
+        """NOTIFY joke_ids об удалённых шутках, None - удалены все"""
+        payload = ",".join(map(str, ids or ()))
+        # Длинный список не влезет в payload (до 8000 байт), тогда сброс
+        if ids is None or len(payload) > 7900:
+            payload = ""
+        elif not payload:
+            return
+        cursor.execute("SELECT pg_notify('joke_ids', %s)", (payload,))
+
+
+class JokesDatabase(Database):
+    _trigram = None
+
+    def startWriteBehind(self, size=100, interval=0.2):
+        """Включение отложенной записи шуток пачками (см. recordJoke)"""
+        if Database._writer is None:
+            Database._writer = WriteBehind(
+                self._writeJokes, size, interval, drop=self._unbufferJoke
+            )
+
+    async def stopWriteBehind(self):
+        """Запись отложенных шуток и выключение отложенной записи"""
+        writer = Database._writer
+        if writer is not None:
+            await writer.close()
+            Database._writer = None
+
+    async def _refreshJokeIds(self):
+        """Подгрузка id новых шуток в выборку"""
+        sampler = self._joke_ids
+        interval = float(getenv("JOKES_SAMPLER_REFRESH", 60))
+        if (
+            sampler.position is not None
+            and not sampler.stale
+            and monotonic() - sampler.refreshed_at < interval
+        ):
+            return
+        if Database._joke_ids_lock is None:
+            Database._joke_ids_lock = AsyncLock()
+        async with Database._joke_ids_lock:
+            if sampler.position is not None and not sampler.stale:
+                if monotonic() - sampler.refreshed_at < interval:
+                    return
+            sampler.stale = False
+            sampler.refreshed_at = monotonic()
+            loaded = sampler.position
+            floor = self._windowFloor(loaded)
+
+            def load(cursor):
+                ids = []
+                with cursor.connection.cursor("joke_ids", withhold=True) as named:
+                    named.itersize = 100000
+                    named.execute(
+                        "SELECT id FROM jokes WHERE id > %s ORDER BY id", (floor,)
+                    )
+                    for (id,) in named:
+                        ids.append(id)
+                return ids
+
+            ids = await self._run(load)
+            if loaded is not None and sampler.position is None:
+                # Выборку сбросили во время загрузки: перезагрузить полностью
+                return
+            position = max(ids[-1] if ids else 0, sampler.position or 0)
+            sampler.merge(ids, self._windowFloor(position))
+            sampler.position = position
 
     async def recordJoke(self, joke, author, user_id):
-        """Запись шутки"""
+        """Запись шутки, возвращает новое количество шуток пользователя"""
         rowid = await self.rowid(user_id)
-        self._open()
-        self._cursor.execute(
-            "INSERT INTO jokes (user_id, joke, author) VALUES (%d, '%s', '%s')" % (rowid, joke, author)
-        )
-        self._cursor.execute(
-            "INSERT INTO newJokes (user_id, joke, author) VALUES (%d, '%s', '%s')" % (rowid, joke, author)
-        )
-        self._close()
+        digest, signature = textHash(joke), minhash(joke)
+        if Database._writer is not None:
+            return await self._bufferJoke(
+                (next(self._temp_ids), rowid, user_id, joke, author, digest, signature)
+            )
+
+        def record(cursor):
+            self._lockHashes(cursor, [digest])
+            cursor.execute(
+                "SELECT id FROM jokes WHERE text_hash = %s LIMIT 1", (digest,)
+            )
+            row = cursor.fetchone()
+            if row is not None:
+                raise DuplicateJoke(row["id"])
+            similar = self._similarJokes(cursor, [signature])[0]
+            if similar is not None:
+                raise DuplicateJoke(similar, exact=False)
+            cursor.execute(
+                """INSERT INTO jokes (user_id, joke, author, text_hash, minhash)
+                   VALUES (%s, %s, %s, %s, %s) RETURNING id""",
+                (rowid, joke, author, digest, signature),
+            )
+            joke_id = cursor.fetchone()["id"]
+            cursor.execute(
+                "INSERT INTO newJokes (user_id, joke, author) VALUES (%s, %s, %s)",
+                (rowid, joke, author),
+            )
+            cursor.execute(
+                """UPDATE users SET jokes_count = jokes_count + 1
+                   WHERE id = %s RETURNING jokes_count""",
+                (rowid,),
+            )
+            quantity = cursor.fetchone()["jokes_count"]
+            cursor.execute("NOTIFY new_jokes")
+            return joke_id, quantity
+
+        joke_id, quantity = await self._atomic(record)
+        self._joke_counts.put(user_id, quantity)
+        self._joke_ids.add(joke_id)
+        jokeAdded.set()
+        return quantity
+
+    def _checkPending(self, digest, signature):
+        """Проверка на дубликат среди шуток в буфере (их id отрицательные)"""
+        row = self._pending.get(digest)
+        if row is not None:
+            raise DuplicateJoke(row[0])
+        similar = self._pending_near.find(signature)
+        if similar:
+            raise DuplicateJoke(similar[0], exact=False)
+
+    async def _bufferJoke(self, row):
+        """Проверка шутки на дубликаты и постановка в очередь записи"""
+        temp, _, user_id, _, _, digest, signature = row
+        self._checkPending(digest, signature)
+
+        def check(cursor):
+            cursor.execute(
+                "SELECT id FROM jokes WHERE text_hash = %s LIMIT 1", (digest,)
+            )
+            found = cursor.fetchone()
+            if found is not None:
+                return found["id"], True
+            return self._similarJokes(cursor, [signature])[0], False
+
+        found, exact = await self._run(check)
+        if found is not None:
+            raise DuplicateJoke(found, exact=exact)
+        quantity = await self.quantityJokesUser(user_id) + 1
+        # Такую же шутку могли поставить в буфер, пока шли запросы
+        self._checkPending(digest, signature)
+        self._pending_near.add(temp, signature)
+        self._pending[digest] = row
+        self._pending_users[user_id] = self._pending_users.get(user_id, 0) + 1
+        self._joke_counts.put(user_id, quantity)
+        Database._writer.add(row)
+        return quantity
+
+    async def _writeJokes(self, rows):
+        """Запись пачки отложенных шуток одной транзакцией"""
+
+        def write(cursor):
+            self._lockHashes(cursor, [row[5] for row in rows])
+            inserted = execute_values(
+                cursor,
+                """INSERT INTO jokes (user_id, joke, author, text_hash, minhash)
+                   SELECT user_id, joke, author, text_hash, minhash
+                   FROM (VALUES %s) v (n, user_id, joke, author, text_hash, minhash)
+                   WHERE NOT EXISTS (SELECT FROM jokes j WHERE j.text_hash = v.text_hash)
+                   ORDER BY n
+                   RETURNING id, text_hash""",
+                [
+                    (n, rowid, joke, author, digest, signature)
+                    for n, (_, rowid, _, joke, author, digest, signature) in enumerate(
+                        rows
+                    )
+                ],
+                template="(%s, %s, %s, %s, %s::BYTEA, %s::BYTEA)",
+                page_size=len(rows),
+                fetch=True,
+            )
+            ids = [row["id"] for row in inserted]
+            cursor.execute(
+                """INSERT INTO newJokes (user_id, joke, author)
+                   SELECT user_id, joke, author FROM jokes WHERE id = ANY(%s)
+                   ORDER BY id""",
+                (ids,),
+            )
+            cursor.execute(
+                """UPDATE users SET jokes_count = jokes_count + added.quantity
+                   FROM (SELECT user_id, COUNT(*) AS quantity FROM jokes
+                         WHERE id = ANY(%s) GROUP BY user_id) added
+                   WHERE users.id = added.user_id
+                   RETURNING users.user_id, users.jokes_count""",
+                (ids,),
+            )
+            counts = cursor.fetchall()
+            cursor.execute("NOTIFY new_jokes")
+            return [(row["id"], bytes(row["text_hash"])) for row in inserted], counts
+
+        inserted, counts = await self._atomic(write)
+        for row in rows:
+            self._unbufferJoke(row)
+        # Шутки, которые успели записать другие процессы, пропущены, и
+        # счётчики их авторов перечитаются из бд
+        for row in counts:
+            self._joke_counts.put(
+                row["user_id"],
+                row["jokes_count"] + self._pending_users.get(row["user_id"], 0),
+            )
+        if len(inserted) < len(rows):
+            info("Пропущено дубликатов при записи: %d", len(rows) - len(inserted))
+        self._joke_ids.extend(id for id, _ in inserted)
+        jokeAdded.set()
+
+    def _unbufferJoke(self, row, error=None):
+        """Удаление шутки из учёта буфера после записи или отказа от неё"""
+        temp, _, user_id, _, _, digest, _ = row
+        self._pending_near.discard(temp)
+        del self._pending[digest]
+        self._pending_users[user_id] -= 1
+        if not self._pending_users[user_id]:
+            del self._pending_users[user_id]
+        self._joke_counts.pop(user_id)
 
     async def randomJoke(self):
         """Отправка рандомной шутки от пользователей бота"""
-        self._open()
-        self._cursor.execute("SELECT joke, author FROM jokes ORDER BY RANDOM() LIMIT 1")
-        records = self._cursor.fetchmany(1)
-        self._close()
-        if not bool(len(records)):
+        await self._refreshJokeIds()
+        for _ in range(3):
+            joke_id = self._joke_ids.choice()
+            if joke_id is None:
+                return "Нету шуток 😞, но ты можешь записать свою шутку 😉"
+            row = await self._fetchone(
+                "SELECT joke, author FROM jokes WHERE id = %s", (joke_id,)
+            )
+            if row is not None:
+                return self._recentJoke(joke_id, row)
+            # Шутку удалили в другом процессе
+            self._joke_ids.discard(joke_id)
+        # Выборка отстала от бд: перезагрузить её, а пока выбрать в бд
+        self._joke_ids.reset()
+        row = await self._fetchone(
+            "SELECT id, joke, author FROM jokes ORDER BY random() LIMIT 1"
+        )
+        if row is None:
             return "Нету шуток 😞, но ты можешь записать свою шутку 😉"
-        for row in records:
-            return f'{row["joke"]} Автор: {row["author"]}'
+        return self._recentJoke(row["id"], row)
+
+    def _recentJoke(self, joke_id, row):
+        text = f'{row["joke"]} Автор: {row["author"]}'
+        self._recent_jokes.put(joke_id, text)
+        return text
+
+    def recentJoke(self):
+        """Одна из недавно выбранных шуток без обращения к бд или None"""
+        texts = self._recent_jokes.values()
+        return choice(texts) if texts else None
 
     async def myJoke(self, user_id):
         """Просмотр своих шуток"""
-        rowid = await self.rowid(user_id)
-        self._open()
-        self._cursor.execute(
-            "SELECT joke, author FROM jokes WHERE user_id = '%s'" % rowid
-        )
-        records = self._cursor.fetchall()
-        self._close()
-        if not bool(len(records)):
+        page = await self.myJokesPage(user_id)
+        if page is None:
             return "Нету шуток 😞, но ты можешь записать свою шутку 😉"
-        msg = "".join(["%s\n\n" % row["joke"] for row in records])
-        return msg
+        return page["text"]
+
+    async def myJokesPage(self, user_id, after=None, before=None, limit=20, size=4096):
+        """Страница своих шуток или None, если шуток нет"""
+        rowid = await self.rowid(user_id)
+        await self._flushJokes(user_id)
+        if before is None:
+            records = await self._fetchall(
+                """SELECT id, joke FROM jokes WHERE user_id = %s AND id > %s
+                   ORDER BY id LIMIT %s""",
+                (rowid, after or 0, limit + 1),
+            )
+        else:
+            records = await self._fetchall(
+                """SELECT id, joke FROM jokes WHERE user_id = %s AND id < %s
+                   ORDER BY id DESC LIMIT %s""",
+                (rowid, before, limit + 1),
+            )
+        if not records:
+            return None
+        page, length = [], 0
+        for row in records[:limit]:
+            text = "%s\n\n" % row["joke"]
+            if page and length + len(text) > size:
+                break
+            page.append((row["id"], text[:size]))
+            length += len(text)
+        more = len(page) < len(records)
+        if before is not None:
+            page.reverse()
+        return {
+            "text": "".join(text for _, text in page),
+            "first": page[0][0],
+            "last": page[-1][0],
+            "prev": more if before is not None else after is not None,
+            "next": more if before is None else True,
+        }
+
+    async def searchJokes(self, query, offset=0, limit=5):
+        """Поиск шуток по тексту и автору"""
+        query = " ".join(query.split())
+
+        def search(cursor):
+            cursor.execute(
+                """SELECT id, joke, author
+                   FROM jokes, websearch_to_tsquery('russian', %s) query
+                   WHERE search @@ query
+                   ORDER BY ts_rank_cd(search, query) DESC, id DESC
+                   LIMIT %s OFFSET %s""",
+                (query, limit + 1, offset),
+            )
+            records = cursor.fetchall()
+            if records:
+                return records
+            if offset:
+                cursor.execute(
+                    """SELECT EXISTS (SELECT FROM jokes
+                       WHERE search @@ websearch_to_tsquery('russian', %s))""",
+                    (query,),
+                )
+                if cursor.fetchone()["exists"]:
+                    return records
+            if JokesDatabase._trigram is None:
+                cursor.execute("SELECT FROM pg_extension WHERE extname = 'pg_trgm'")
+                JokesDatabase._trigram = cursor.fetchone() is not None
+            pattern = "%%%s%%" % query.replace("\\", "\\\\").replace(
+                "%", "\\%"
+            ).replace("_", "\\_")
+            if JokesDatabase._trigram:
+                order = "word_similarity(%s, joke) DESC, id DESC"
+                params = (pattern, query, limit + 1, offset)
+            else:
+                order = "id DESC"
+                params = (pattern, limit + 1, offset)
+            cursor.execute(
+                f"""SELECT id, joke, author FROM jokes WHERE joke ILIKE %s
+                    ORDER BY {order} LIMIT %s OFFSET %s""",
+                params,
+            )
+            return cursor.fetchall()
+
+        records = await self._run(search)
+        return {"jokes": records[:limit], "next": len(records) > limit}
 
     async def quantityJokesUser(self, user_id):
         """Количество шуток у пользователя"""
-        rowid = await self.rowid(user_id)
-        self._open()
-        self._cursor.execute("SELECT COUNT(*) FROM jokes WHERE user_id = '%s'" % rowid)
-        result = self._cursor.fetchone()["count"]
-        self._close()
-        return result
+        quantity = self._joke_counts.get(user_id)
+        if quantity is not None:
+            return quantity
+        await self._flushJokes(user_id)
+        result = await self._fetchone(
+            "SELECT jokes_count FROM users WHERE user_id = %s", (user_id,)
+        )
+        # Если запись пачки не удалась, её шутки ещё в буфере
+        quantity = (result["jokes_count"] if result else 0) + self._pending_users.get(
+            user_id, 0
+        )
+        self._joke_counts.put(user_id, quantity)
+        return quantity
 
     async def deleteJokesUser(self, user_id):
         """Удаление своих шуток"""
         rowid = await self.rowid(user_id)
-        self._open()
-        self._cursor.execute("DELETE FROM jokes WHERE user_id = '%s'" % rowid)
-        self._close()
+        await self._flushJokes(user_id)
 
+        def delete(cursor):
+            cursor.execute(
+                "DELETE FROM jokes WHERE user_id = %s RETURNING id", (rowid,)
+            )
+            records = cursor.fetchall()
+            cursor.execute("UPDATE users SET jokes_count = 0 WHERE id = %s", (rowid,))
+            self._notifyDeleted(cursor, [row["id"] for row in records])
+            return records
 
-class NotificationsDatabase(Database):
-    def __init__(self, database):
-        super(NotificationsDatabase, self).__init__(database)
-        self._open()
-        self._cursor.execute(
-            """CREATE TABLE IF NOT EXISTS newJokes (
-                                user_id INTEGER,
-                                joke TEXT,
-                                author TEXT
-                            )"""
-        )
-        self._close()
+        records = await self._atomic(delete)
+        self._joke_counts.put(user_id, 0)
+        for row in records:
+            self._joke_ids.discard(row["id"])
+            self._recent_jokes.pop(row["id"])
 
-    def __del__(self):
-        self._open()
-        try:
-            self._cursor.execute("DELETE FROM newJokes")
-        except UndefinedTable:
-            raise Exception("Таблицы newJokes не существует")
-        self._close()
 
+class NotificationsDatabase(Database):
     async def newsJokesExists(self):
         """Проверка шуток"""
-        self._open()
-        self._cursor.execute("SELECT count(*) FROM newJokes")
-        result = self._cursor.fetchone()["count"]
-        self._close()
-        if result < 1:
+        result = await self._fetchone("SELECT count(*) FROM newJokes")
+        if result["count"] < 1:
             return False
         return True
 
     async def quantityUsers(self):
         """Количество пользователей"""
-        self._open()
-        self._cursor.execute("SELECT count(*) FROM users")
-        result = self._cursor.fetchone()["count"]
-        self._close()
-        return result
+        result = await self._fetchone("SELECT count(*) FROM users")
+        return result["count"]
 
     async def newsJoke(self):
         """Вывод последней шутки"""
-        self._open()
-        self._cursor.execute("SELECT * FROM newJokes LIMIT 1")
-        records = self._cursor.fetchmany(1)
-        self._close()
-        for row in records:
-            return row
+        return await self._fetchone("SELECT * FROM newJokes ORDER BY id LIMIT 1")
 
     async def infoId(self, id):
         """Просмотр пользователя"""
-        self._open()
-        self._cursor.execute("SELECT * FROM users WHERE id = %d" % id)
-        result = self._cursor.fetchone()["user_id"]
-        self._close()
-        return result
+        result = await self._fetchone("SELECT * FROM users WHERE id = %s", (id,))
+        return result["user_id"]
 
     async def deleteOldJoke(self):
         """Удаление старой шутки"""
-        self._open()
-        self._cursor.execute(
-            "DELETE FROM newJokes WHERE ctid IN (SELECT ctid FROM newJokes LIMIT 1)"
+        await self._execute(
+            "DELETE FROM newJokes WHERE id IN (SELECT id FROM newJokes ORDER BY id LIMIT 1)"
         )
-        self._close()
 
+    async def claimJoke(self, lease):
+        """Захват неразосланной шутки на lease секунд"""
+        return await self._fetchone(
+            """UPDATE newJokes SET lease_until = now() + %s * interval '1 second'
+               WHERE id = (
+                   SELECT id FROM newJokes
+                   WHERE lease_until IS NULL OR lease_until < now()
+                   ORDER BY id LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+               )
+               RETURNING *""",
+            (lease,),
+        )
 
-class AdminDatabase(Database):
-    def __init__(self, database):
-        super(AdminDatabase, self).__init__(database)
-        self._open()
-        self._cursor.execute(
-            """CREATE TABLE IF NOT EXISTS admins (
-                                user_id BIGINT,
-                                name TEXT,
-                                inviting BIGINT
-                            )"""
+    async def checkpointJoke(self, id, last_user_id, lease):
+        """Сохранение прогресса рассылки и продление аренды"""
+        await self._execute(
+            """UPDATE newJokes
+               SET last_user_id = GREATEST(last_user_id, %s),
+                   lease_until = now() + %s * interval '1 second'
+               WHERE id = %s""",
+            (last_user_id, lease, id),
         )
-        self._close()
+
+    async def releaseJoke(self, id):
+        """Освобождение шутки для другого процесса"""
+        await self._execute(
+            "UPDATE newJokes SET lease_until = NULL WHERE id = %s", (id,)
+        )
+
+    async def finishJoke(self, id):
+        """Удаление разосланной шутки"""
+        await self._execute("DELETE FROM newJokes WHERE id = %s", (id,))
+
+    def recipients(self, exclude=None, size=1000, after=0):
+        """Получатели рассылки с id больше after пачками по size строк"""
+        return self._stream(
+            """SELECT id, user_id FROM users
+               WHERE NOT blocked AND id IS DISTINCT FROM %s AND id > %s
+               ORDER BY id""",
+            (exclude, after),
+            size,
+        )
+
+    async def blockUsers(self, user_ids):
+        """Отметка пользователей, заблокировавших бота"""
+        await self._execute(
+            "UPDATE users SET blocked = TRUE WHERE user_id = ANY(%s)", (list(user_ids),)
+        )
+
+
+class AdminDatabase(Database):
+    _admins = None
 
     async def deleteJokes(self):
         """Удаление всех шуток"""
-        self._open()
-        self._cursor.execute("DELETE FROM jokes")
-        self._cursor.execute("DELETE FROM newJokes")
-        self._close()
+        await self._flushJokes()
+
+        def delete(cursor):
+            cursor.execute("DELETE FROM jokes")
+            cursor.execute("DELETE FROM newJokes")
+            cursor.execute("UPDATE users SET jokes_count = 0 WHERE jokes_count <> 0")
+            cursor.execute("NOTIFY jokes_counts")
+            self._notifyDeleted(cursor)
+
+        await self._atomic(delete)
+        self._joke_ids.clear()
+        self._recent_jokes.clear()
+        self.invalidateJokeCounts()
+
+    async def dedupeJokes(self):
+        """Удаление дубликатов среди записанных шуток"""
+        await self._flushJokes()
+        await self.backfillJokes()
+
+        def dedupe(cursor):
+            cursor.execute(
+                """DELETE FROM jokes a USING jokes b
+                   WHERE a.text_hash = b.text_hash AND a.id > b.id
+                   RETURNING a.id, a.user_id"""
+            )
+            rows = cursor.fetchall()
+            deleted = [row["id"] for row in rows]
+            users = [row["user_id"] for row in rows]
+            exact = len(deleted)
+            # Кандидаты - шутки с общей полосой MinHash, в памяти только они
+            cursor.execute(
+                """SELECT array_agg(id) AS ids FROM (
+                       SELECT id, unnest(minhash_bands) AS band FROM jokes
+                   ) b GROUP BY band HAVING count(*) > 1"""
+            )
+            mates = {}
+            for row in cursor.fetchall():
+                for id in row["ids"]:
+                    mates.setdefault(id, set()).update(row["ids"])
+            cursor.execute(
+                "SELECT id, user_id, minhash FROM jokes WHERE id = ANY(%s) ORDER BY id",
+                (list(mates),),
+            )
+            kept, near = {}, []
+            for row in cursor.fetchall():
+                signature = bytes(row["minhash"])
+                if any(
+                    similarity(signature, kept[id]) >= self._similarity
+                    for id in mates[row["id"]]
+                    if id in kept
+                ):
+                    near.append(row["id"])
+                    users.append(row["user_id"])
+                else:
+                    kept[row["id"]] = signature
+            cursor.execute("DELETE FROM jokes WHERE id = ANY(%s)", (near,))
+            users = list(set(users))
+            # Удалённые дубликаты не должны уйти в рассылку
+            cursor.execute(
+                """DELETE FROM newJokes n WHERE user_id = ANY(%s) AND NOT EXISTS (
+                       SELECT FROM jokes j WHERE j.user_id = n.user_id AND j.joke = n.joke
+                   )""",
+                (users,),
+            )
+            cursor.execute(
+                """UPDATE users SET jokes_count =
+                       (SELECT COUNT(*) FROM jokes WHERE jokes.user_id = users.id)
+                   WHERE id = ANY(%s)""",
+                (users,),
+            )
+            cursor.execute("NOTIFY jokes_counts")
+            self._notifyDeleted(cursor, deleted + near)
+            return deleted + near, exact
 
-    async def dump(self, user_id):
+        deleted, exact = await self._atomic(dedupe)
+        for id in deleted:
+            self._joke_ids.discard(id)
+            self._recent_jokes.pop(id)
+        self.invalidateJokeCounts()
+        near = len(deleted) - exact
+        return {"exact": exact, "near": near}
+
+    async def importJokes(
+        self, file, kind, user_id, author, broadcast=False, batch=1000
+    ):
+        """Массовый импорт шуток из файла, выдаёт прогресс после каждой пачки"""
+        rowid = await self.rowid(user_id)
+        await self._flushJokes()
+        rows = readJokes(file, kind, author)
+        progress = {"read": 0, "added": 0, "duplicates": 0, "invalid": 0, "errors": []}
+
+        def copy(cursor, jokes):
+            similar = self._similarJokes(cursor, [row[4] for row in jokes])
+            jokes = [row for row, found in zip(jokes, similar) if found is None]
+            if not jokes:
+                return []
+            buffer = StringIO()
+            csv = writer(buffer)
+            for _, joke, joke_author, digest, signature in jokes:
+                csv.writerow(
+                    (
+                        joke,
+                        joke_author,
+                        "\\x" + digest.hex(),
+                        signature and "\\x" + signature.hex(),
+                    )
+                )
+            buffer.seek(0)
+            cursor.execute(
+                """CREATE TEMP TABLE import_jokes (
+                       joke TEXT, author TEXT, text_hash BYTEA, minhash BYTEA
+                   ) ON COMMIT DROP"""
+            )
+            cursor.copy_expert("COPY import_jokes FROM STDIN WITH (FORMAT csv)", buffer)
+            self._lockHashes(cursor, [row[3] for row in jokes])
+            cursor.execute(
+                """INSERT INTO jokes (user_id, joke, author, text_hash, minhash)
+                   SELECT %s, joke, author, text_hash, minhash FROM import_jokes i
+                   WHERE NOT EXISTS (SELECT FROM jokes j WHERE j.text_hash = i.text_hash)
+                   RETURNING id, text_hash""",
+                (rowid,),
+            )
+            inserted = cursor.fetchall()
+            if inserted:
+                cursor.execute(
+                    "UPDATE users SET jokes_count = jokes_count + %s WHERE id = %s",
+                    (len(inserted), rowid),
+                )
+                if broadcast:
+                    cursor.execute(
+                        """INSERT INTO newJokes (user_id, joke, author)
+                           SELECT user_id, joke, author FROM jokes
+                           WHERE id = ANY(%s) ORDER BY id""",
+                        ([row["id"] for row in inserted],),
+                    )
+                    cursor.execute("NOTIFY new_jokes")
+            cursor.execute("NOTIFY jokes_counts")
+            return [(row["id"], bytes(row["text_hash"])) for row in inserted]
+
+        while True:
+            # Разбор и отпечатки считаются в пуле потоков, индекс - в цикле событий
+            jokes, errors = await self._blocking(prepareJokes, rows, batch)
+            if not jokes and not errors:
+                break
+            progress["read"] += len(jokes) + len(errors)
+            progress["invalid"] += len(errors)
+            progress["errors"].extend(errors[: 20 - len(progress["errors"])])
+            # Повторы из прошлых пачек уже в бд и отсеются при вставке
+            fresh, digests, seen = [], set(), MinHashIndex(self._similarity)
+            for row in jokes:
+                number, _, _, digest, signature = row
+                if digest in digests or seen.find(signature):
+                    continue
+                digests.add(digest)
+                seen.add(number, signature)
+                fresh.append(row)
+            inserted = await self._atomic(copy, fresh) if fresh else []
+            for id, _ in inserted:
+                self._joke_ids.add(id)
+            progress["added"] += len(inserted)
+            progress["duplicates"] += len(jokes) - len(inserted)
+            yield dict(progress)
+        self.invalidateJokeCounts()
+        if broadcast and progress["added"]:
+            jokeAdded.set()
+
+    async def dump(self, tables=("users", "jokes", "admins")):
         """Дамп бд"""
-        if not exists("sql/"):
-            mkdir("sql/")
-        self._open()
-        self._cursor.execute("SELECT * FROM users")
-        with open(f"sql\dump_users_{user_id}.sql", "w", encoding="utf 8") as file:
-            for row in self._cursor:
-                file.write("INSERT INTO users VALUES (" + str(row) + ");")
-
-        self._cursor.execute("SELECT * FROM jokes")
-        with open(f"sql\dump_jokes_{user_id}.sql", "w", encoding="utf 8") as file:
-            for row in self._cursor:
-                file.write("INSERT INTO jokes VALUES (" + str(row) + ");")
-
-        self._cursor.execute("SELECT * FROM admins")
-        with open(f"sql\dump_admins_{user_id}.sql", "w", encoding="utf 8") as file:
-            for row in self._cursor:
-                file.write("INSERT INTO admins VALUES (" + str(row) + ");")
-        self._close()
+
+        def dump(cursor):
+            # Все таблицы из одного снимка, даже если в бд идёт запись
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            buffer = TemporaryFile()
+            with GzipFile(fileobj=buffer, mode="wb") as archive:
+                archive.write(b"BEGIN;\n\n")
+                for table in tables:
+                    cursor.execute(
+                        """SELECT column_name, column_default FROM information_schema.columns
+                           WHERE table_schema = current_schema() AND table_name = %s
+                               AND is_generated = 'NEVER'
+                           ORDER BY ordinal_position""",
+                        (table,),
+                    )
+                    columns = cursor.fetchall()
+                    names = ", ".join(
+                        quote_ident(column["column_name"], cursor) for column in columns
+                    )
+                    copy = f"{quote_ident(table, cursor)} ({names})"
+                    archive.write(f"COPY {copy} FROM stdin;\n".encode())
+                    cursor.copy_expert(f"COPY {copy} TO STDOUT", archive)
+                    archive.write(b"\\.\n\n")
+                    for column in columns:
+                        if (column["column_default"] or "").startswith("nextval("):
+                            archive.write(
+                                cursor.mogrify(
+                                    "SELECT setval(pg_get_serial_sequence(%s, %s), "
+                                    "coalesce(max({0}), 0) + 1, false) FROM {1};\n\n".format(
+                                        quote_ident(column["column_name"], cursor),
+                                        quote_ident(table, cursor),
+                                    ),
+                                    (table, column["column_name"]),
+                                )
+                            )
+                archive.write(b"COMMIT;\n")
+            buffer.seek(0)
+            return buffer
+
+        return await self._atomic(dump)
+
+    async def loadAdmins(self):
+        """Загрузка id админов в память"""
+        records = await self._fetchall("SELECT user_id FROM admins")
+        AdminDatabase._admins = {row["user_id"] for row in records}
+
+    def invalidateAdmins(self, *args):
+        """Сброс загруженных админов, следующая проверка перечитает их из бд"""
+        AdminDatabase._admins = None
 
     async def adminExists(self, user_id):
         """Проверка админа"""
-        self._open()
-        self._cursor.execute("SELECT * FROM admins WHERE user_id = %d" % user_id)
-        result = self._cursor.fetchmany(1)
-        self._close()
-        return bool(len(result))
+        if AdminDatabase._admins is None:
+            await self.loadAdmins()
+        return user_id in AdminDatabase._admins
 
     async def nameAdminExists(self, name):
         """Проверка имени админа"""
-        self._open()
-        self._cursor.execute("SELECT * FROM admins WHERE name = '%s'" % name)
-        result = self._cursor.fetchmany(1)
-        self._close()
-        return bool(len(result))
+        result = await self._fetchone("SELECT 1 FROM admins WHERE name = %s", (name,))
+        return result is not None
 
     async def adminAdd(self, user_id, name, inviting):
         """Добавление админа"""
-        self._open()
-        self._cursor.execute(
-            "INSERT INTO admins (user_id, name, inviting) VALUES (%d, '%s', %d)" % (user_id, name, inviting)
-        )
-        self._close()
+
+        def add(cursor):
+            cursor.execute(
+                "INSERT INTO admins (user_id, name, inviting) VALUES (%s, %s, %s)",
+                (user_id, name, inviting),
+            )
+            cursor.execute("NOTIFY admins")
+
+        await self._run(add)
+        if AdminDatabase._admins is not None:
+            AdminDatabase._admins.add(user_id)
 
     async def adminDel(self, user_id):
         """Удаление админа"""
-        self._open()
-        self._cursor.execute("DELETE FROM admins WHERE user_id = '%s'" % user_id)
-        self._close()
+
+        def delete(cursor):
+            cursor.execute("DELETE FROM admins WHERE user_id = %s", (user_id,))
+            cursor.execute("NOTIFY admins")
+
+        await self._run(delete)
+        if AdminDatabase._admins is not None:
+            AdminDatabase._admins.discard(user_id)
 
     async def allAdmins(self):
         """Просмотр список админов"""
-        self._open()
-        self._cursor.execute(f"SELECT user_id, name, inviting FROM admins")
-        records = self._cursor.fetchall()
+        records = await self._fetchall("SELECT user_id, name, inviting FROM admins")
         msg = "".join(["id: %s, name: %s, inviting: %s\n\n" % (row["user_id"], row["name"], row["inviting"]) for row in records])
-        self._close()
         if not bool(len(msg)):
             return "Нету админов"
         return msg
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from time import monotonic
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from scripts.limiter import TokenBucket
+from scripts.metrics import throttled_requests
+
+
+def throttled(rate, burst=1, fallback=None):
+    """Ограничение частоты вызова обработчика одним пользователем
+
+    Обработчик вызывается не чаще rate раз в секунду, подряд - не больше
+    burst раз. Сверх лимита вызывается fallback(event), если он задан;
+    если он ничего не ответил (вернул ложь), пользователь получает одно
+    предупреждение на серию лишних запросов.
+    """
+
+    def decorator(handler):
+        handler.throttling = (rate, burst, fallback)
+        return handler
+
+    return decorator
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничение частоты обработчиков, помеченных @throttled
+
+    На каждую пару (пользователь, обработчик) заводится TokenBucket.
+    Вёдра лежат в OrderedDict в порядке последнего обращения, поэтому
+    учёт стоит O(1), а раз в evict_interval секунд с начала словаря
+    удаляются вёдра пользователей, молчавших дольше idle секунд.
+    """
+
+    def __init__(self, idle=600, evict_interval=60, notice="Не так быстро 🙂"):
+        super().__init__()
+        self._buckets = OrderedDict()
+        self._idle = idle
+        self._evict_interval = evict_interval
+        self._evicted_at = monotonic()
+        self._notice = notice
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def evict(self, now=None):
+        """Удаление вёдер пользователей, давно не обращавшихся к боту"""
+        now = monotonic() if now is None else now
+        self._evicted_at = now
+        while self._buckets:
+            key, (_, used, _) = next(iter(self._buckets.items()))
+            if now - used < self._idle:
+                break
+            self._buckets.popitem(last=False)
+
+    async def _throttle(self, event, user_id):
+        handler = current_handler.get()
+        settings = getattr(handler, "throttling", None)
+        if settings is None:
+            return
+        rate, burst, fallback = settings
+        now = monotonic()
+        if now - self._evicted_at >= self._evict_interval:
+            self.evict(now)
+        key = (user_id, handler.__name__)
+        entry = self._buckets.get(key)
+        if entry is None:
+            entry = self._buckets[key] = [TokenBucket(rate, burst), now, False]
+        else:
+            self._buckets.move_to_end(key)
+            entry[1] = now
+        if entry[0].try_acquire():
+            entry[2] = False
+            return
+        throttled_requests.inc(handler.__name__)
+        if fallback is not None and await fallback(event):
+            pass
+        elif isinstance(event, types.InlineQuery):
+            # Подсказки в inline-режиме просто не обновятся
+            pass
+        elif not entry[2]:
+            # Предупреждение одно на серию лишних нажатий
+            entry[2] = True
+            await event.answer(self._notice)
+        elif isinstance(event, types.CallbackQuery):
+            # Иначе у пользователя так и крутятся часики на кнопке
+            await event.answer()
+        raise CancelHandler()
+
+    async def on_process_message(self, message, data):
+        await self._throttle(message, message.from_user.id)
+
+    async def on_process_callback_query(self, call, data):
+        await self._throttle(call, call.from_user.id)
+
+    async def on_process_inline_query(self, inline_query, data):
+        await self._throttle(inline_query, inline_query.from_user.id)
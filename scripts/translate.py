@@ -0,0 +1,112 @@
+from asyncio import get_running_loop
+from hashlib import sha1
+from sqlite3 import connect
+from threading import Lock
+from googletrans import Translator
+from scripts.cache import LRUCache
+
+
+class TranslationCache:
+    """Переводы с кешем в памяти и на диске
+
+    Ключ - sha1 языка и исходного текста. Сначала проверяется LRU-кеш в
+    памяти, затем таблица sqlite в файле path, и только при промахе текст
+    уходит в googletrans. Переводчик синхронный, поэтому translate()
+    выполняется в пуле потоков. Кеш в памяти и sqlite общие для цикла
+    событий и потоков: LRU защищён _lock, sqlite - _db_lock, и ни один из
+    них не держится во время запроса к сети.
+    """
+
+    def __init__(self, path, size=1000, dest="ru", translator=None):
+        self._memory = LRUCache(size)
+        self._dest = dest
+        self._translator = translator or Translator()
+        self._lock = Lock()
+        self._db_lock = Lock()
+        # googletrans.Translator не рассчитан на вызовы из нескольких потоков
+        self._translator_lock = Lock()
+        self._db = connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, text TEXT)"
+        )
+        self._db.commit()
+
+    def _key(self, text):
+        return sha1(f"{self._dest}:{text}".encode()).hexdigest()
+
+    def get(self, text):
+        """Перевод из кеша или None"""
+        key = self._key(text)
+        with self._lock:
+            result = self._memory.get(key)
+        if result is not None:
+            return result
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT text FROM translations WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        with self._lock:
+            self._memory.put(key, row[0])
+        return row[0]
+
+    def put(self, text, translation):
+        key = self._key(text)
+        with self._lock:
+            self._memory.put(key, translation)
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO translations (key, text) VALUES (?, ?)",
+                (key, translation),
+            )
+            self._db.commit()
+
+    def translateSync(self, text):
+        """Перевод с обращением к сети только при промахе кеша"""
+        result = self.get(text)
+        if result is None:
+            with self._translator_lock:
+                result = self._translator.translate(text, dest=self._dest).text
+            self.put(text, result)
+        return result
+
+    async def translate(self, text):
+        with self._lock:
+            result = self._memory.get(self._key(text))
+        if result is not None:
+            return result
+        return await get_running_loop().run_in_executor(None, self.translateSync, text)
+
+    def close(self):
+        with self._db_lock:
+            self._db.close()
+
+
+def warm(path):
+    """Перевод всего корпуса pyjokes заранее"""
+    from pyjokes import get_jokes
+
+    cache = TranslationCache(path)
+    jokes = get_jokes(language="en", category="all")
+    translated = failed = 0
+    for joke in jokes:
+        if cache.get(joke) is not None:
+            continue
+        try:
+            cache.translateSync(joke)
+        except Exception as e:
+            failed += 1
+            print(f"Не удалось перевести: {e}")
+        else:
+            translated += 1
+    cache.close()
+    print(f"Шуток: {len(jokes)}, переведено: {translated}, ошибок: {failed}")
+
+
+if __name__ == "__main__":
+    from os import getenv
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    warm(getenv("TRANSLATIONS_PATH", "translations.sqlite3"))
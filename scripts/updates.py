@@ -0,0 +1,45 @@
+UPDATE_TYPES = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+    "callback_query",
+    "inline_query",
+    "chosen_inline_result",
+    "shipping_query",
+    "pre_checkout_query",
+    "poll_answer",
+    "my_chat_member",
+    "chat_member",
+    "chat_join_request",
+)
+
+
+def _fields(obj):
+    """Поля объекта Telegram: словарь из JSON или значения объекта aiogram"""
+    if obj is None or isinstance(obj, dict):
+        return obj or {}
+    return obj.values
+
+
+def chatId(update):
+    """Чат, к которому относится обновление (словарь из JSON или types.Update)
+
+    Для обновлений без чата (inline-запросы, ответы в опросах) берётся
+    пользователь, а если нет и его, то update_id.
+    """
+    update = _fields(update)
+    for key in UPDATE_TYPES:
+        event = _fields(update.get(key))
+        if not event:
+            continue
+        chat = _fields(event.get("chat")) or _fields(
+            _fields(event.get("message")).get("chat")
+        )
+        if chat:
+            return chat["id"]
+        user = _fields(event.get("from") or event.get("user"))
+        if user:
+            return user["id"]
+        break
+    return update.get("update_id", 0)
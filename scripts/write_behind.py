@@ -0,0 +1,119 @@
+from asyncio import Lock, create_task, gather, get_running_loop
+from logging import exception
+
+
+class WriteBehind:
+    """Буфер отложенной записи
+
+    Строки копятся в памяти и записываются пачкой через await write(rows):
+    как только набралось size строк, через interval секунд после первой
+    строки пачки или по flush()/close(). Записи идут по одной, строки,
+    добавленные во время записи, попадают в следующую пачку. Если запись
+    не удалась, строки возвращаются в буфер и повторяются со следующей
+    пачкой.
+
+    Строки пачки, не записанной retries раз подряд, пишутся по одной.
+    Если при этом другие строки записались, то не записанные отбрасываются
+    с вызовом drop(row, error), иначе (бд недоступна) ждут следующей попытки.
+    """
+
+    def __init__(self, write, size=100, interval=0.2, retries=3, drop=None):
+        self._write = write
+        self._size = size
+        self._interval = interval
+        self._retries = retries
+        self._drop = drop
+        self._rows = []
+        # Число неудачных записей строки по id(row)
+        self._attempts = {}
+        self._timer = None
+        self._lock = Lock()
+        self._tasks = set()
+        # Запись уже запущена и ещё не забрала строки
+        self._queued = False
+        self.written = 0
+        self.flushes = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self._size:
+            if not self._queued:
+                self._start()
+        elif self._timer is None:
+            self._timer = get_running_loop().call_later(self._interval, self._start)
+
+    def _start(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._queued = True
+        task = create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Запись накопленных строк, False - если запись не удалась"""
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._queued = False
+            if not self._rows:
+                return True
+            rows, self._rows = self._rows, []
+            attempts = self._attempts
+            if any(attempts.get(id(row), 0) >= self._retries for row in rows):
+                return await self._isolate(rows)
+            try:
+                await self._write(rows)
+            except Exception:
+                exception("Не удалось записать %d строк, повтор позже", len(rows))
+                for row in rows:
+                    attempts[id(row)] = attempts.get(id(row), 0) + 1
+                self._retry(rows)
+                return False
+            for row in rows:
+                attempts.pop(id(row), None)
+            self.written += len(rows)
+            self.flushes += 1
+            return True
+
+    async def _isolate(self, rows):
+        """Запись строк по одной, чтобы найти строки, которые не записываются"""
+        failed, written = [], 0
+        for row in rows:
+            try:
+                await self._write([row])
+            except Exception as error:
+                failed.append((row, error))
+                continue
+            self._attempts.pop(id(row), None)
+            written += 1
+        self.written += written
+        self.flushes += written
+        if failed and not written:
+            exception("Не удалось записать %d строк, повтор позже", len(rows))
+            self._retry([row for row, _ in failed])
+            return False
+        for row, error in failed:
+            self._attempts.pop(id(row), None)
+            exception("Строка не записывается и отброшена", exc_info=error)
+            if self._drop is not None:
+                self._drop(row, error)
+        return not failed
+
+    def _retry(self, rows):
+        self._rows[:0] = rows
+        if self._timer is None:
+            self._timer = get_running_loop().call_later(self._interval, self._start)
+
+    async def close(self):
+        """Запись всего, что осталось в буфере"""
+        await gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
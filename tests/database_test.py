@@ -1,5 +1,16 @@
+from asyncio import Event, create_task, sleep
+from gzip import decompress
+from io import BytesIO
 from unittest import IsolatedAsyncioTestCase
+from aiohttp import ClientError
+from aiogram.utils.exceptions import BotBlocked, RetryAfter
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 from scripts import AdminDatabase, NotificationsDatabase, JokesDatabase
+from scripts.broadcast import Broadcaster
+from scripts.dedup import DuplicateJoke, textHash
+from scripts.events import Signal
+from scripts.listener import PgListener
+from scripts.migrations import MIGRATIONS, migrate
 
 
 class Testing(AdminDatabase, NotificationsDatabase, JokesDatabase):
@@ -8,11 +19,31 @@ class Testing(AdminDatabase, NotificationsDatabase, JokesDatabase):
 
     async def clearDatabase(self):
         """Полная очистка бд"""
-        self._open()
-        self._cursor.execute(f"DROP TABLE users")
-        self._cursor.execute(f"DROP TABLE admins")
-        self._cursor.execute(f"DROP TABLE jokes")
-        self._close()
+        with self._cursor() as cursor:
+            cursor.execute(f"DROP TABLE users")
+            cursor.execute(f"DROP TABLE admins")
+            cursor.execute(f"DROP TABLE jokes")
+            cursor.execute("DROP TABLE schema_migrations")
+        self.resetSchema()
+        self._user_ids.clear()
+        self._joke_ids.reset()
+        self.invalidateAdmins()
+        self.invalidateJokeCounts()
+
+
+class FakeBot:
+    def __init__(self, blocked):
+        self.blocked = blocked
+        self.flood = True
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        if self.flood:
+            self.flood = False
+            raise RetryAfter(0)
+        if chat_id in self.blocked:
+            raise BotBlocked("Forbidden: bot was blocked by the user")
+        self.sent.append(chat_id)
 
 
 class TestDatabase(IsolatedAsyncioTestCase):
@@ -33,6 +64,23 @@ class TestDatabase(IsolatedAsyncioTestCase):
         self.assertEqual(await self.Testing.quantityJokesUser(1), 0)
         await self.Testing.clearDatabase()
 
+    async def test_JokeCounter(self):
+        await self.Testing.deleteJokes()
+        self.assertEqual(await self.Testing.quantityJokesUser(1), 0)
+        self.assertEqual(await self.Testing.recordJoke("Meow", "Cat", 1), 1)
+        self.assertEqual(await self.Testing.recordJoke("Woof", "Dog", 1), 2)
+        await self.Testing.recordJoke("Moo", "Cow", 2)
+        self.Testing.invalidateJokeCounts()
+        self.assertEqual(await self.Testing.quantityJokesUser(1), 2)
+        await self.Testing.deleteJokesUser(1)
+        self.assertEqual(await self.Testing.quantityJokesUser(1), 0)
+        self.Testing.invalidateJokeCounts()
+        self.assertEqual(await self.Testing.quantityJokesUser(1), 0)
+        self.assertEqual(await self.Testing.quantityJokesUser(2), 1)
+        await self.Testing.deleteJokes()
+        self.assertEqual(await self.Testing.quantityJokesUser(2), 0)
+        await self.Testing.clearDatabase()
+
     async def test_ReadWriteNotificationsDatabase(self):
         await self.Testing.deleteJokes()
         self.assertEqual(await self.Testing.newsJokesExists(), 0)
@@ -64,3 +112,519 @@ class TestDatabase(IsolatedAsyncioTestCase):
         self.assertEqual(await self.Testing.adminExists(1), 0)
         self.assertEqual(await self.Testing.allAdmins(), "Нету админов")
         await self.Testing.clearDatabase()
+
+    async def test_UserResolver(self):
+        self.assertEqual(await self.Testing.rowid(10), 1)
+        self.assertEqual(await self.Testing.rowid(20), 2)
+        self.Testing._user_ids.clear()
+        self.assertEqual(await self.Testing.rowid(20), 2)
+        await self.Testing.userAdd(10)
+        self.assertEqual(await self.Testing.quantityUsers(), 2)
+        await self.Testing.clearDatabase()
+
+    async def test_RandomJoke(self):
+        await self.Testing.deleteJokes()
+        for joke in ("Meow", "Woof", "Moo"):
+            await self.Testing.recordJoke(joke, "Cat", 1)
+        await self.Testing.recordJoke("Quack", "Duck", 2)
+        jokes = {await self.Testing.randomJoke() for _ in range(200)}
+        self.assertEqual(len(jokes), 4)
+        await self.Testing.deleteJokesUser(1)
+        self.assertEqual(await self.Testing.randomJoke(), "Quack Автор: Duck")
+        await self.Testing.deleteJokes()
+        await self.Testing.clearDatabase()
+
+    async def test_SamplerWindow(self):
+        await self.Testing.deleteJokes()
+        await self.Testing.recordJoke("Meow", "Cat", 1)
+        # Транзакция с меньшим id завершается после транзакции с большим
+        slow, fast = self.Testing._connect(), self.Testing._connect()
+        try:
+            with slow.cursor() as cursor:
+                cursor.execute("BEGIN")
+                cursor.execute(
+                    "INSERT INTO jokes (joke, author) VALUES ('Slow', 'Cat')"
+                )
+            with fast.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO jokes (joke, author) VALUES ('Fast', 'Cat')"
+                )
+            self.Testing._joke_ids.stale = True
+            await self.Testing._refreshJokeIds()
+            self.assertEqual(len(self.Testing._joke_ids), 2)
+            with slow.cursor() as cursor:
+                cursor.execute("COMMIT")
+        finally:
+            slow.close()
+            fast.close()
+        self.Testing._joke_ids.stale = True
+        await self.Testing._refreshJokeIds()
+        self.assertEqual(len(self.Testing._joke_ids), 3)
+        # Своя шутка добавляется сразу и не задваивается при подгрузке
+        await self.Testing.recordJoke("Woof", "Dog", 1)
+        self.Testing._joke_ids.stale = True
+        await self.Testing._refreshJokeIds()
+        self.assertEqual(len(self.Testing._joke_ids), 4)
+        jokes = {await self.Testing.randomJoke() for _ in range(200)}
+        self.assertEqual(len(jokes), 4)
+        await self.Testing.deleteJokes()
+        await self.Testing.clearDatabase()
+
+    async def test_SamplerInvalidation(self):
+        await self.Testing.deleteJokes()
+        await self.Testing.recordJoke("Meow", "Cat", 1)
+        await self.Testing.recordJoke("Woof", "Dog", 2)
+        woof = (
+            await self.Testing._fetchone("SELECT id FROM jokes WHERE joke = 'Woof'")
+        )["id"]
+        signal, payloads = Signal(), []
+        listener = PgListener("test")
+        listener.subscribe("joke_ids", payloads.append)
+        listener.subscribe("joke_ids", signal.set)
+        await listener.start()
+        self.assertTrue(await signal.wait(0))
+        await self.Testing.deleteJokesUser(2)
+        self.assertTrue(await signal.wait(5))
+        self.assertEqual(payloads[-1], str(woof))
+        await listener.stop()
+        # Другие процессы убирают удалённые id из своей выборки
+        await self.Testing.randomJoke()
+        self.Testing._joke_ids.add(woof)
+        self.Testing.invalidateJokeIds(payloads[-1])
+        self.assertEqual(len(self.Testing._joke_ids), 1)
+        # Отставшая выборка не стоит запроса на каждый удалённый id
+        self.Testing._joke_ids.reset()
+        self.Testing._joke_ids.position = 10**6 + 1000
+        self.Testing._joke_ids.extend(range(10**6, 10**6 + 1000))
+        self.assertEqual(await self.Testing.randomJoke(), "Meow Автор: Cat")
+        self.assertIsNone(self.Testing._joke_ids.position)
+        await self.Testing.randomJoke()
+        self.assertEqual(len(self.Testing._joke_ids), 1)
+        await self.Testing.deleteJokes()
+        await self.Testing.clearDatabase()
+
+    async def test_RecentJoke(self):
+        await self.Testing.deleteJokes()
+        self.assertIsNone(self.Testing.recentJoke())
+        await self.Testing.recordJoke("Meow", "Cat", 1)
+        await self.Testing.randomJoke()
+        self.assertEqual(self.Testing.recentJoke(), "Meow Автор: Cat")
+        await self.Testing.deleteJokesUser(1)
+        self.assertIsNone(self.Testing.recentJoke())
+        await self.Testing.clearDatabase()
+
+    async def test_Broadcast(self):
+        for user_id in range(1, 11):
+            await self.Testing.rowid(user_id)
+        bot = FakeBot(blocked={3})
+        broadcaster = Broadcaster(bot, self.Testing, rate=1000, concurrency=3, batch=4)
+        stats = await broadcaster.broadcast("Meow", exclude=1)
+        self.assertEqual(sorted(bot.sent), [2, 4, 5, 6, 7, 8, 9, 10])
+        self.assertEqual((stats["sent"], stats["blocked"], stats["failed"]), (8, 1, 0))
+        bot.sent.clear()
+        await broadcaster.broadcast("Meow")
+        self.assertEqual(sorted(bot.sent), [1, 2, 4, 5, 6, 7, 8, 9, 10])
+        await self.Testing.userExists(3)
+        batches = [rows async for rows in self.Testing.recipients(size=20)]
+        self.assertEqual(len(batches[0]), 10)
+        await self.Testing.clearDatabase()
+
+    async def test_ResumeBroadcast(self):
+        await self.Testing.deleteJokes()
+        await self.Testing.recordJoke("Meow", "Cat", 1)
+        for user_id in range(2, 7):
+            await self.Testing.rowid(user_id)
+        job = await self.Testing.claimJoke(60)
+        self.assertEqual(job["last_user_id"], 0)
+        self.assertIsNone(await self.Testing.claimJoke(60))
+        await self.Testing.checkpointJoke(job["id"], 3, 60)
+        await self.Testing.releaseJoke(job["id"])
+        job = await self.Testing.claimJoke(60)
+        self.assertEqual(job["last_user_id"], 3)
+        bot = FakeBot(blocked=set())
+        checkpoints = []
+
+        async def checkpoint(last_user_id):
+            checkpoints.append(last_user_id)
+            await self.Testing.checkpointJoke(job["id"], last_user_id, 60)
+
+        broadcaster = Broadcaster(bot, self.Testing, rate=1000, batch=2)
+        await broadcaster.broadcast(
+            "Meow",
+            exclude=job["user_id"],
+            after=job["last_user_id"],
+            checkpoint=checkpoint,
+        )
+        self.assertEqual(sorted(bot.sent), [4, 5, 6])
+        self.assertEqual(checkpoints[-1], 6)
+        await self.Testing.finishJoke(job["id"])
+        self.assertFalse(await self.Testing.newsJokesExists())
+        await self.Testing.clearDatabase()
+
+    async def test_BroadcastCheckpointFailure(self):
+        for user_id in range(1, 11):
+            await self.Testing.rowid(user_id)
+
+        class SlowBot(FakeBot):
+            async def send_message(self, chat_id, text):
+                await sleep(0.02)
+                self.sent.append(chat_id)
+
+        failures = [ConnectionError("нет соединения")]
+
+        async def flaky(last_user_id):
+            if failures:
+                raise failures.pop()
+
+        bot = SlowBot(blocked=set())
+        broadcaster = Broadcaster(
+            bot,
+            self.Testing,
+            concurrency=1,
+            checkpoint_interval=0.01,
+            checkpoint_timeout=1,
+        )
+        with self.assertLogs(level="ERROR"):
+            await broadcaster.broadcast("Meow", checkpoint=flaky)
+        self.assertEqual(len(bot.sent), 10)
+
+        async def broken(last_user_id):
+            raise ConnectionError("нет соединения")
+
+        bot = SlowBot(blocked=set())
+        broadcaster = Broadcaster(
+            bot,
+            self.Testing,
+            concurrency=1,
+            checkpoint_interval=0.01,
+            checkpoint_timeout=0.05,
+        )
+        with self.assertLogs(level="ERROR"), self.assertRaises(ConnectionError):
+            await broadcaster.broadcast("Meow", checkpoint=broken)
+        self.assertLess(len(bot.sent), 10)
+        await self.Testing.clearDatabase()
+
+    async def test_BroadcastSendError(self):
+        for user_id in range(1, 11):
+            await self.Testing.rowid(user_id)
+
+        class BrokenBot(FakeBot):
+            async def send_message(self, chat_id, text):
+                if chat_id == 4:
+                    raise ClientError("соединение сброшено")
+                if chat_id == 7 and self.hang:
+                    await Event().wait()
+                self.sent.append(chat_id)
+
+        checkpoints = []
+
+        async def checkpoint(last_user_id):
+            checkpoints.append(last_user_id)
+
+        bot = BrokenBot(blocked=set())
+        bot.hang = False
+        broadcaster = Broadcaster(
+            bot, self.Testing, rate=1000, concurrency=2, checkpoint_interval=0.01
+        )
+        with self.assertLogs(level="WARNING"):
+            stats = await broadcaster.broadcast("Meow", checkpoint=checkpoint)
+        self.assertEqual((stats["sent"], stats["failed"]), (9, 1))
+        self.assertEqual(checkpoints[-1], 10)
+        # Зависшая отправка не продлевает аренду бесконечно
+        checkpoints.clear()
+        bot = BrokenBot(blocked=set())
+        bot.hang = True
+        broadcaster = Broadcaster(
+            bot,
+            self.Testing,
+            rate=1000,
+            concurrency=1,
+            checkpoint_interval=0.01,
+            stall_timeout=0.05,
+        )
+        with self.assertLogs(level="WARNING"), self.assertRaises(TimeoutError):
+            await broadcaster.broadcast("Meow", checkpoint=checkpoint)
+        self.assertEqual(max(checkpoints), 6)
+        await self.Testing.clearDatabase()
+
+    async def test_NotifyNewJoke(self):
+        signal = Signal()
+        listener = PgListener("test")
+        listener.subscribe("new_jokes", signal.set)
+        await listener.start()
+        self.assertTrue(await signal.wait(0))
+        self.assertFalse(await signal.wait(0.1))
+        await self.Testing.recordJoke("Meow", "Cat", 1)
+        self.assertTrue(await signal.wait(5))
+        await listener.stop()
+        await self.Testing.deleteJokes()
+        await self.Testing.clearDatabase()
+
+    async def test_AdminRegistry(self):
+        await self.Testing.adminAdd(1, "Cat", 1)
+        self.assertTrue(await self.Testing.adminExists(1))
+        await self.Testing._execute("INSERT INTO admins VALUES (2, 'Dog', 1)")
+        self.assertFalse(await self.Testing.adminExists(2))
+        self.Testing.invalidateAdmins()
+        self.assertTrue(await self.Testing.adminExists(2))
+        await self.Testing.adminDel(2)
+        self.assertFalse(await self.Testing.adminExists(2))
+        await self.Testing.clearDatabase()
+
+    async def test_Dump(self):
+        await self.Testing.deleteJokes()
+        await self.Testing.recordJoke("Meow\tpurr", "Cat's", 1)
+        await self.Testing.adminAdd(1, "Cat", 1)
+        archive = await self.Testing.dump()
+        sql = decompress(archive.read()).decode()
+        archive.close()
+        self.assertTrue(sql.startswith("BEGIN;"))
+        self.assertIn(
+            'COPY "users" ("id", "user_id", "blocked", "jokes_count") FROM stdin;\n1\t1\tf\t1\n\\.',
+            sql,
+        )
+        self.assertIn("Meow\\tpurr\tCat's", sql)
+        self.assertIn(
+            'COPY "admins" ("user_id", "name", "inviting") FROM stdin;\n1\tCat\t1\n',
+            sql,
+        )
+        self.assertTrue(sql.endswith("COMMIT;\n"))
+        await self.Testing.deleteJokes()
+        await self.Testing.clearDatabase()
+
+    async def test_MyJokesPage(self):
+        await self.Testing.deleteJokes()
+        for i in range(5):
+            await self.Testing.recordJoke(f"Joke {i}", "Cat", 1)
+        first = await self.Testing.myJokesPage(1, limit=2)
+        self.assertEqual(first["text"], "Joke 0\n\nJoke 1\n\n")
+        self.assertEqual((first["prev"], first["next"]), (False, True))
+        last = await self.Testing.myJokesPage(1, after=first["last"], limit=3)
+        self.assertEqual(last["text"], "Joke 2\n\nJoke 3\n\nJoke 4\n\n")
+        self.assertEqual((last["prev"], last["next"]), (True, False))
+        back = await self.Testing.myJokesPage(1, before=last["first"], limit=1)
+        self.assertEqual(back["text"], "Joke 1\n\n")
+        self.assertEqual((back["prev"], back["next"]), (True, True))
+        fit = await self.Testing.myJokesPage(1, size=20)
+        self.assertEqual(fit["text"], "Joke 0\n\nJoke 1\n\n")
+        self.assertTrue(fit["next"])
+        self.assertIsNone(await self.Testing.myJokesPage(2))
+        await self.Testing.deleteJokes()
+        await self.Testing.clearDatabase()
+
+    async def test_SearchJokes(self):
+        await self.Testing.deleteJokes()
+        await self.Testing.recordJoke("Кот сидит на окне", "Мурзик", 1)
+        await self.Testing.recordJoke("Собака и кошки", "Шарик", 1)
+        for i in range(3):
+            await self.Testing.recordJoke(f"Про котов {i}, котов и котиков", "Кот", 2)
+        found = await self.Testing.searchJokes("коты", limit=2)
+        self.assertEqual(found["jokes"][0]["joke"], "Про котов 2, котов и котиков")
+        self.assertTrue(found["next"])
+        rest = await self.Testing.searchJokes("коты", offset=2, limit=2)
+        self.assertEqual(len(rest["jokes"]), 2)
+        self.assertFalse(rest["next"])
+        author = await self.Testing.searchJokes("мурзика")
+        self.assertEqual(
+            [row["joke"] for row in author["jokes"]], ["Кот сидит на окне"]
+        )
+        # Часть слова полнотекстовый поиск не находит
+        short = await self.Testing.searchJokes("соба")
+        self.assertEqual([row["joke"] for row in short["jokes"]], ["Собака и кошки"])
+        partial = await self.Testing.searchJokes("бака и ко")
+        self.assertEqual([row["joke"] for row in partial["jokes"]], ["Собака и кошки"])
+        self.assertEqual((await self.Testing.searchJokes("100%"))["jokes"], [])
+        await self.Testing.deleteJokes()
+        await self.Testing.clearDatabase()
+
+    async def test_DuplicateJokes(self):
+        await self.Testing.deleteJokes()
+        joke = "Приходит мужик к врачу и говорит: доктор, у меня всё болит"
+        await self.Testing.recordJoke(joke, "Cat", 1)
+        with self.assertRaises(DuplicateJoke) as exact:
+            await self.Testing.recordJoke(joke.upper() + "!!!", "Dog", 2)
+        self.assertTrue(exact.exception.exact)
+        with self.assertRaises(DuplicateJoke) as near:
+            await self.Testing.recordJoke(joke + " и колет", "Dog", 2)
+        self.assertFalse(near.exception.exact)
+        self.assertEqual(await self.Testing.quantityJokesUser(2), 0)
+        await self.Testing.recordJoke("Meow", "Cat", 2)
+        # Шутки, записанные до появления отпечатков
+        with self.Testing._cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO jokes (user_id, joke, author) VALUES
+                   (2, 'meow.', 'Cat'), (2, %s, 'Dog'), (2, 'Woof', 'Dog')""",
+                (joke + " и колет",),
+            )
+            cursor.execute("UPDATE users SET jokes_count = 4 WHERE id = 2")
+            cursor.execute(
+                """INSERT INTO newJokes (user_id, joke, author)
+                   SELECT user_id, joke, author FROM jokes WHERE text_hash IS NULL"""
+            )
+        self.Testing.invalidateJokeCounts()
+        self.assertEqual(await self.Testing.dedupeJokes(), {"exact": 1, "near": 1})
+        # В рассылке и выборке остались только уцелевшие шутки
+        queued = await self.Testing._fetchall(
+            "SELECT joke FROM newJokes WHERE user_id = 2"
+        )
+        self.assertEqual(sorted(row["joke"] for row in queued), ["Meow", "Woof"])
+        self.Testing._joke_ids.stale = True
+        await self.Testing._refreshJokeIds()
+        self.assertEqual(len(self.Testing._joke_ids), 3)
+        self.assertEqual(await self.Testing.quantityJokesUser(2), 2)
+        self.assertEqual(await self.Testing.quantityJokesUser(1), 1)
+        with self.assertRaises(DuplicateJoke):
+            await self.Testing.recordJoke("Woof!", "Dog", 1)
+        await self.Testing.deleteJokes()
+        await self.Testing.clearDatabase()
+
+    async def test_ImportJokes(self):
+        await self.Testing.deleteJokes()
+        joke = "Приходит мужик к врачу и говорит: доктор, у меня всё болит"
+        await self.Testing.recordJoke("Meow", "Cat", 2)
+        lines = [
+            "joke,author",
+            "Meow!,Cat",
+            f"{joke},Doc",
+            f"{joke} и колет,Doc",
+            ",Nobody",
+        ]
+        lines += [f"Joke {i},Bench" for i in range(5)] + ["joke 1,Bench"]
+        file = BytesIO("\n".join(lines).encode())
+        progress = [
+            p async for p in self.Testing.importJokes(file, "csv", 1, "Admin", batch=4)
+        ]
+        self.assertEqual(len(progress), 3)
+        last = progress[-1]
+        self.assertEqual((last["read"], last["added"], last["invalid"]), (10, 6, 1))
+        self.assertEqual(last["duplicates"], 3)
+        self.assertEqual(last["errors"], [(5, "нет текста шутки")])
+        self.assertEqual(await self.Testing.quantityJokesUser(1), 6)
+        queued = "SELECT count(*) FROM newJokes"
+        self.assertEqual((await self.Testing._fetchone(queued))["count"], 1)
+        with self.assertRaises(DuplicateJoke):
+            await self.Testing.recordJoke("JOKE 3", "Cat", 2)
+        file = BytesIO('"Hello"\n'.encode())
+        with self.assertRaises(ValueError):
+            [p async for p in self.Testing.importJokes(file, "json", 1, "Admin")]
+        file = BytesIO("Woof\n\nQuack".encode())
+        async for _ in self.Testing.importJokes(
+            file, "txt", 1, "Admin", broadcast=True
+        ):
+            pass
+        self.assertEqual(await self.Testing.quantityJokesUser(1), 8)
+        self.assertEqual((await self.Testing._fetchone(queued))["count"], 3)
+        await self.Testing.deleteJokes()
+        await self.Testing.clearDatabase()
+
+    async def test_ImportLocks(self):
+        await self.Testing.deleteJokes()
+        await self.Testing.rowid(1)
+        # Параллельная запись той же шутки держит блокировку на её хеш
+        other = self.Testing._connect()
+        try:
+            with other.cursor() as cursor:
+                cursor.execute("BEGIN")
+                self.Testing._lockHashes(cursor, [textHash("Meow")])
+                file = BytesIO("Meow\n\nWoof".encode())
+                progress = self.Testing.importJokes(file, "txt", 1, "Admin")
+                importing = create_task(progress.__anext__())
+                await sleep(0.2)
+                self.assertFalse(importing.done())
+                cursor.execute(
+                    "INSERT INTO jokes (user_id, joke, author, text_hash) VALUES (1, 'Meow', 'Cat', %s)",
+                    (textHash("Meow"),),
+                )
+                cursor.execute("COMMIT")
+        finally:
+            other.close()
+        result = await importing
+        self.assertEqual((result["added"], result["duplicates"]), (1, 1))
+        await progress.aclose()
+        await self.Testing.deleteJokes()
+        await self.Testing.clearDatabase()
+
+    async def test_WriteBehind(self):
+        await self.Testing.deleteJokes()
+        self.Testing.startWriteBehind(size=100, interval=60)
+        try:
+            joke = "Приходит мужик к врачу и говорит: доктор, у меня всё болит"
+            self.assertEqual(await self.Testing.recordJoke(joke, "Cat", 1), 1)
+            self.assertEqual(await self.Testing.recordJoke("Meow", "Cat", 1), 2)
+            self.assertEqual(await self.Testing.recordJoke("Woof", "Dog", 2), 1)
+            with self.assertRaises(DuplicateJoke):
+                await self.Testing.recordJoke("meow!", "Dog", 2)
+            with self.assertRaises(DuplicateJoke) as near:
+                await self.Testing.recordJoke(joke + " и колет", "Dog", 2)
+            self.assertFalse(near.exception.exact)
+            # Похожая шутка ещё в буфере, в бд её нет
+            self.assertLess(near.exception.joke_id, 0)
+            count = "SELECT count(*) FROM jokes"
+            self.assertEqual((await self.Testing._fetchone(count))["count"], 0)
+            # Свои шутки автор видит сразу, шутки других пишутся той же пачкой
+            self.assertEqual(await self.Testing.myJoke(1), joke + "\n\nMeow\n\n")
+            self.assertEqual((await self.Testing._fetchone(count))["count"], 3)
+            self.assertEqual(await self.Testing.recordJoke("Moo", "Cow", 2), 2)
+            self.Testing.invalidateJokeCounts()
+            self.assertEqual(await self.Testing.quantityJokesUser(2), 2)
+            self.assertEqual(await self.Testing.recordJoke("Quack", "Duck", 3), 1)
+        finally:
+            await self.Testing.stopWriteBehind()
+        self.assertEqual((await self.Testing._fetchone(count))["count"], 5)
+        queued = "SELECT count(*) FROM newJokes"
+        self.assertEqual((await self.Testing._fetchone(queued))["count"], 5)
+        self.Testing.invalidateJokeCounts()
+        self.assertEqual(await self.Testing.quantityJokesUser(3), 1)
+        with self.assertRaises(DuplicateJoke):
+            await self.Testing.recordJoke("Quack", "Duck", 1)
+        await self.Testing.deleteJokes()
+        await self.Testing.clearDatabase()
+
+    async def test_ConnectionPool(self):
+        await self.Testing.recordJoke("Meow", "Cat", 1)
+        await self.Testing.randomJoke()
+        stats = self.Testing.poolStats()
+        self.assertEqual(stats["in_use"], 0)
+        self.assertEqual(stats["waiting"], 0)
+        self.assertLessEqual(stats["size"], stats["max"])
+        self.assertGreaterEqual(stats["idle"], 1)
+        # Транзакция, брошенная после явного BEGIN, откатывается при возврате
+        pool = self.Testing._pool()
+        connection = pool.getconn()
+        with connection.cursor() as cursor:
+            cursor.execute("BEGIN")
+            cursor.execute("SELECT pg_advisory_xact_lock(1)")
+        pool.putconn(connection)
+        connection = pool.getconn()
+        try:
+            self.assertEqual(
+                connection.get_transaction_status(), TRANSACTION_STATUS_IDLE
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory'"
+                )
+                self.assertEqual(cursor.fetchone()[0], 0)
+        finally:
+            pool.putconn(connection)
+        await self.Testing.deleteJokes()
+        await self.Testing.clearDatabase()
+
+    async def test_Migrations(self):
+        await self.Testing.recordJoke("Meow", "Cat", 1)
+        connection = self.Testing._connect()
+        try:
+            self.assertEqual(migrate(connection), [])
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM schema_migrations WHERE version = 6")
+                cursor.execute("UPDATE users SET jokes_count = 0")
+            # Повтор миграции на существующей схеме не ломает данные
+            self.assertEqual(migrate(connection), [6])
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT max(version) FROM schema_migrations")
+                self.assertEqual(cursor.fetchone()[0], MIGRATIONS[-1][0])
+        finally:
+            connection.close()
+        self.Testing.invalidateJokeCounts()
+        self.assertEqual(await self.Testing.quantityJokesUser(1), 1)
+        await self.Testing.clearDatabase()
@@ -0,0 +1,43 @@
+from unittest import TestCase
+from scripts.dedup import MinHashIndex, minhash, normalize, similarity, textHash
+
+JOKE = (
+    "Приходит мужик к врачу и говорит: доктор, у меня болит всё тело, "
+    "куда ни ткну пальцем. Врач осматривает его и говорит: у вас сломан палец."
+)
+
+
+class TestDedup(TestCase):
+    def test_Normalize(self):
+        self.assertEqual(normalize("  Ёжик,\nв_тумане!!! "), "ежик в тумане")
+        self.assertEqual(textHash("Ёжик в тумане"), textHash("ежик... В ТУМАНЕ"))
+        self.assertNotEqual(textHash("Ёжик в тумане"), textHash("Ёжик в лесу"))
+
+    def test_MinHash(self):
+        self.assertIsNone(minhash("Слишком короткая шутка"))
+        signature = minhash(JOKE)
+        self.assertEqual(similarity(signature, minhash(JOKE.upper())), 1.0)
+        self.assertGreaterEqual(
+            similarity(signature, minhash(JOKE.replace("мужик", "парень"))), 0.8
+        )
+        other = minhash(
+            "Совсем другая шутка про кота, который весь день смотрел в окно"
+        )
+        self.assertLess(similarity(signature, other), 0.5)
+
+    def test_Index(self):
+        index = MinHashIndex()
+        index.add(1, minhash(JOKE))
+        index.add(
+            2, minhash("Совсем другая шутка про кота, который весь день смотрел в окно")
+        )
+        index.add(3, None)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.find(minhash(JOKE.replace("сломан", "вывихнут"))), [1])
+        self.assertEqual(
+            index.find(minhash("Шутка про собаку, которая лаяла на почтальона")), []
+        )
+        index.discard(1)
+        self.assertEqual(index.find(minhash(JOKE)), [])
+        index.reset()
+        self.assertEqual(len(index), 0)
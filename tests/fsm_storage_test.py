@@ -0,0 +1,68 @@
+from asyncio import sleep
+from unittest import IsolatedAsyncioTestCase
+from scripts.fsm_storage import PostgresStorage
+
+
+class TestPostgresStorage(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.storage = PostgresStorage("test", flush_interval=0.01)
+
+    async def asyncTearDown(self):
+        await self.storage._execute("DROP TABLE fsm_states")
+        await self.storage._execute("DROP TABLE schema_migrations")
+        self.storage.resetSchema()
+
+    async def test_ReadWriteState(self):
+        await self.storage.set_state(chat=1, user=2, state="ClientRecord:joke")
+        await self.storage.update_data(chat=1, user=2, data={"quantity": 3})
+        await self.storage.update_data(chat=1, user=2, joke="Meow")
+        self.assertEqual(
+            await self.storage.get_state(chat=1, user=2), "ClientRecord:joke"
+        )
+        await self.storage.close()
+
+        storage = PostgresStorage("test")
+        self.assertEqual(await storage.get_state(chat=1, user=2), "ClientRecord:joke")
+        self.assertEqual(
+            await storage.get_data(chat=1, user=2), {"quantity": 3, "joke": "Meow"}
+        )
+        await storage.finish(chat=1, user=2)
+        await storage.close()
+        storage = PostgresStorage("test")
+        self.assertIsNone(await storage.get_state(chat=1, user=2))
+        self.assertEqual(await storage.get_data(chat=1, user=2), {})
+
+    async def test_ExpiredState(self):
+        await self.storage.set_state(chat=1, state="AddAdmin:name")
+        await self.storage.close()
+        storage = PostgresStorage("test", ttl=0)
+        self.assertIsNone(await storage.get_state(chat=1))
+
+    async def test_FlushDuringWrite(self):
+        run, calls = self.storage._run, []
+
+        async def slow(function, *args):
+            if function.__name__ != "write":
+                return await run(function, *args)
+            calls.append(function)
+            if len(calls) == 1:
+                await sleep(0.05)
+            if len(calls) == 2:
+                raise ConnectionError("bd недоступна")
+            return await run(function, *args)
+
+        self.storage._run = slow
+        await self.storage.set_state(chat=1, state="AddAdmin:name")
+        await sleep(0.03)
+        # Первая пачка ещё пишется, вторая сначала не запишется
+        await self.storage.set_state(chat=2, state="AddAdmin:name")
+        with self.assertLogs(level="ERROR"):
+            await sleep(0.1)
+        await sleep(1.2)
+        self.assertEqual(self.storage._dirty, {})
+        self.assertEqual(len(calls), 3)
+        row = await self.storage._fetchone(
+            "SELECT state FROM fsm_states WHERE chat_id = 2"
+        )
+        self.assertEqual(row["state"], "AddAdmin:name")
+        await self.storage.close()
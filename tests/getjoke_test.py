@@ -0,0 +1,112 @@
+from asyncio import get_running_loop, sleep, wait_for
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Event
+from types import SimpleNamespace
+from unittest import IsolatedAsyncioTestCase
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from scripts import getAnekdot
+from scripts.translate import TranslationCache
+
+
+class Testing(getAnekdot):
+    """Переводчик недоступен, анекдоты берутся только с локального сервера"""
+
+    async def Anekdot1(self):
+        raise ConnectionError("googletrans недоступен")
+
+
+class TestGetAnekdot(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = 0
+
+        async def page(request):
+            self.requests += 1
+            if self.requests == 1:
+                raise web.HTTPServiceUnavailable()
+            first = (self.requests - 2) * 2 + 1
+            return web.Response(
+                text=f'<div class="item_text">Анекдот {first}</div>'
+                f'<div class="other">Реклама</div>'
+                f'<div class="item_text">Анекдот {first + 1}</div>',
+                content_type="text/html",
+            )
+
+        app = web.Application()
+        app.router.add_get("/", page)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.Testing = Testing(size=3, low=2, url=str(self.server.make_url("/")))
+        self.Testing._http._backoff = 0.01
+
+    async def asyncTearDown(self):
+        await self.Testing.stop()
+        await self.server.close()
+
+    async def test_DirectFetch(self):
+        self.assertEqual(await self.Testing.getAnekdot(), "Анекдот 1")
+        self.assertEqual(self.requests, 2)
+
+    async def test_Prefetch(self):
+        await self.Testing.start()
+        await sleep(0.2)
+        self.assertEqual(self.requests, 3)
+        jokes = [self.Testing.popAnekdot() for _ in range(3)]
+        self.assertEqual(jokes, ["Анекдот 1", "Анекдот 2", "Анекдот 3"])
+        self.assertIsNone(self.Testing.popAnekdot())
+        await sleep(0.2)
+        self.assertEqual(self.Testing.popAnekdot(), "Анекдот 5")
+
+    async def test_Dedupe(self):
+        self.assertTrue(not self.Testing._isRecent("Анекдот"))
+        self.assertTrue(self.Testing._isRecent("Анекдот"))
+
+
+class FakeTranslator:
+    def __init__(self):
+        self.calls = 0
+
+    def translate(self, text, dest):
+        self.calls += 1
+        return SimpleNamespace(text=f"{dest}: {text}")
+
+
+class TestTranslationCache(IsolatedAsyncioTestCase):
+    async def test_Cache(self):
+        with TemporaryDirectory() as directory:
+            path = join(directory, "translations.sqlite3")
+            translator = FakeTranslator()
+            cache = TranslationCache(path, translator=translator)
+            self.assertEqual(await cache.translate("Joke"), "ru: Joke")
+            self.assertEqual(await cache.translate("Joke"), "ru: Joke")
+            self.assertEqual(translator.calls, 1)
+            cache.close()
+
+            cache = TranslationCache(path, translator=translator)
+            self.assertEqual(await cache.translate("Joke"), "ru: Joke")
+            self.assertEqual(translator.calls, 1)
+            cache.close()
+
+    async def test_LookupDuringTranslation(self):
+        started, release = Event(), Event()
+
+        class SlowTranslator(FakeTranslator):
+            def translate(self, text, dest):
+                started.set()
+                release.wait(5)
+                return super().translate(text, dest)
+
+        with TemporaryDirectory() as directory:
+            path = join(directory, "translations.sqlite3")
+            cache = TranslationCache(path, size=1, translator=SlowTranslator())
+            cache.put("Joke", "Шутка")
+            cache.put("Other", "Другая")
+            slow = get_running_loop().run_in_executor(None, cache.translateSync, "Slow")
+            started.wait(5)
+            # Промах памяти при идущем запросе к сети не ждёт перевода
+            lookup = get_running_loop().run_in_executor(None, cache.get, "Joke")
+            self.assertEqual(await wait_for(lookup, 1), "Шутка")
+            release.set()
+            self.assertEqual(await slow, "ru: Slow")
+            cache.close()
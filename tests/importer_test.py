@@ -0,0 +1,61 @@
+from io import BytesIO
+from unittest import TestCase
+from scripts.importer import prepareJokes, readJokes
+
+
+def read(data, kind, size=100):
+    return prepareJokes(readJokes(BytesIO(data.encode()), kind, "Импорт"), size)
+
+
+class TestImporter(TestCase):
+    def test_Txt(self):
+        jokes, errors = read("Первая\nшутка\n\n\n  \nВторая шутка\n", "txt")
+        self.assertEqual(
+            [row[:3] for row in jokes],
+            [(1, "Первая\nшутка", "Импорт"), (6, "Вторая шутка", "Импорт")],
+        )
+        self.assertEqual(errors, [])
+
+    def test_Csv(self):
+        jokes, errors = read('joke,author\n"Мяу,\nмяу",Кот\n,Пёс\nГав,\n', "csv")
+        self.assertEqual(
+            [row[:3] for row in jokes], [(3, "Мяу,\nмяу", "Кот"), (5, "Гав", "Импорт")]
+        )
+        self.assertEqual(errors, [(4, "нет текста шутки")])
+        with self.assertRaises(ValueError):
+            read("text\nМяу\n", "csv")
+
+    def test_Json(self):
+        data = '[\n"Мяу", {"joke": "Гав", "author": "Пёс"}, {"author": "Кот"}, 5\n]'
+        jokes, errors = read(data, "json")
+        self.assertEqual(
+            [row[:3] for row in jokes], [(1, "Мяу", "Импорт"), (2, "Гав", "Пёс")]
+        )
+        self.assertEqual([number for number, _ in errors], [3, 4])
+        with self.assertRaises(ValueError):
+            read('["Мяу", "Гав"', "json")
+        with self.assertRaises(ValueError):
+            read('{"joke": "Мяу"}', "json")
+
+    def test_JsonChunks(self):
+        rows = readJokes(
+            BytesIO(
+                (
+                    '["' + '", "'.join("шутка %d" % i for i in range(5000)) + '"]'
+                ).encode()
+            ),
+            "json",
+            "Импорт",
+        )
+        first, _ = prepareJokes(rows, 3000)
+        rest, _ = prepareJokes(rows, 3000)
+        self.assertEqual((len(first), len(rest)), (3000, 2000))
+        self.assertEqual(rest[-1][1], "шутка 4999")
+        self.assertEqual(prepareJokes(rows, 3000), ([], []))
+
+    def test_Jsonl(self):
+        jokes, errors = read('{"joke": "Мяу"}\n\nне json\n"Гав"\n', "jsonl")
+        self.assertEqual([row[:2] for row in jokes], [(1, "Мяу"), (4, "Гав")])
+        self.assertEqual(errors, [(3, "нет текста шутки")])
+        with self.assertRaises(ValueError):
+            read("Мяу", "docx")
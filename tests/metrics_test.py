@@ -0,0 +1,57 @@
+from unittest import IsolatedAsyncioTestCase
+from aiohttp import ClientSession
+from scripts.metrics import Counter, Histogram, Registry, queryTemplate, startServer
+
+
+class TestMetrics(IsolatedAsyncioTestCase):
+    def test_Histogram(self):
+        histogram = Histogram("test_seconds", "Test", ("name",), buckets=(0.1, 1))
+        for value in (0.05, 0.05, 0.5, 2):
+            histogram.observe(value, "a")
+        self.assertAlmostEqual(histogram.quantile(0.5, "a"), 0.1)
+        self.assertEqual(histogram.quantile(0.5, "b"), 0.0)
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{name="a",le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{name="a",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{name="a"} 4', lines)
+
+    def test_QueryTemplate(self):
+        self.assertEqual(
+            queryTemplate("SELECT id\n   FROM jokes WHERE id > %s"),
+            "SELECT id FROM jokes WHERE id > %s",
+        )
+        self.assertEqual(
+            queryTemplate(b"INSERT INTO t (a, b) VALUES (1, 'x'),(2, 'it''s')"),
+            "INSERT INTO t (a, b) VALUES (?, ?), ...",
+        )
+        # Большая пачка execute_values: шаблон по началу, без данных
+        rows = ",".join(
+            f"({i}, 'шутка {i}', '\\x00'::bytea, NULL)" for i in range(10000)
+        )
+        query = f"INSERT INTO jokes (id, joke) VALUES {rows} RETURNING id".encode()
+        self.assertEqual(
+            queryTemplate(query),
+            "INSERT INTO jokes (id, joke) VALUES (?, ?, ?::bytea, NULL), ...",
+        )
+        self.assertEqual(
+            queryTemplate(b"INSERT INTO jokes (joke) VALUES ('" + b"x" * 5000 + b"')"),
+            "INSERT INTO jokes (joke) VALUES (?",
+        )
+
+    async def test_Server(self):
+        registry = Registry()
+        counter = registry.register(Counter("test_total", "Test", ("result",)))
+        counter.inc("sent")
+        counter.inc("sent")
+        runner = await startServer("127.0.0.1", 0)
+        port = runner.addresses[0][1]
+        try:
+            async with ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                    text = await response.text()
+        finally:
+            await runner.cleanup()
+        self.assertIn("# TYPE bot_handler_seconds histogram", text)
+        self.assertEqual(
+            registry.render().splitlines()[-1], 'test_total{result="sent"} 2'
+        )
@@ -0,0 +1,163 @@
+from asyncio import Event, create_task, sleep
+from unittest import IsolatedAsyncioTestCase
+from aiogram import Bot, Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher import FSMContext
+from scripts.scheduler import ChatDispatcher, ChatScheduler
+
+
+class TestChatScheduler(IsolatedAsyncioTestCase):
+    async def test_OrderWithinChat(self):
+        done, running = [], set()
+        peak = []
+
+        async def handler(update):
+            chat, i = update
+            running.add(chat)
+            peak.append(len(running))
+            await sleep(0.01 if i % 2 else 0)
+            running.discard(chat)
+            done.append(update)
+
+        scheduler = ChatScheduler(handler, concurrency=3)
+        for i in range(5):
+            for chat in range(6):
+                await scheduler.submit(chat, (chat, i))
+        await scheduler.join()
+        self.assertEqual(len(done), 30)
+        for chat in range(6):
+            self.assertEqual([i for c, i in done if c == chat], list(range(5)))
+        self.assertEqual(max(peak), 3)
+        self.assertEqual(scheduler.stats()["processed"], 30)
+        self.assertEqual(scheduler.stats()["pending"], 0)
+
+    async def test_Backpressure(self):
+        release = []
+
+        async def handler(update):
+            while not release:
+                await sleep(0.001)
+
+        scheduler = ChatScheduler(handler, chat_queue=2, pending=3)
+        await scheduler.submit(1, 1)
+        await scheduler.submit(1, 2)
+        blocked = create_task(scheduler.submit(1, 3))
+        await sleep(0.01)
+        self.assertFalse(blocked.done())
+        self.assertEqual(scheduler.stats()["max_chat_depth"], 2)
+        await scheduler.submit(2, 1)
+        self.assertEqual(scheduler.stats()["pending"], 3)
+        release.append(True)
+        await blocked
+        await scheduler.join()
+        self.assertEqual(scheduler.stats()["waits"], 1)
+
+    async def test_Dispatcher(self):
+        dp = ChatDispatcher(Bot("123456:" + "A" * 35), concurrency=10)
+        steps = []
+
+        async def handler(message: types.Message):
+            await sleep(0.01 if message.text == "1" else 0)
+            steps.append((message.chat.id, message.text))
+
+        dp.register_message_handler(handler)
+        updates = [
+            types.Update.to_object(
+                {
+                    "update_id": i,
+                    "message": {
+                        "message_id": i,
+                        "date": 0,
+                        "chat": {"id": i % 2 + 1, "type": "private"},
+                        "from": {"id": i % 2 + 1, "is_bot": False, "first_name": "A"},
+                        "text": str(i // 2),
+                    },
+                }
+            )
+            for i in range(6)
+        ]
+        await dp.process_updates(updates)
+        await dp.scheduler.join()
+        for chat in (1, 2):
+            self.assertEqual([t for c, t in steps if c == chat], ["0", "1", "2"])
+        await (await dp.bot.get_session()).close()
+
+    async def test_DispatcherStates(self):
+        dp = ChatDispatcher(Bot("123456:" + "A" * 35), storage=MemoryStorage())
+        Dispatcher.set_current(dp)
+        steps = []
+
+        async def first(message: types.Message, state: FSMContext):
+            steps.append("first")
+            await state.set_state("second")
+
+        async def second(message: types.Message, state: FSMContext):
+            steps.append("second")
+            await state.finish()
+
+        dp.register_message_handler(first)
+        dp.register_message_handler(second, state="second")
+        updates = [
+            types.Update.to_object(
+                {
+                    "update_id": i,
+                    "message": {
+                        "message_id": i,
+                        "date": 0,
+                        "chat": {"id": 1, "type": "private"},
+                        "from": {"id": 1, "is_bot": False, "first_name": "A"},
+                        "text": "Meow",
+                    },
+                }
+            )
+            for i in range(4)
+        ]
+        # Все обновления чата разбирает одна задача очереди
+        await dp.process_updates(updates)
+        await dp.scheduler.join()
+        self.assertEqual(steps, ["first", "second", "first", "second"])
+        await (await dp.bot.get_session()).close()
+
+    async def test_PollingBackpressure(self):
+        dp = ChatDispatcher(
+            Bot("123456:" + "A" * 35), storage=MemoryStorage(), pending=2
+        )
+        release, handled, calls = Event(), [], []
+
+        async def handler(message: types.Message):
+            await release.wait()
+            handled.append(message.message_id)
+
+        async def get_updates(offset=None, **kwargs):
+            calls.append(offset)
+            await sleep(0)
+            start = offset or 1
+            return [update(i) for i in range(start, start + 2)]
+
+        def update(i):
+            return types.Update.to_object(
+                {
+                    "update_id": i,
+                    "message": {
+                        "message_id": i,
+                        "date": 0,
+                        "chat": {"id": i, "type": "private"},
+                        "from": {"id": i, "is_bot": False, "first_name": "A"},
+                        "text": "Meow",
+                    },
+                }
+            )
+
+        dp.register_message_handler(handler)
+        dp.bot.get_updates = get_updates
+        polling = create_task(dp.start_polling(relax=0, reset_webhook=False))
+        await sleep(0.05)
+        # Первая пачка заняла очередь, вторая ждёт места, третьей не запрашивали
+        self.assertEqual(calls, [None, 3])
+        dp.stop_polling()
+        release.set()
+        await dp.drain()
+        await dp.scheduler.join()
+        await polling
+        self.assertEqual(sorted(handled), [1, 2, 3, 4])
+        await (await dp.bot.get_session()).close()
@@ -0,0 +1,69 @@
+from unittest import IsolatedAsyncioTestCase
+from aiogram import Bot, Dispatcher, types
+from scripts.throttling import ThrottlingMiddleware, throttled
+
+
+def message(i, user_id, text):
+    return types.Update.to_object(
+        {
+            "update_id": i,
+            "message": {
+                "message_id": i,
+                "date": 0,
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "A"},
+                "text": text,
+            },
+        }
+    )
+
+
+class TestThrottling(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dp = Dispatcher(Bot("123456:" + "A" * 35))
+        self.throttling = ThrottlingMiddleware(idle=60)
+        self.dp.middleware.setup(self.throttling)
+
+    async def asyncTearDown(self):
+        await (await self.dp.bot.get_session()).close()
+
+    async def test_Limit(self):
+        calls, fallbacks = [], []
+
+        async def fallback(message):
+            fallbacks.append(message.from_user.id)
+            return True
+
+        @throttled(0.001, 2, fallback=fallback)
+        async def heavy(message: types.Message):
+            calls.append(message.from_user.id)
+
+        async def light(message: types.Message):
+            calls.append("light")
+
+        self.dp.register_message_handler(heavy, text="heavy")
+        self.dp.register_message_handler(light, text="light")
+        for i in range(5):
+            await self.dp.process_update(message(i, 1, "heavy"))
+        await self.dp.process_update(message(5, 2, "heavy"))
+        for i in range(6, 10):
+            await self.dp.process_update(message(i, 1, "light"))
+        self.assertEqual(calls, [1, 1, 2] + ["light"] * 4)
+        self.assertEqual(fallbacks, [1, 1, 1])
+        self.assertEqual(len(self.throttling), 2)
+
+    async def test_Evict(self):
+        @throttled(1, 1)
+        async def heavy(message: types.Message):
+            pass
+
+        self.dp.register_message_handler(heavy)
+        for user_id in range(1, 4):
+            await self.dp.process_update(message(user_id, user_id, "heavy"))
+        self.assertEqual(len(self.throttling), 3)
+        buckets = self.throttling._buckets
+        used = buckets[(3, "heavy")][1]
+        self.throttling.evict(used + 30)
+        self.assertEqual(len(self.throttling), 3)
+        self.throttling.evict(used + 61)
+        self.assertEqual(len(self.throttling), 0)
@@ -0,0 +1,82 @@
+from asyncio import sleep
+from unittest import IsolatedAsyncioTestCase
+from scripts.write_behind import WriteBehind
+
+
+class TestWriteBehind(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.batches = []
+        self.failures = 0
+
+        async def write(rows):
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("нет соединения")
+            if 13 in rows:
+                raise ValueError("несчастливая строка")
+            self.batches.append(rows)
+
+        self.write = write
+
+    async def test_Size(self):
+        buffer = WriteBehind(self.write, size=3, interval=60)
+        for i in range(4):
+            buffer.add(i)
+        await sleep(0)
+        self.assertEqual(self.batches, [[0, 1, 2, 3]])
+        buffer.add(4)
+        self.assertEqual(len(buffer), 1)
+        await buffer.close()
+        self.assertEqual(self.batches[-1], [4])
+        self.assertEqual((buffer.written, buffer.flushes), (5, 2))
+
+    async def test_Interval(self):
+        buffer = WriteBehind(self.write, size=100, interval=0.01)
+        buffer.add(1)
+        buffer.add(2)
+        self.assertEqual(self.batches, [])
+        await sleep(0.05)
+        self.assertEqual(self.batches, [[1, 2]])
+        await buffer.close()
+
+    async def test_Retry(self):
+        buffer = WriteBehind(self.write, size=100, interval=0.01)
+        self.failures = 1
+        buffer.add(1)
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(await buffer.flush())
+        buffer.add(2)
+        await sleep(0.05)
+        self.assertEqual(self.batches, [[1, 2]])
+        self.assertTrue(await buffer.flush())
+        await buffer.close()
+
+    async def test_Drop(self):
+        dropped = []
+        buffer = WriteBehind(
+            self.write,
+            size=100,
+            interval=60,
+            retries=2,
+            drop=lambda row, error: dropped.append((row, str(error))),
+        )
+        buffer.add(1)
+        buffer.add(13)
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(await buffer.flush())
+            self.assertFalse(await buffer.flush())
+        self.assertEqual(len(buffer), 2)
+        # Бд недоступна: по одной тоже ничего не пишется, строки ждут
+        self.failures = 2
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(await buffer.flush())
+        self.assertEqual((len(buffer), dropped), (2, []))
+        buffer.add(2)
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(await buffer.flush())
+        self.assertEqual(dropped, [(13, "несчастливая строка")])
+        self.assertEqual(self.batches, [[1], [2]])
+        buffer.add(3)
+        self.assertTrue(await buffer.flush())
+        self.assertEqual(self.batches[-1], [3])
+        await buffer.close()
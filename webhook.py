@@ -0,0 +1,185 @@
+"""Запуск бота через вебхук с несколькими процессами-обработчиками
+
+Главный процесс принимает обновления от Telegram на aiohttp-сервере и
+раскладывает их по WEBHOOK_WORKERS процессам по номеру чата, так что
+все обновления одного чата попадают в один процесс и обрабатываются
+по порядку. Внутри процесса обновления разных чатов обрабатываются
+параллельно через ChatScheduler (до DISPATCH_CONCURRENCY сразу). При
+остановке сервер перестаёт принимать обновления, а процессы
+дорабатывают уже принятые.
+
+Запуск: python webhook.py
+"""
+from asyncio import create_task, gather, get_running_loop, run
+from concurrent.futures import ThreadPoolExecutor
+from logging import basicConfig, info, warning, INFO
+from multiprocessing import get_context, parent_process
+from os import cpu_count, environ, getenv
+from queue import Empty, Full
+from signal import SIGINT, SIGTERM, SIG_IGN, signal
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from scripts.updates import chatId
+
+load_dotenv()
+
+
+async def work(index, queue, ready):
+    """Обработка обновлений, которые главный процесс отдал этому процессу"""
+    from aiogram import Bot, Dispatcher, types
+    import main
+    from create_bot import dp
+    from scripts.notifications import scheduled
+
+    Dispatcher.set_current(dp)
+    Bot.set_current(dp.bot)
+    if getenv("METRICS_PORT"):
+        # Метрики каждого процесса на своём порту
+        environ["METRICS_PORT"] = str(int(getenv("METRICS_PORT")) + index)
+    await main.on_startup(dp)
+    ready.set()
+    notifier = None
+    if index == 0:
+        notifier = create_task(scheduled(int(getenv("NOTIFY_POLL_INTERVAL", 300))))
+
+    loop = get_running_loop()
+    reader = ThreadPoolExecutor(1)
+
+    def receive():
+        while True:
+            try:
+                return queue.get(timeout=1)
+            except Empty:
+                if not parent_process().is_alive():
+                    return None
+
+    while True:
+        update = await loop.run_in_executor(reader, receive)
+        if update is None:
+            break
+        # Пока очереди планировщика полны, новые обновления остаются в queue
+        await dp.scheduler.submit(chatId(update), types.Update.to_object(update))
+
+    info(
+        "Процесс %s дорабатывает %s обновлений", index, dp.scheduler.stats()["pending"]
+    )
+    await dp.scheduler.join()
+    if notifier is not None:
+        notifier.cancel()
+        await gather(notifier, return_exceptions=True)
+    await main.on_shutdown(dp)
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    await (await dp.bot.get_session()).close()
+    reader.shutdown()
+
+
+def worker(index, queue, ready):
+    """Процесс-обработчик"""
+    # Останавливает главный процесс, чтобы сначала прекратить приём обновлений
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, SIG_IGN)
+    basicConfig(level=INFO)
+    run(work(index, queue, ready))
+
+
+async def handle(request):
+    """Приём обновления от Telegram"""
+    secret = request.app["secret"]
+    if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+        return web.Response(status=403)
+    update = await request.json()
+    queues = request.app["queues"]
+    queue = queues[chatId(update) % len(queues)]
+    try:
+        queue.put_nowait(update)
+    except Full:
+        # Обработчик не успевает: ждём места, пока Telegram ждёт ответа
+        try:
+            await get_running_loop().run_in_executor(
+                None, queue.put, update, True, request.app["put_timeout"]
+            )
+        except Full:
+            warning("Очередь обработчика переполнена, обновление отклонено")
+            return web.Response(status=503)
+    return web.Response()
+
+
+async def on_startup(app):
+    # Сервер начнёт принимать обновления, когда все обработчики готовы
+    loop = get_running_loop()
+    for process, ready in zip(app["processes"], app["ready"]):
+        while not await loop.run_in_executor(None, ready.wait, 1):
+            if not process.is_alive():
+                raise RuntimeError(f"Процесс {process.name} не запустился")
+    host = getenv("WEBHOOK_HOST")
+    if not host:
+        return
+    from aiogram import Bot
+    from aiogram.bot.api import TelegramAPIServer
+
+    bot = Bot(
+        token=getenv("TOKEN"),
+        server=TelegramAPIServer.from_base(
+            getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+        ),
+    )
+    try:
+        await bot.set_webhook(
+            host.rstrip("/") + app["path"],
+            drop_pending_updates=True,
+            secret_token=app["secret"],
+        )
+    finally:
+        await (await bot.get_session()).close()
+
+
+async def on_shutdown(app):
+    """Остановка обработчиков после того, как сервер перестал принимать обновления"""
+    loop = get_running_loop()
+    for queue in app["queues"]:
+        await loop.run_in_executor(None, queue.put, None)
+    timeout = float(getenv("WEBHOOK_DRAIN_TIMEOUT", 30))
+    for process in app["processes"]:
+        await loop.run_in_executor(None, process.join, timeout)
+        if process.is_alive():
+            warning("Процесс %s не успел доработать и будет остановлен", process.name)
+            process.terminate()
+
+
+def main():
+    basicConfig(level=INFO)
+    workers = int(getenv("WEBHOOK_WORKERS", 0)) or cpu_count()
+    context = get_context("spawn")
+    queues = [context.Queue(int(getenv("WEBHOOK_QUEUE", 1000))) for _ in range(workers)]
+    ready = [context.Event() for _ in range(workers)]
+    processes = [
+        context.Process(
+            target=worker, args=(i, queues[i], ready[i]), name=f"worker-{i}"
+        )
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    app = web.Application()
+    app["queues"] = queues
+    app["processes"] = processes
+    app["ready"] = ready
+    app["path"] = getenv("WEBHOOK_PATH", "/webhook")
+    app["secret"] = getenv("WEBHOOK_SECRET")
+    app["put_timeout"] = float(getenv("WEBHOOK_QUEUE_TIMEOUT", 10))
+    app.router.add_post(app["path"], handle)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    web.run_app(
+        app,
+        host=getenv("WEBAPP_HOST", "0.0.0.0"),
+        port=int(getenv("WEBAPP_PORT", 8080)),
+    )
+
+
+if __name__ == "__main__":
+    main()